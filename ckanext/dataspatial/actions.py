@@ -1,22 +1,37 @@
 # encoding: utf-8
 import datetime
+import hashlib
 import json
 import logging
+from typing import Optional, Union
 
-import ckan.lib.jobs as rq_jobs
+import sqlalchemy as sa
+from ckan.lib.dictization import model_dictize
 from ckan.logic import NotFound, side_effect_free
 from ckan.plugins import toolkit
 from ckan.types import Context, DataDict
 from dateutil.parser import isoparse as parse_iso_date
 from dateutil.parser import parse as parse_date
+from sqlalchemy.dialects.postgresql import JSONB
 
 from ckanext.dataspatial import jobs
-from ckanext.dataspatial.jobs import JOB_TYPE
+from ckanext.dataspatial.config import config as dataspatial_config
+from ckanext.dataspatial.lib.cache import TTLCache
+from ckanext.dataspatial.lib.db import (
+    get_connection,
+    get_last_write,
+    get_table_sizes,
+    record_table_write,
+)
 from ckanext.dataspatial.lib.postgis import prepare_and_populate_geoms
 from ckanext.dataspatial.lib.types import GeoreferenceStatus, StatusResult
+from ckanext.dataspatial.lib.util import (
+    INTERNAL_CONTEXT_KEY,
+    can_be_spatial,
+    should_be_updated,
+)
 
 enqueue_job = toolkit.enqueue_job
-get_queue = rq_jobs.get_queue
 
 config = toolkit.config
 
@@ -26,34 +41,22 @@ logger = logging.getLogger(__name__)
 TASK_TYPE = "dataspatial"
 TASK_KEY = "dataspatial"
 
+# task states of submissions that haven't finished
+IN_PROGRESS_STATES = (
+    GeoreferenceStatus.PENDING.value,
+    GeoreferenceStatus.SUBMITTING.value,
+    GeoreferenceStatus.WORKING.value,
+)
 
-def dataspatial_submit(context: Context, data_dict: DataDict) -> bool:
-    """Submit a job to be georeferenced.
 
-    Returns `True` if the job has been submitted and `False` if the job
-    has not been submitted, i.e. if a bug is encountered
-    """
-    # validate arguments and setup first
-    resource_id = toolkit.get_or_bust(data_dict, "resource_id")
-    try:
-        resource_dict = toolkit.get_action("resource_show")(
-            context,
-            {
-                "id": resource_id,
-            },
-        )
-        if (
-            not resource_dict.get("datastore_active")
-            and resource_dict.get("format").lower() != "geojson"
-        ):
-            raise toolkit.ValidationError(
-                "Resource data must be loaded into the datastore."
-            )
-    except toolkit.ObjectNotFound:
-        raise toolkit.ValidationError(f"Resource with ID {resource_id} does not exist.")
+def _find_extant_task(
+    context: Context, resource_id: str
+) -> tuple[Optional[str], bool]:
+    """Find the georeferencing task of a resource
 
-    # check if is a job is already running properly for this resource
-    extant_task_id = None
+    :returns: the id of the task, if any, and True if a job is already queued or
+        running for the resource, so it mustn't be submitted again
+    """
     try:
         extant_task = toolkit.get_action("task_status_show")(
             context,
@@ -68,24 +71,21 @@ def dataspatial_submit(context: Context, data_dict: DataDict) -> bool:
         # todo: add config options
         assume_task_stale_after = datetime.timedelta(seconds=3600)
         assume_task_stillborn_after = datetime.timedelta(seconds=5)
-        if extant_task.get("state") == GeoreferenceStatus.PENDING:
-            import re  # here because it takes a moment to load
-
-            queued_res_ids = [
-                re.search(r"'resource_id': u?'([^']+)'", job.description).groups()[0]
-                for job in get_queue().get_jobs()
-                if JOB_TYPE in str(job)
-            ]
+        if str(extant_task.get("state")).upper() in IN_PROGRESS_STATES:
+            job = jobs.get_in_flight_job(resource_id)
             updated = parse_iso_date(extant_task["last_updated"])
             time_since_last_updated = datetime.datetime.utcnow() - updated
 
-            if (
-                resource_id not in queued_res_ids
-                and time_since_last_updated > assume_task_stillborn_after
-            ):
+            if job is not None and job.get_status() == "queued":
+                logger.info(
+                    f"Job {job.id} is already queued for this resource, "
+                    f"so skipping this duplicate task"
+                )
+                return extant_task["id"], True
+            elif job is None and time_since_last_updated > assume_task_stillborn_after:
                 logger.info(
                     f"A pending task was found ({extant_task['id']}), "
-                    f"but its not found in the queue ({queued_res_ids}) "
+                    f"but its job is not in the queue "
                     f"and is {time_since_last_updated} hours old",
                 )
             elif time_since_last_updated > assume_task_stale_after:
@@ -98,11 +98,47 @@ def dataspatial_submit(context: Context, data_dict: DataDict) -> bool:
                     f"A healthy pending task was found {extant_task['id']} for this resource, "
                     f"so skipping this duplicate task"
                 )
-                return False
+                return extant_task["id"], True
+
+        return extant_task["id"], False
+    except toolkit.ObjectNotFound:
+        return None, False
+
+
+def dataspatial_submit(context: Context, data_dict: DataDict) -> bool:
+    """Submit a job to be georeferenced.
 
-        extant_task_id = extant_task["id"]
+    Returns `True` if the job has been submitted and `False` if the job
+    has not been submitted, i.e. if a bug is encountered or a job is already
+    queued or running for the resource
+
+    Jobs of tables estimated to be large go to their own queue. If `priority`
+    is true, as for submissions from the resource page, jobs of small tables
+    are put at the front of their queue.
+    """
+    # validate arguments and setup first
+    resource_id = toolkit.get_or_bust(data_dict, "resource_id")
+    try:
+        resource_dict = toolkit.get_action("resource_show")(
+            context,
+            {
+                "id": resource_id,
+            },
+        )
+        if (
+            not resource_dict.get("datastore_active")
+            and resource_dict.get("format").lower() != "geojson"
+        ):
+            raise toolkit.ValidationError(
+                "Resource data must be loaded into the datastore."
+            )
     except toolkit.ObjectNotFound:
-        pass
+        raise toolkit.ValidationError(f"Resource with ID {resource_id} does not exist.")
+
+    # check if is a job is already running properly for this resource
+    extant_task_id, duplicate = _find_extant_task(context, resource_id)
+    if duplicate:
+        return False
 
     # set task status to `submitting`
     task = {
@@ -122,19 +158,26 @@ def dataspatial_submit(context: Context, data_dict: DataDict) -> bool:
         {"session": model.meta.create_local_session(), "ignore_auth": True}, task
     )
 
-    # todo add to config
-    timeout = config.get("ckanext.dataspatial.job_timeout", "3600")
     try:
+        options = jobs.get_job_options(resource_id)
+        # interactive submissions of small tables skip the line
+        at_front = toolkit.asbool(data_dict.get("priority", False)) and not options["large"]
         job = enqueue_job(
             jobs.georeference_datastore_table,
             [resource_id, task["last_updated"], logger],
-            rq_kwargs={"timeout": timeout},
+            title=f"{jobs.JOB_TYPE} {resource_id}",
+            queue=options["queue"],
+            rq_kwargs={"timeout": options["timeout"], "at_front": at_front},
         )
     except Exception as e:
         logger.exception(e)
         return False
 
-    logger.debug(f"Enqueued dataspatial job {job.id} for resource {resource_id}")
+    jobs.register_job(resource_id, job)
+    logger.debug(
+        f"Enqueued dataspatial job {job.id} for resource {resource_id} "
+        f"on queue {options['queue']} with a {options['timeout']}s timeout"
+    )
 
     # update task status
     task["value"] = json.dumps({"job_id": job.id})
@@ -191,6 +234,18 @@ def dataspatial_hook(context: Context, data_dict: DataDict):
             except ValueError:
                 pass
 
+        # or its table written to, when submissions were skipped as it ran
+        last_write = get_last_write(resource_id)
+        if last_write and job_created:
+            try:
+                if last_write > parse_date(job_created):
+                    logger.debug(
+                        f"Table written to since job started {last_write} > {job_created}"
+                    )
+                    resubmit = True
+            except ValueError:
+                pass
+
     error = data_dict.get("error")
     if error:
         logger.error(error)
@@ -239,6 +294,11 @@ def dataspatial_status(context: Context, data_dict: DataDict) -> StatusResult:
             "job_id": job_id,
             "status": status,
             "rows_completed": rows_completed,
+            "rows_total": value.get("rows_total"),
+            "rows_per_second": value.get("rows_per_second"),
+            "eta": value.get("eta"),
+            "phase": value.get("phase"),
+            "phase_durations": value.get("phase_durations", {}),
             "notes": notes,
             "error": error,
             "last_updated": last_updated,
@@ -304,22 +364,338 @@ def dataspatial_populate(context: Context, data_dict: DataDict):
     prepare_and_populate_geoms(resource)
 
 
-@side_effect_free
-def dataspatial_resource_list(context: Context, data_dict: DataDict):
-    active_resources = toolkit.get_action("resource_search")(
-        context, {"query": "dataspatial_status:active"}
-    )["results"]
-    fields = [
-        "id",
-        "package_id",
-        "url",
-        "format",
-        "dataspatial_active",
-        "dataspatial_fields_definition",
-        "dataspatial_last_geom_updated",
-        "dataspatial_status",
+def select_resources_to_populate(
+    context: Context, query: str = "datastore_active:true", force: bool = False
+) -> list[dict]:
+    """Find the resources that need to be georeferenced, smallest tables first
+
+    :param context: Current context
+    :param query: resource_search query selecting the candidate resources
+        (Default value = "datastore_active:true")
+    :param force: If True, select resources that are up to date too
+        (Default value = False)
+    :returns: a list of {id, name, table_size} dictionaries
+    """
+    candidates = toolkit.get_action("resource_search")(context, {"query": query})[
+        "results"
+    ]
+    selected = [
+        resource
+        for resource in candidates
+        if (can_be_spatial(resource) if force else should_be_updated(resource))
     ]
-    result = []
-    for resource in active_resources:
-        result.append({field: resource.get(field) for field in fields})
+    with get_connection() as c:
+        sizes = get_table_sizes(c, [resource["id"] for resource in selected])
+    return sorted(
+        (
+            {
+                "id": resource["id"],
+                "name": resource.get("name"),
+                "table_size": sizes.get(resource["id"], 0),
+            }
+            for resource in selected
+        ),
+        key=lambda resource: resource["table_size"],
+    )
+
+
+def dataspatial_populate_all(context: Context, data_dict: DataDict) -> dict:
+    """Submit the resources that need to be georeferenced, smallest tables first.
+
+    At most `concurrency` of the selected resources are in flight at once, so
+    this submits up to the number of free slots and should be called again
+    (as `ckan dataspatial populate-all` does) until nothing remains.
+
+    :param context: Current context
+    :param data_dict: Parameters:
+      - query: resource_search query selecting the candidate resources,
+        defaults to every datastore resource
+      - force: if true, resources that are up to date are selected too
+      - dry_run: if true, only list the selected resources
+      - concurrency: largest number of selected resources in flight, 0 for no
+        limit, defaults to dataspatial.populate_all.concurrency
+      - exclude: ids of resources not to submit, e.g. because they were
+        already submitted by a previous call
+    :returns: a dictionary defining:
+        {
+            resources: The selected resources, as {id, name, table_size},
+            in_flight: Ids of the selected resources being georeferenced,
+            submitted: Ids of the resources submitted by this call,
+            already_queued: Ids of the resources not submitted because a
+                job was already queued or running for them,
+            failed: Ids of the resources this call failed to submit,
+            remaining: Ids of the resources still to be submitted,
+        }
+    """
+    toolkit.check_access("sysadmin", context, data_dict)
+    query = data_dict.get("query") or "datastore_active:true"
+    force = toolkit.asbool(data_dict.get("force", False))
+    dry_run = toolkit.asbool(data_dict.get("dry_run", False))
+    concurrency = toolkit.asint(
+        data_dict.get("concurrency", dataspatial_config["populate_all.concurrency"])
+    )
+    exclude = set(toolkit.aslist(data_dict.get("exclude", [])))
+
+    resources = select_resources_to_populate(context, query, force)
+    in_flight = [
+        resource["id"]
+        for resource in resources
+        if jobs.get_in_flight_job(resource["id"]) is not None
+    ]
+    remaining = [
+        resource["id"]
+        for resource in resources
+        if resource["id"] not in exclude and resource["id"] not in in_flight
+    ]
+
+    submitted = []
+    already_queued = []
+    failed = []
+    if not dry_run:
+        slots = len(remaining) if concurrency <= 0 else concurrency - len(in_flight)
+        for resource_id in remaining[: max(slots, 0)]:
+            if toolkit.get_action("dataspatial_submit")(
+                context, {"resource_id": resource_id}
+            ):
+                submitted.append(resource_id)
+            elif _find_extant_task(context, resource_id)[1]:
+                # submitted by someone else since in_flight was computed
+                already_queued.append(resource_id)
+            else:
+                failed.append(resource_id)
+        remaining = remaining[max(slots, 0) :]
+
+    return {
+        "resources": resources,
+        "in_flight": in_flight,
+        "submitted": submitted,
+        "already_queued": already_queued,
+        "failed": failed,
+        "remaining": remaining,
+    }
+
+
+RESOURCE_LIST_FIELDS = [
+    "id",
+    "package_id",
+    "url",
+    "format",
+    "dataspatial_active",
+    "dataspatial_fields_definition",
+    "dataspatial_last_geom_updated",
+    "dataspatial_status",
+]
+RESOURCE_LIST_DEFAULT_LIMIT = 100
+RESOURCE_LIST_MAX_LIMIT = 1000
+# parameters of paginated calls, without which the list is returned whole
+RESOURCE_LIST_PAGINATION_KEYS = ("limit", "cursor", "since", "version")
+
+_resource_list_cache: Optional[TTLCache] = None
+
+
+def _get_resource_list_cache() -> TTLCache:
+    """Return the process wide resource list cache, creating it on first use."""
+    global _resource_list_cache
+    if _resource_list_cache is None:
+        _resource_list_cache = TTLCache(
+            max_size=toolkit.asint(dataspatial_config["resource_list.cache_size"]),
+            ttl=toolkit.asint(dataspatial_config["resource_list.cache_ttl"]),
+        )
+    return _resource_list_cache
+
+
+def _active_resources_query(model, *columns):
+    """Query the active resources of public, active datasets whose
+    geometries are active."""
+    extras = sa.cast(model.Resource.extras, JSONB)
+    return (
+        model.Session.query(*columns)
+        .join(model.Package, model.Package.id == model.Resource.package_id)
+        .filter(model.Resource.state == "active")
+        .filter(model.Package.state == "active")
+        .filter(model.Package.private == False)  # noqa: E712
+        .filter(extras["dataspatial_status"].astext == "active")
+    )
+
+
+def get_resource_list_version(model) -> str:
+    """Get a version of the list of georeferenced resources, which changes
+    whenever any of them is modified, added or removed.
+
+    :param model: The CKAN model
+    :returns: a hex digest
+    """
+    count, last_modified = _active_resources_query(
+        model,
+        sa.func.count(model.Resource.id),
+        sa.func.max(model.Resource.metadata_modified),
+    ).one()
+    return hashlib.md5(f"{count}:{last_modified}".encode()).hexdigest()
+
+
+@side_effect_free
+def dataspatial_resource_list(
+    context: Context, data_dict: DataDict
+) -> Union[dict, list[dict]]:
+    """List the georeferenced resources, ordered by ID, a page at a time.
+
+    Pages are cached per process, for as long as the version of the list
+    doesn't change.
+
+    Called without any of the parameters below, every resource is returned
+    as a list, as before pagination was added.
+
+    :param context: Current context
+    :param data_dict: Parameters:
+      - limit: Number of resources per page (Default value = 100, at most 1000)
+      - cursor: The next_cursor returned with the previous page
+      - since: Only list resources georeferenced after this ISO timestamp
+      - version: The version returned by a previous call. If the list hasn't
+        changed since, no results are returned.
+    :returns: a dictionary defining:
+        {
+            results: The resources of the page, or None if not modified,
+            next_cursor: Cursor of the next page, or None if this is the last,
+            version: The version of the list,
+            modified: False if the list is still at the given version,
+        }
+    """
+    if not any(key in data_dict for key in RESOURCE_LIST_PAGINATION_KEYS):
+        version = get_resource_list_version(context["model"])
+        results = []
+        cursor = None
+        while True:
+            page = _get_cached_resource_list_page(
+                context, version, RESOURCE_LIST_MAX_LIMIT, cursor, None
+            )
+            results += page["results"]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return results
+
+    try:
+        limit = toolkit.asint(data_dict.get("limit", RESOURCE_LIST_DEFAULT_LIMIT))
+    except ValueError:
+        raise toolkit.ValidationError({"limit": ["Must be an integer"]})
+    if not 0 < limit <= RESOURCE_LIST_MAX_LIMIT:
+        raise toolkit.ValidationError(
+            {"limit": [f"Must be between 1 and {RESOURCE_LIST_MAX_LIMIT}"]}
+        )
+    cursor = data_dict.get("cursor") or None
+    since = data_dict.get("since") or None
+    if since:
+        try:
+            since = parse_iso_date(since)
+        except ValueError:
+            raise toolkit.ValidationError({"since": ["Must be an ISO timestamp"]})
+        if since.tzinfo is not None:
+            since = since.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        # timestamps are stored as ISO strings, which sort chronologically
+        since = since.isoformat()
+
+    model = context["model"]
+    version = get_resource_list_version(model)
+    if data_dict.get("version") == version:
+        return {
+            "results": None,
+            "next_cursor": None,
+            "version": version,
+            "modified": False,
+        }
+
+    page = _get_cached_resource_list_page(context, version, limit, cursor, since)
+    return dict(page, version=version, modified=True)
+
+
+def _get_cached_resource_list_page(
+    context: Context,
+    version: str,
+    limit: int,
+    cursor: Optional[str],
+    since: Optional[str],
+) -> dict:
+    cache = _get_resource_list_cache()
+    key = (limit, cursor, since)
+    page = cache.get(key, version)
+    if page is None:
+        page = _get_resource_list_page(context, limit, cursor, since)
+        cache.set(key, page, version)
+    return page
+
+
+def _get_resource_list_page(
+    context: Context, limit: int, cursor: Optional[str], since: Optional[str]
+) -> dict:
+    model = context["model"]
+    query = _active_resources_query(model, model.Resource)
+    if cursor:
+        query = query.filter(model.Resource.id > cursor)
+    if since:
+        extras = sa.cast(model.Resource.extras, JSONB)
+        query = query.filter(extras["dataspatial_last_geom_updated"].astext > since)
+    # one more than asked for tells if there's a next page
+    resources = query.order_by(model.Resource.id).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(resources) > limit:
+        resources = resources[:limit]
+        next_cursor = resources[-1].id
+
+    results = []
+    for resource in resources:
+        resource_dict = model_dictize.resource_dictize(resource, context)
+        results.append(
+            {field: resource_dict.get(field) for field in RESOURCE_LIST_FIELDS}
+        )
+    return {"results": results, "next_cursor": next_cursor}
+
+
+def _after_datastore_write(
+    context: Context, data_dict: DataDict, result: dict, submit: bool = True
+) -> None:
+    """Record a write made by a datastore action, and schedule the
+    georeferencing of the resource if enabled by dataspatial.auto_submit.
+
+    Writes of this extension, e.g. when loading GeoJSON, are flagged in their
+    context: they change the version of the table, but aren't recorded as
+    changes to the data, so they don't lead to another georeferencing.
+    """
+    if toolkit.asbool(data_dict.get("dry_run", False)):
+        return
+    resource_id = result.get("resource_id") or data_dict.get("resource_id")
+    if not resource_id:
+        return
+    internal = bool(context.get(INTERNAL_CONTEXT_KEY))
+    try:
+        record_table_write(resource_id, external=not internal)
+        if (
+            submit
+            and not internal
+            and toolkit.asbool(dataspatial_config["auto_submit"])
+        ):
+            jobs.schedule_auto_submit(resource_id)
+    except Exception as e:
+        # the write itself succeeded
+        logger.exception(e)
+
+
+@toolkit.chained_action
+def datastore_create(original_action, context: Context, data_dict: DataDict):
+    result = original_action(context, data_dict)
+    _after_datastore_write(context, data_dict, result)
+    return result
+
+
+@toolkit.chained_action
+def datastore_upsert(original_action, context: Context, data_dict: DataDict):
+    result = original_action(context, data_dict)
+    _after_datastore_write(context, data_dict, result)
+    return result
+
+
+@toolkit.chained_action
+def datastore_delete(original_action, context: Context, data_dict: DataDict):
+    result = original_action(context, data_dict)
+    # deleted rows don't need georeferencing
+    _after_datastore_write(context, data_dict, result, submit=False)
     return result
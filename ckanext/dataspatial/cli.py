@@ -1,7 +1,9 @@
 # encoding: utf-8
 import logging
+import time
 
 import click
+from ckan.plugins import toolkit
 
 from ckanext.dataspatial.lib.geofiles import load_geojson_to_datastore
 from ckanext.dataspatial.lib.postgis import (
@@ -17,11 +19,20 @@ log = logging.getLogger("ckan")
 
 @click.command()
 @click.argument("action")
-@click.argument("resource_id")
+@click.argument("resource_id", required=False)
 @click.option("--latitude-field")
 @click.option("--longitude-field")
 @click.option("--wkt-field")
 @click.option("--geom-type")
+@click.option("--query", help="populate-all: resource_search query selecting resources")
+@click.option("--force", is_flag=True, help="populate-all: include up to date resources")
+@click.option("--dry-run", is_flag=True, help="populate-all: only list the resources")
+@click.option(
+    "--concurrency", type=int, help="populate-all: largest number of jobs in flight"
+)
+@click.option(
+    "--interval", type=int, default=10, help="populate-all: seconds between checks"
+)
 def dataspatial(
     action: str,
     resource_id: str,
@@ -29,23 +40,37 @@ def dataspatial(
     longitude_field: str,
     wkt_field: str,
     geom_type: str,
+    query: str,
+    force: bool,
+    dry_run: bool,
+    concurrency: int,
+    interval: int,
 ):
     """Run dataspatial COMMAND to create or populate postgis spatial columns on datasets.
 
-    ACTION: one of (create-columns | create-index | populate-columns)
-    RESOURCE_ID: ID of resource to modify/update
+    ACTION: one of (create-columns | create-index | populate-columns | populate-all)
+    RESOURCE_ID: ID of resource to modify/update, not used by populate-all
     """
     # Validate arguments
     if action not in [
         "create-columns",
         "create-index",
         "populate-columns",
+        "populate-all",
         "load-file",
     ]:
         raise click.BadArgumentUsage(
-            "Please specify one of create-columns, create-index or populate-columns"
+            "Please specify one of create-columns, create-index, populate-columns "
+            "or populate-all"
         )
 
+    if action == "populate-all":
+        populate_all(query, force, dry_run, concurrency, interval)
+        return
+
+    if not resource_id:
+        raise click.BadArgumentUsage("Please specify a RESOURCE_ID")
+
     if action == "load-file":
         load_geojson_to_datastore(resource_id)
 
@@ -81,6 +106,47 @@ def dataspatial(
     click.echo("Done!")
 
 
+def populate_all(
+    query: str, force: bool, dry_run: bool, concurrency: int, interval: int
+):
+    """Submit every resource that needs georeferencing, waiting for jobs to
+    finish so that no more than the concurrency limit are in flight."""
+    site_user = toolkit.get_action("get_site_user")({"ignore_auth": True}, {})
+    data_dict = {"query": query, "force": force, "dry_run": dry_run}
+    if concurrency is not None:
+        data_dict["concurrency"] = concurrency
+
+    submitted = []
+    already_queued = []
+    failed = []
+    while True:
+        result = toolkit.get_action("dataspatial_populate_all")(
+            {"user": site_user["name"], "ignore_auth": True},
+            dict(data_dict, exclude=submitted + already_queued + failed),
+        )
+        if dry_run:
+            for resource in result["resources"]:
+                click.echo(
+                    f"{resource['id']}\t{resource['table_size']}\t{resource['name']}"
+                )
+            click.echo(f"{len(result['resources'])} resources would be submitted.")
+            return
+
+        for resource_id in result["submitted"]:
+            click.echo(f"Submitted {resource_id}.")
+        for resource_id in result["already_queued"]:
+            click.echo(f"{resource_id} is already queued.")
+        for resource_id in result["failed"]:
+            click.echo(f"Failed to submit {resource_id}.", err=True)
+        submitted += result["submitted"]
+        already_queued += result["already_queued"]
+        failed += result["failed"]
+        if not result["remaining"] and not result["in_flight"]:
+            break
+        time.sleep(interval)
+    click.echo(f"Done! {len(submitted)} resources submitted.")
+
+
 @click.command()
 def dataspatial_init():
     click.echo("Updating _full_text update trigger.")
@@ -2,8 +2,52 @@
 
 config = {
     "query_extent": "postgis",
+    "query_extent.cache_size": "256",
+    "query_extent.cache_ttl": "60",
+    "auto_submit": "false",
+    "auto_submit.debounce": "60",
+    "auto_submit.max_wait": "600",
+    "cells.geohash_precisions": "",
+    "db.async_read": "false",
+    "db.statement_timeout": "30000",
+    "db.read_urls": "",
+    "db.read_routing": "round_robin",
+    "db.health_check_interval": "30",
+    "db.replica_max_lag": "30",
+    "db.replica_connect_timeout": "5",
+    "db.primary_pin_seconds": "60",
+    "db.read.pool_size": "5",
+    "db.read.max_overflow": "10",
+    "db.read.pool_pre_ping": "false",
+    "db.read.pool_recycle": "-1",
+    "db.write.pool_size": "0",
+    "db.write.max_overflow": "10",
+    "db.write.pool_pre_ping": "false",
+    "db.write.pool_recycle": "-1",
+    "export.formats": "",
+    "introspection.cache_size": "1024",
+    "introspection.cache_ttl": "60",
+    "export.ogr2ogr": "ogr2ogr",
+    "geojson.precision": "6",
+    "grid.max_cells": "10000",
+    "jobs.queue": "default",
+    "jobs.large_queue": "default",
+    "jobs.large_table_rows": "1000000",
+    "jobs.seconds_per_million_rows": "1800",
+    "jobs.max_timeout": "86400",
+    "metrics.exporters": "",
+    "metrics.statsd_host": "localhost",
+    "metrics.statsd_port": "8125",
+    "metrics.statsd_prefix": "",
+    "nearest.max_k": "1000",
+    "populate_all.concurrency": "4",
+    "resource_list.cache_size": "64",
+    "resource_list.cache_ttl": "60",
     "postgis.field": "_geom",
     "postgis.mercator_field": "_geom_webmercator",
+    "status.update_interval": "5",
+    "solr.url": "",
+    "solr.timeout": "10",
     "solr.index_field": "_geom",
     "solr.latitude_field": "latitude",
     "solr.longitude_field": "longitude",
@@ -1,50 +1,343 @@
+import datetime
 import logging
+import math
+import time
 import traceback
+from typing import Optional
 
+from ckan.lib.jobs import get_queue
+from ckan.lib.redis import connect_to_redis
 from ckan.plugins import toolkit
 from ckan.types import Context
+from rq import get_current_job
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
 
-from ckanext.dataspatial.lib import geofiles, postgis
+from ckanext.dataspatial.config import config
+from ckanext.dataspatial.lib import export, geofiles, links, metrics, postgis
+from ckanext.dataspatial.lib.db import (
+    get_connection,
+    get_estimated_row_count,
+    get_last_write,
+    record_table_write,
+)
 from ckanext.dataspatial.lib.types import StatusCallback, GeoreferenceStatus
+from ckanext.dataspatial.lib.util import (
+    DEFAULT_CONTEXT,
+    can_be_spatial,
+    links_to_polygons,
+    takes_linked_geoms,
+)
 
 JOB_TYPE = "dataspatial_georeference"
+AUTO_SUBMIT_JOB_TYPE = "dataspatial_auto_submit"
+
+# rq statuses of jobs that have not run to completion yet
+IN_FLIGHT_JOB_STATUSES = ("queued", "started", "deferred", "scheduled")
+
+# how long the id of the last georeferencing job of a resource is kept
+JOB_ID_TTL = 7 * 24 * 60 * 60
 
 logger = logging.getLogger(__name__)
 
 
+def get_job_options(resource_id: str) -> dict:
+    """Choose the queue and timeout of the georeferencing job of a resource
+
+    Tables estimated to have more than dataspatial.jobs.large_table_rows rows
+    go to dataspatial.jobs.large_queue, so they don't hold up smaller ones.
+    The timeout grows with the size of the table, from
+    ckanext.dataspatial.job_timeout by dataspatial.jobs.seconds_per_million_rows,
+    up to dataspatial.jobs.max_timeout.
+
+    :param resource_id: The resource to georeference
+    :returns: a dictionary defining:
+        {
+            queue: The queue name,
+            timeout: The timeout in seconds,
+            large: True if the table is large,
+        }
+    """
+    with get_connection() as c:
+        rows = get_estimated_row_count(c, resource_id)
+
+    base_timeout = toolkit.asint(
+        toolkit.config.get("ckanext.dataspatial.job_timeout", "3600")
+    )
+    timeout = base_timeout + math.ceil(
+        rows / 1_000_000 * toolkit.asint(config["jobs.seconds_per_million_rows"])
+    )
+    timeout = min(timeout, max(base_timeout, toolkit.asint(config["jobs.max_timeout"])))
+
+    large = rows > toolkit.asint(config["jobs.large_table_rows"])
+    return {
+        "queue": config["jobs.large_queue"] if large else config["jobs.queue"],
+        "timeout": timeout,
+        "large": large,
+    }
+
+
+def _job_key(resource_id: str) -> str:
+    return f"ckanext:dataspatial:job:{resource_id}"
+
+
+def register_job(resource_id: str, job: Job) -> None:
+    """Record the georeferencing job of a resource
+
+    This keeps the id of the last job of each resource in redis, so it can be
+    looked up directly rather than by scanning the queue.
+    """
+    connect_to_redis().set(_job_key(resource_id), job.id, ex=JOB_ID_TTL)
+
+
+def get_in_flight_job(resource_id: str) -> Optional[Job]:
+    """Get the georeferencing job of a resource if it is queued or running
+
+    :param resource_id: The resource to look for
+    :returns: the job, or None if there is none in flight
+    """
+    redis = connect_to_redis()
+    job_id = redis.get(_job_key(resource_id))
+    if job_id is None:
+        return None
+    if isinstance(job_id, bytes):
+        job_id = job_id.decode()
+    try:
+        job = Job.fetch(job_id, connection=redis)
+    except NoSuchJobError:
+        return None
+    if job.get_status() not in IN_FLIGHT_JOB_STATUSES:
+        return None
+    return job
+
+
+def _auto_submit_key(resource_id: str) -> str:
+    return f"ckanext:dataspatial:auto_submit:{resource_id}"
+
+
+def schedule_auto_submit(resource_id: str) -> None:
+    """Schedule the georeferencing of a resource after a write to its table
+
+    Unless one is already scheduled for this resource, a job is enqueued to
+    run in dataspatial.auto_submit.debounce seconds. It submits the resource
+    if no write happened since, and reschedules itself otherwise, so a burst
+    of writes leads to a single georeferencing job.
+
+    :param resource_id: The resource that was written to
+    """
+    debounce = toolkit.asint(config["auto_submit.debounce"])
+    max_wait = toolkit.asint(config["auto_submit.max_wait"])
+    # the key outlives the scheduled job, even if it is lost
+    expires = debounce + max_wait + 60
+
+    redis = connect_to_redis()
+    if not redis.set(_auto_submit_key(resource_id), 1, nx=True, ex=expires):
+        return
+
+    try:
+        _enqueue_auto_submit(resource_id, time.time() + max_wait, debounce)
+    except Exception:
+        redis.delete(_auto_submit_key(resource_id))
+        raise
+
+
+def _enqueue_auto_submit(resource_id: str, deadline: float, delay: float) -> None:
+    get_queue(config["jobs.queue"]).enqueue_in(
+        datetime.timedelta(seconds=math.ceil(delay)),
+        auto_submit_datastore_table,
+        resource_id,
+        deadline,
+        description=f"{AUTO_SUBMIT_JOB_TYPE} {resource_id}",
+        meta={"title": f"{AUTO_SUBMIT_JOB_TYPE} {resource_id}"},
+    )
+
+
+def auto_submit_datastore_table(resource_id: str, deadline: float) -> None:
+    """Submit a resource for georeferencing if its table has not been written
+    to for dataspatial.auto_submit.debounce seconds
+
+    Otherwise the job is scheduled again for when that will be the case, or
+    for the deadline, so writes that keep coming don't delay the submission
+    by more than dataspatial.auto_submit.max_wait seconds.
+
+    :param resource_id: The resource to submit
+    :param deadline: Timestamp after which the resource is submitted anyway
+    """
+    debounce = toolkit.asint(config["auto_submit.debounce"])
+    last_write = get_last_write(resource_id)
+    last_write = (
+        last_write.replace(tzinfo=datetime.timezone.utc).timestamp()
+        if last_write
+        else 0
+    )
+    wait = min(last_write + debounce, deadline) - time.time()
+    if wait > 0:
+        _enqueue_auto_submit(resource_id, deadline, wait)
+        return
+
+    # writes from now on schedule another submission
+    connect_to_redis().delete(_auto_submit_key(resource_id))
+
+    try:
+        resource = toolkit.get_action("resource_show")(
+            DEFAULT_CONTEXT, {"id": resource_id}
+        )
+    except toolkit.ObjectNotFound:
+        return
+    if not can_be_spatial(resource):
+        return
+    logger.info(f"Submitting {resource_id}, whose datastore table was written to.")
+    toolkit.get_action("dataspatial_submit")(
+        DEFAULT_CONTEXT, {"resource_id": resource_id}
+    )
+
+
+class JobProgress:
+    """Accumulates the progress reported by the steps of a job
+
+    Steps report a `phase` when they start, and `rows_completed` and
+    `rows_total` as they go. Values are merged into those reported before,
+    per-phase counters being reset when the phase changes. Phases are timed
+    from when they start to when the next one starts or the job ends, unless
+    a step reports their duration itself in `phase_durations`.
+    """
+
+    def __init__(self):
+        self.phase = None
+        self.phase_started = None
+        self.phase_durations = {}
+        self._reported_phases = set()
+        self._values = {}
+
+    def _end_phase(self, now: float) -> None:
+        if self.phase is not None and self.phase not in self._reported_phases:
+            duration = self.phase_durations.get(self.phase, 0) + now - self.phase_started
+            self.phase_durations[self.phase] = round(duration, 3)
+        self.phase = None
+
+    def update(self, status: str, value: Optional[dict] = None) -> dict:
+        """Merge a status update, and return the full progress to record
+
+        :param status: Status of the job
+        :param value: Values reported by the step
+        :returns: the task value, with rows_per_second and eta added if the
+            current phase reported rows
+        """
+        now = time.monotonic()
+        value = dict(value or {})
+        phase = value.pop("phase", self.phase)
+        if phase != self.phase:
+            self._end_phase(now)
+            self.phase = phase
+            self.phase_started = now
+            self._values = {}
+        for name, duration in value.pop("phase_durations", {}).items():
+            self.phase_durations[name] = duration
+            self._reported_phases.add(name)
+        self._values.update(value)
+
+        result = dict(self._values, phase=self.phase)
+        rows_completed = self._values.get("rows_completed")
+        rows_total = self._values.get("rows_total")
+        elapsed = now - self.phase_started if self.phase_started else 0
+        if rows_completed and elapsed > 0:
+            rows_per_second = rows_completed / elapsed
+            result["rows_per_second"] = round(rows_per_second, 1)
+            if rows_total:
+                remaining = max(rows_total - rows_completed, 0) / rows_per_second
+                eta = datetime.datetime.utcnow() + datetime.timedelta(seconds=remaining)
+                result["eta"] = eta.isoformat()
+
+        if status != GeoreferenceStatus.WORKING:
+            self._end_phase(now)
+            result["phase"] = None
+            result.pop("eta", None)
+        result["phase_durations"] = dict(self.phase_durations)
+        return result
+
+
 def make_status_callback(
     resource_id: str,
     job_created: str,
     context: Context,
 ) -> StatusCallback:
+    """Make a callback reporting the status of a job through dataspatial_hook
+
+    The values reported are accumulated by a JobProgress, so the task value
+    always holds the progress of the whole job.
+
+    Progress updates (WORKING updates with the same notes and phase as the
+    last one sent) are coalesced, sending at most one every
+    dataspatial.status.update_interval seconds. Phase changes, errors and
+    any other status are always sent immediately.
+    """
+    interval = float(config["status.update_interval"])
+    progress = JobProgress()
+    last_sent = {"time": None, "notes": None, "phase": None}
+
     def callback(
         status: str,
         value: dict = None,
         error: str = None,
     ) -> None:
+        value = progress.update(status, value)
+        notes = value.get("notes")
+        now = time.monotonic()
+        is_progress = (
+            status == GeoreferenceStatus.WORKING
+            and not error
+            and last_sent["time"] is not None
+            and notes == last_sent["notes"]
+            and value["phase"] == last_sent["phase"]
+        )
+        if is_progress and now - last_sent["time"] < interval:
+            return
+        last_sent["time"] = now
+        last_sent["notes"] = notes
+        last_sent["phase"] = value["phase"]
+
         data_dict = {
             "resource_id": resource_id,
             "job_created": job_created,
             "status": status,
             "error": None,
+            "value": value,
         }
 
         if error:
             logger.error(error)
             data_dict["error"] = error
-        if value:
-            data_dict["value"] = value
 
         return toolkit.get_action("dataspatial_hook")(context, data_dict)
 
     return callback
 
 
+def _observe_queue_wait() -> None:
+    """Record how long the current job waited in its queue"""
+    job = get_current_job()
+    if job is None or job.enqueued_at is None:
+        return
+    started_at = job.started_at
+    if started_at is None:
+        # rq stores naive UTC times, or aware ones in later versions
+        if job.enqueued_at.tzinfo is None:
+            started_at = datetime.datetime.utcnow()
+        else:
+            started_at = datetime.datetime.now(datetime.timezone.utc)
+    metrics.observe(
+        "dataspatial_job_queue_wait_seconds",
+        (started_at - job.enqueued_at).total_seconds(),
+        queue=job.origin,
+    )
+
+
 def georeference_datastore_table(
     resource_id: str,
     job_created: str,
     logger,
 ) -> None:
+    _observe_queue_wait()
     status_callback = make_status_callback(
         resource_id, job_created, {"user": "default"}
     )
@@ -74,8 +367,133 @@ def georeference_datastore_table(
             raise toolkit.ValidationError(
                 "Can only georeference geojson files or resources pushed to datastore."
             )
+
+        # the cached exports are stale now the new geometries are committed,
+        # but keep serving them until then
+        export.remove_exports(resource_id)
+
         status_callback(GeoreferenceStatus.COMPLETE, value={"notes": ""})
 
+        submit_dependent_resources(resource_id)
+
+        if links_to_polygons(resource):
+            enqueue_link_job(resource_id)
+
+        if export.get_export_formats():
+            toolkit.enqueue_job(
+                export_datastore_table,
+                [resource_id],
+                title=f"dataspatial export {resource_id}",
+            )
+
     except Exception as e:
         logger.error(traceback.format_exc())
         status_callback(GeoreferenceStatus.ERROR, error=traceback.format_exc())
+
+
+def export_datastore_table(resource_id: str) -> None:
+    """Write the cached exports of a georeferenced resource in every
+    configured format.
+    """
+    for export_format in export.get_export_formats():
+        try:
+            export.write_export(resource_id, export_format)
+        except Exception:
+            logger.error(traceback.format_exc())
+
+
+def _find_dependents(resource_id: str, field: str) -> list[dict]:
+    dependents = toolkit.get_action("resource_search")(
+        DEFAULT_CONTEXT, {"query": f"{field}:{resource_id}"}
+    )["results"]
+    return [
+        dependent
+        for dependent in dependents
+        if dependent["id"] != resource_id and dependent.get(field) == resource_id
+    ]
+
+
+def submit_dependent_resources(resource_id: str) -> None:
+    """Update the resources that depend on a resource, now that its geometries
+    have changed.
+
+    Resources taking their geometries from it through their
+    dataspatial_geom_resource are georeferenced again; georeferenced
+    resources linked to its polygons through their dataspatial_link_resource
+    only have their rows linked again.
+    """
+    for dependent in _find_dependents(resource_id, "dataspatial_geom_resource"):
+        if not takes_linked_geoms(dependent):
+            continue
+        logger.info(f"Submitting {dependent['id']}, which is linked to {resource_id}.")
+        toolkit.get_action("dataspatial_submit")(
+            DEFAULT_CONTEXT, {"resource_id": dependent["id"]}
+        )
+
+    for dependent in _find_dependents(resource_id, "dataspatial_link_resource"):
+        if not links_to_polygons(dependent) or not dependent.get("dataspatial_active"):
+            continue
+        logger.info(f"Linking {dependent['id']} to the polygons of {resource_id}.")
+        enqueue_link_job(dependent["id"])
+
+
+def enqueue_link_job(resource_id: str) -> None:
+    """Queue a job linking the rows of a resource to its polygon resource"""
+    toolkit.enqueue_job(
+        link_datastore_table,
+        [resource_id],
+        title=f"dataspatial link {resource_id}",
+    )
+
+
+def link_datastore_table(resource_id: str) -> None:
+    """Link the rows of a georeferenced resource to the polygons of the
+    resource set in its dataspatial_link_resource.
+
+    Only rows whose geometry changed since the last run are linked, unless the
+    polygons have been georeferenced again since then.
+    """
+    try:
+        resource = toolkit.get_action("resource_show")(
+            DEFAULT_CONTEXT, {"id": resource_id}
+        )
+        if not links_to_polygons(resource):
+            # the link was removed since the job was queued
+            return
+        polygon_resource = toolkit.get_action("resource_show")(
+            DEFAULT_CONTEXT, {"id": resource["dataspatial_link_resource"]}
+        )
+    except toolkit.ObjectNotFound:
+        # either resource was deleted since the job was queued
+        logger.error(f"Cannot link {resource_id}: resource not found.")
+        return
+    if not polygon_resource.get("dataspatial_active"):
+        logger.error(
+            f"Cannot link {resource_id} to {polygon_resource['id']}, "
+            f"which has not been georeferenced."
+        )
+        return
+
+    link_updated = resource.get("dataspatial_link_updated")
+    polygons_updated = polygon_resource.get("dataspatial_last_geom_updated")
+    full = not link_updated or (polygons_updated and polygons_updated > link_updated)
+
+    try:
+        links.link_to_polygons(
+            resource_id,
+            polygon_resource["id"],
+            resource["dataspatial_link_field"],
+            full=full,
+        )
+    except Exception:
+        logger.error(traceback.format_exc())
+        return
+    record_table_write(resource_id, external=False)
+
+    toolkit.get_action("resource_patch")(
+        DEFAULT_CONTEXT,
+        {
+            "id": resource_id,
+            "dataspatial_link_updated": datetime.datetime.utcnow().isoformat(),
+        },
+    )
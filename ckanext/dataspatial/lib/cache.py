@@ -0,0 +1,66 @@
+# encoding: utf-8
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class TTLCache:
+    """A small thread safe LRU cache whose entries expire after a fixed time.
+
+    :param max_size: Maximum number of entries kept. The least recently used
+        entry is evicted when the cache is full.
+    :param ttl: Number of seconds an entry stays valid.
+    """
+
+    def __init__(self, max_size: int = 256, ttl: float = 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, version: Any = None) -> Optional[Any]:
+        """Return the cached value for key, or None if it is missing, expired or
+        was stored for a different version.
+
+        :param key: Cache key
+        :param version: Version the value must have been stored with
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, entry_version, value = entry
+            if expires < time.monotonic() or entry_version != version:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, version: Any = None) -> None:
+        """Store a value, evicting the least recently used entries if needed.
+
+        :param key: Cache key
+        :param value: Value to store
+        :param version: Version of the underlying data the value was computed from
+        """
+        if self.max_size <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, predicate=None) -> None:
+        """Remove entries from the cache.
+
+        :param predicate: Callable taking a key and returning True if that entry
+            should be removed. If None, the whole cache is cleared.
+        """
+        with self._lock:
+            if predicate is None:
+                self._entries.clear()
+                return
+            for key in [k for k in self._entries if predicate(k)]:
+                del self._entries[key]
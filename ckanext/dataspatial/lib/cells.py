@@ -0,0 +1,211 @@
+# encoding: utf-8
+# Precomputed geohash cell columns.
+#
+# Geohashes are hierarchical: the geohash of a point at a given precision is a
+# prefix of its geohash at every higher precision, so a cell and all the cells
+# within it can be found with a prefix scan on a btree index.
+import logging
+import math
+from typing import Optional
+
+from ckan.plugins import toolkit
+
+from ckanext.dataspatial.config import config
+from ckanext.dataspatial.lib import metrics
+from ckanext.dataspatial.lib.constants import BATCH_SIZE
+from ckanext.dataspatial.lib.db import (
+    Connection,
+    create_column,
+    create_index,
+    fields_exist,
+    get_connection,
+)
+from ckanext.dataspatial.lib.types import (
+    GeoreferencePhase,
+    GeoreferenceStatus,
+    StatusCallback,
+)
+
+logger = logging.getLogger(__name__)
+
+# approximate width of a geohash cell at the equator in meters, by precision
+GEOHASH_CELL_WIDTHS = {
+    1: 5009400,
+    2: 1252300,
+    3: 156500,
+    4: 39100,
+    5: 4890,
+    6: 1220,
+    7: 153,
+    8: 38.2,
+    9: 4.77,
+    10: 1.19,
+    11: 0.149,
+    12: 0.0372,
+}
+
+
+def geohash_field(precision: int) -> str:
+    """Get the name of the column holding geohashes of the given precision"""
+    return f"_geohash_{precision}"
+
+
+def get_geohash_precisions() -> list[int]:
+    """Get the configured geohash precisions, in ascending order"""
+    precisions = set()
+    for value in toolkit.aslist(config["cells.geohash_precisions"]):
+        precision = int(value)
+        if precision not in GEOHASH_CELL_WIDTHS:
+            raise ValueError(f"Geohash precision must be between 1 and 12: {value}")
+        precisions.add(precision)
+    return sorted(precisions)
+
+
+def get_available_precisions(
+    resource_id: str, connection: Optional[Connection] = None
+) -> list[int]:
+    """Get the configured geohash precisions the table of a resource has
+    columns for, in ascending order.
+
+    :param resource_id: The resource to check
+    :param connection: Database connection. If None, one will be
+        created for this operation. (Default value = None)
+    """
+    precisions = get_geohash_precisions()
+    if not precisions:
+        return []
+    with get_connection(connection) as c:
+        return [
+            precision
+            for precision in precisions
+            if fields_exist(c, resource_id, [geohash_field(precision)])
+        ]
+
+
+def precision_for_cell_size(precisions: list[int], cell_size: float) -> int:
+    """Pick the precision whose cells are closest in size to cell_size
+
+    :param precisions: Available precisions
+    :param cell_size: Wanted cell width in meters
+    """
+    return min(
+        precisions,
+        key=lambda p: abs(math.log(GEOHASH_CELL_WIDTHS[p] / cell_size)),
+    )
+
+
+def geohash_cell_degrees(precision: int) -> tuple[float, float]:
+    """Get the width and height of the geohash cells of a precision in degrees
+
+    Each character of a geohash holds 5 bits, alternating between longitude
+    and latitude, starting with longitude.
+
+    :param precision: Geohash precision
+    """
+    bits = 5 * precision
+    return 360 / 2 ** math.ceil(bits / 2), 180 / 2 ** (bits // 2)
+
+
+def estimate_geohash_cells(bbox: list[float], precision: int) -> int:
+    """Estimate the largest number of geohash cells of a precision a bbox can
+    overlap
+
+    :param bbox: [xmin, ymin, xmax, ymax] in WGS84
+    :param precision: Geohash precision
+    """
+    width, height = geohash_cell_degrees(precision)
+    # the bbox can overlap part of a cell on either side of the cells it spans
+    columns = min(math.floor((bbox[2] - bbox[0]) / width) + 2, round(360 / width))
+    rows = min(math.floor((bbox[3] - bbox[1]) / height) + 2, round(180 / height))
+    return columns * rows
+
+
+def create_geohash_columns(
+    resource_id: str,
+    precisions: list[int],
+    connection: Optional[Connection] = None,
+) -> None:
+    """Create the geohash columns and their prefix search indexes
+
+    :param resource_id: The resource to create the columns on
+    :param precisions: The precisions to create columns for
+    :param connection: Database connection. If None, one will be
+        created for this operation. (Default value = None)
+    """
+    with get_connection(connection, write=True) as c:
+        for precision in precisions:
+            field = geohash_field(precision)
+            create_column(c, resource_id, field, "text")
+            create_index(c, resource_id, field, "BTREE", "text_pattern_ops")
+
+
+def populate_geohash_columns(
+    resource_id: str,
+    precisions: list[int],
+    geom_field: str,
+    connection: Optional[Connection] = None,
+    status_callback: StatusCallback = lambda status, value=None, error=None: None,
+) -> None:
+    """Compute the geohashes of every row that has a geom but no geohash yet
+
+    Rows are updated in batches of _id ranges, committing after each batch,
+    and progress is reported after each batch. Geohashes are computed from
+    the centroid of each geometry.
+
+    :param resource_id: The resource to populate
+    :param precisions: The precisions to populate
+    :param geom_field: The WGS84 geometry column
+    :param connection: Database connection. If None, one will be
+        created for this operation. (Default value = None)
+    :param status_callback: Callable that logs status to CKAN task table
+    """
+    if not precisions:
+        return
+    assignments = ", ".join(
+        f'"{geohash_field(p)}" = ST_GeoHash(ST_Centroid("{geom_field}"), {p})'
+        for p in precisions
+    )
+    missing = " OR ".join(f'"{geohash_field(p)}" IS NULL' for p in precisions)
+    update_sql = f"""
+        UPDATE "{resource_id}"
+        SET    {assignments}
+        WHERE  _id >= %s AND _id < %s
+          AND  "{geom_field}" IS NOT NULL
+          AND  ({missing})
+    """
+
+    with get_connection(connection, write=True, raw=True) as c:
+        cursor = c.cursor()
+        cursor.execute(f'SELECT MIN(_id), MAX(_id) FROM "{resource_id}"')
+        min_id, max_id = cursor.fetchone()
+        if min_id is None:
+            return
+
+        rows_total = max_id + 1 - min_id
+        status_callback(
+            GeoreferenceStatus.WORKING,
+            value={
+                "notes": "Populating geohash columns.",
+                "phase": GeoreferencePhase.GEOHASH.value,
+                "rows_completed": 0,
+                "rows_total": rows_total,
+            },
+        )
+        count = 0
+        for start in range(min_id, max_id + 1, BATCH_SIZE):
+            with metrics.timed(
+                "dataspatial_batch_seconds", phase=GeoreferencePhase.GEOHASH.value
+            ):
+                cursor.execute(update_sql, (start, start + BATCH_SIZE))
+                count += cursor.rowcount
+                c.commit()
+            status_callback(
+                GeoreferenceStatus.WORKING,
+                value={
+                    "notes": "Populating geohash columns.",
+                    "phase": GeoreferencePhase.GEOHASH.value,
+                    "rows_completed": min(start + BATCH_SIZE, max_id + 1) - min_id,
+                    "rows_total": rows_total,
+                },
+            )
+        logger.info(f"Geohash columns of {count} rows of {resource_id} populated.")
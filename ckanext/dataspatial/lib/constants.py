@@ -23,3 +23,11 @@ WKB_FIELD_NAME = "dataspatial_wkb"
 
 
 BATCH_SIZE = 5000
+
+
+# datastore_search filters provided by this extension
+BBOX_FILTER = "_bbox"
+DISTANCE_FILTER = "_within_distance"
+WKT_FILTER = "_intersects_wkt"
+GEOHASH_FILTER = "_geohash"
+SPATIAL_FILTERS = (BBOX_FILTER, DISTANCE_FILTER, WKT_FILTER, GEOHASH_FILTER)
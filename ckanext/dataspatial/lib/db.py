@@ -1,39 +1,285 @@
 # encoding: utf-8
-from contextlib import contextmanager
+import asyncio
+import concurrent.futures
+import datetime
+import itertools
+import json
+import logging
+import re
+import threading
+import time
+from contextlib import ExitStack, contextmanager
 from typing import Optional, Generator, Iterable, Union
 
+from ckan.lib.redis import connect_to_redis
 from ckan.plugins import PluginImplementations, toolkit
 from ckanext.datastore.interfaces import IDatastore
 from sqlalchemy import create_engine, sql, text
-from sqlalchemy.engine import Connection, Engine, Row
+from sqlalchemy.engine import Connection, Engine, Row, RowMapping, make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from sqlalchemy.pool import NullPool
-from sqlalchemy.sql import Select
 from sqlalchemy.sql.elements import TextClause
 
-_read_engine = None
+from ckanext.dataspatial.config import config
+from ckanext.dataspatial.lib import metrics
+from ckanext.dataspatial.lib.cache import TTLCache
+from ckanext.dataspatial.lib.types import TableInfo
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+logger = logging.getLogger(__name__)
+
+_read_engines: dict[str, Engine] = {}
 _write_engine = None
+_async_read_engines: dict[str, AsyncEngine] = {}
+_engines_lock = threading.Lock()
+_event_loop = None
+_event_loop_lock = threading.Lock()
+_read_targets: dict[str, "ReadTarget"] = {}
+_round_robin = itertools.count()
+_table_info_cache = None
+
+# postgres error code of statements cancelled by statement_timeout
+QUERY_CANCELED = "57014"
+
+READ_ROUTINGS = ("round_robin", "least_connections")
+
+# how long the count of writes to a table is kept after the last one
+TABLE_WRITES_TTL = 7 * 24 * 60 * 60
+
+
+def _engine_options(kind: str) -> dict:
+    """Get the connection pool options of an engine from the configuration
+
+    A pool size of 0 disables pooling, opening a new database connection each
+    time one is needed.
+
+    :param kind: read or write
+    :returns: keyword arguments for create_engine
+    """
+    pool_size = toolkit.asint(config[f"db.{kind}.pool_size"])
+    options = {"pool_pre_ping": toolkit.asbool(config[f"db.{kind}.pool_pre_ping"])}
+    if pool_size <= 0:
+        options["poolclass"] = NullPool
+    else:
+        options["pool_size"] = pool_size
+        options["max_overflow"] = toolkit.asint(config[f"db.{kind}.max_overflow"])
+        options["pool_recycle"] = toolkit.asint(config[f"db.{kind}.pool_recycle"])
+    return options
 
 
-def get_engine(write: bool = False) -> Engine:
+def _replica_connect_args(url: str, timeout_arg: str) -> dict:
+    """Get the driver arguments of the connections to a read url
+
+    Connections to the databases of dataspatial.db.read_urls give up after
+    dataspatial.db.replica_connect_timeout seconds, so that an unreachable
+    replica doesn't hang health checks and reads.
+
+    :param url: The read url
+    :param timeout_arg: The name of the connect timeout argument of the driver
     """
+    timeout = toolkit.asint(config["db.replica_connect_timeout"])
+    if timeout <= 0 or url == toolkit.config["ckan.datastore.read_url"]:
+        return {}
+    return {timeout_arg: timeout}
+
 
-    :param write:  (Default value = False)
+def get_engine(write: bool = False, url: Optional[str] = None) -> Engine:
+    """Get the engine for the datastore database, creating it on first use
 
+    :param write: If True, get the engine using the datastore write url, else
+        a read url (Default value = False)
+    :param url: The read url, one of the configured read replicas. If None,
+        ckan.datastore.read_url is used. (Default value = None)
     """
     if write:
         global _write_engine
         if _write_engine is None:
-            # Write engine doesn't really need to keep connections open, as it happens
-            #  quite rarely.
             _write_engine = create_engine(
-                toolkit.config["ckan.datastore.write_url"], poolclass=NullPool
+                toolkit.config["ckan.datastore.write_url"], **_engine_options("write")
             )
         return _write_engine
     else:
-        global _read_engine
-        if _read_engine is None:
-            _read_engine = create_engine(toolkit.config["ckan.datastore.read_url"])
-        return _read_engine
+        url = url or toolkit.config["ckan.datastore.read_url"]
+        with _engines_lock:
+            if url not in _read_engines:
+                _read_engines[url] = create_engine(
+                    url,
+                    connect_args=_replica_connect_args(url, "connect_timeout"),
+                    **_engine_options("read"),
+                )
+            return _read_engines[url]
+
+
+class ReadTarget:
+    """A database reads can be routed to, with its health and usage
+
+    :param url: The database url
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.in_use = 0
+        self.healthy = True
+        self.checked_at = 0.0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def acquire(self) -> Generator[None, None, None]:
+        """Count a connection to this target as in use while in the context"""
+        with self._lock:
+            self.in_use += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_use -= 1
+
+    def is_healthy(self) -> bool:
+        """Test that the database is reachable and isn't lagging behind the
+        primary by more than dataspatial.db.replica_max_lag seconds.
+
+        The result is kept for dataspatial.db.health_check_interval seconds.
+        Only one thread runs the check, the others get the previous result
+        meanwhile.
+        """
+        interval = toolkit.asint(config["db.health_check_interval"])
+        now = time.monotonic()
+        with self._lock:
+            if now - self.checked_at < interval:
+                return self.healthy
+            self.checked_at = now
+
+        max_lag = toolkit.asint(config["db.replica_max_lag"])
+        # a replica that has replayed everything it received isn't lagging,
+        #  however old its last replayed transaction is
+        query = text(
+            """
+            SELECT CASE
+                     WHEN NOT pg_is_in_recovery()
+                       OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+                     THEN 0
+                     ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+                   END
+            """
+        )
+        try:
+            with get_engine(url=self.url).connect() as c:
+                lag = c.execute(query).scalar()
+        except DBAPIError as e:
+            logger.warning(f"Read database {make_url(self.url)!r} is unreachable: {e}")
+            with self._lock:
+                self.healthy = False
+            return False
+
+        healthy = max_lag <= 0 or lag is None or lag <= max_lag
+        if not healthy:
+            logger.warning(f"Read database {make_url(self.url)!r} is {lag}s behind.")
+        with self._lock:
+            self.healthy = healthy
+        return healthy
+
+
+def _get_read_target(url: str) -> ReadTarget:
+    with _engines_lock:
+        if url not in _read_targets:
+            _read_targets[url] = ReadTarget(url)
+        return _read_targets[url]
+
+
+def get_read_urls() -> list[str]:
+    """Get the urls reads are routed between
+
+    These are the urls of dataspatial.db.read_urls, or ckan.datastore.read_url
+    if none are configured.
+    """
+    return toolkit.aslist(config["db.read_urls"]) or [
+        toolkit.config["ckan.datastore.read_url"]
+    ]
+
+
+def _primary_pin_key(resource_id: str) -> str:
+    return f"ckanext:dataspatial:primary:{resource_id}"
+
+
+def pin_to_primary(resource_id: str) -> None:
+    """Route the reads of a resource to the primary for a while
+
+    This is called after writing geometries, so that replicas have time to
+    catch up before they are read from. The window is set by
+    dataspatial.db.primary_pin_seconds, and shared by all processes via redis.
+
+    :param resource_id: The resource that was written to
+    """
+    seconds = toolkit.asint(config["db.primary_pin_seconds"])
+    if seconds > 0 and toolkit.aslist(config["db.read_urls"]):
+        connect_to_redis().set(_primary_pin_key(resource_id), 1, ex=seconds)
+
+
+def is_pinned_to_primary(resource_id: str) -> bool:
+    """Test if the reads of a resource must go to the primary
+
+    :param resource_id: The resource to test
+    """
+    # pins are only set when there are replicas to avoid
+    if toolkit.asint(config["db.primary_pin_seconds"]) <= 0 or not toolkit.aslist(
+        config["db.read_urls"]
+    ):
+        return False
+    return bool(connect_to_redis().exists(_primary_pin_key(resource_id)))
+
+
+def choose_read_target(
+    resource_id: Optional[str] = None, primary: bool = False
+) -> ReadTarget:
+    """Choose the database a read is routed to
+
+    Reads are spread over the healthy databases of dataspatial.db.read_urls as
+    per dataspatial.db.read_routing. They go to ckan.datastore.read_url
+    instead if asked, if the resource is pinned to the primary, or if no
+    configured database is healthy.
+
+    :param resource_id: The resource being read, if any (Default value = None)
+    :param primary: If True, read from the primary (Default value = False)
+    """
+    primary_url = toolkit.config["ckan.datastore.read_url"]
+    urls = get_read_urls()
+    if primary or urls == [primary_url]:
+        return _get_read_target(primary_url)
+    if resource_id and is_pinned_to_primary(resource_id):
+        return _get_read_target(primary_url)
+
+    targets = [_get_read_target(url) for url in urls]
+    healthy = [target for target in targets if target.is_healthy()]
+    if not healthy:
+        return _get_read_target(primary_url)
+    if config["db.read_routing"] == "least_connections":
+        return min(healthy, key=lambda target: target.in_use)
+    return healthy[next(_round_robin) % len(healthy)]
+
+
+@contextmanager
+def _explicit_transactions(dbapi_connection) -> Generator[None, None, None]:
+    """Context manager turning off the autocommit of a DBAPI connection, so
+    the commits of the caller delimit its transactions, e.g. to commit updates
+    in batches rather than one by one.
+    """
+    if not getattr(dbapi_connection, "autocommit", False):
+        yield
+        return
+    dbapi_connection.autocommit = False
+    try:
+        yield
+        dbapi_connection.commit()
+    except BaseException:
+        dbapi_connection.rollback()
+        raise
+    finally:
+        dbapi_connection.autocommit = True
 
 
 @contextmanager
@@ -41,27 +287,173 @@ def get_connection(
     connection: Optional[Connection] = None,
     write: bool = False,
     raw: bool = False,
+    resource_id: Optional[str] = None,
+    primary: bool = False,
 ) -> Generator[Connection, None, None]:
     """Context manager to get a database connection
 
     This will either return the provided connection (and then leave it open)
-    or create a new connection for this operation only.
+    or create a new connection for this operation only. New read-only
+    connections are routed as per choose_read_target.
 
     :param connection: Database connection or None (Default value = None)
     :param write: If connection is None, specify whether to get a read-only
         or a read-write connection (Default value = False)
-    :param raw: If connection is None, specify whether to get a raw
-        connection (Default value = False)
+    :param raw: Specify whether to get the raw DBAPI connection, e.g. to
+        commit batches explicitly (Default value = False)
+    :param resource_id: The resource being read, used to route read-only
+        connections (Default value = None)
+    :param primary: If True, read-only connections go to the primary, e.g.
+        to read up to date statistics (Default value = False)
     """
     if connection:
-        yield connection
-    else:
-        engine = get_engine(write=write)
-        with engine.begin() as new_connection:
-            if raw:
-                yield new_connection.connection
-            else:
-                yield new_connection
+        if raw and isinstance(connection, Connection):
+            with _explicit_transactions(connection.connection.dbapi_connection):
+                yield connection.connection
+        else:
+            yield connection
+        return
+
+    with ExitStack() as stack:
+        started = time.perf_counter()
+        if write:
+            kind = "write"
+            new_connection = stack.enter_context(get_engine(write=True).begin())
+        else:
+            kind = "read"
+            target = choose_read_target(resource_id, primary)
+            stack.enter_context(target.acquire())
+            new_connection = stack.enter_context(get_engine(url=target.url).begin())
+        metrics.observe(
+            "dataspatial_connection_acquire_seconds",
+            time.perf_counter() - started,
+            kind=kind,
+        )
+        if raw:
+            yield new_connection.connection
+        else:
+            yield new_connection
+
+
+def async_reads_enabled() -> bool:
+    """Return True if spatial reads should use the asyncio read engine"""
+    return toolkit.asbool(config["db.async_read"])
+
+
+def _get_event_loop() -> asyncio.AbstractEventLoop:
+    """Return the event loop running async reads, starting it on first use
+
+    The loop runs in a daemon thread shared by every request thread of the
+    process, so queries from concurrent requests share the async pool.
+    """
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None:
+            _event_loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_event_loop.run_forever, name="dataspatial-db", daemon=True
+            ).start()
+    return _event_loop
+
+
+def get_async_engine(url: Optional[str] = None) -> AsyncEngine:
+    """Get the asyncio engine for a read url, creating it on first use
+
+    This needs asyncpg, and uses the same pool options as the read engines.
+
+    :param url: The read url. If None, ckan.datastore.read_url is used.
+        (Default value = None)
+    """
+    if asyncpg is None:
+        raise RuntimeError(
+            "asyncpg must be installed to use dataspatial.db.async_read."
+        )
+    url = url or toolkit.config["ckan.datastore.read_url"]
+    with _engines_lock:
+        if url not in _async_read_engines:
+            async_url = make_url(url).set(drivername="postgresql+asyncpg")
+            _async_read_engines[url] = create_async_engine(
+                async_url,
+                connect_args=_replica_connect_args(url, "timeout"),
+                **_engine_options("read"),
+            )
+        return _async_read_engines[url]
+
+
+# the setting is local to the transaction the read runs in
+_SET_STATEMENT_TIMEOUT = text("SELECT set_config('statement_timeout', :timeout, true)")
+
+
+async def _execute_read_async(
+    query: TextClause, values: dict, timeout: int, url: str
+) -> list[RowMapping]:
+    async with get_async_engine(url).begin() as c:
+        if timeout > 0:
+            await c.execute(_SET_STATEMENT_TIMEOUT, {"timeout": f"{timeout}ms"})
+        result = await c.execute(query, values)
+        return result.mappings().all()
+
+
+def _timeout_error(timeout: int) -> toolkit.ValidationError:
+    return toolkit.ValidationError(
+        {"query": [f"Query cancelled after exceeding the {timeout}ms timeout."]}
+    )
+
+
+def execute_read(
+    query: TextClause,
+    values: Optional[dict] = None,
+    connection: Optional[Connection] = None,
+    timeout: Optional[int] = None,
+    resource_id: Optional[str] = None,
+) -> list[RowMapping]:
+    """Run a read query with a statement timeout, and return all its rows
+
+    If dataspatial.db.async_read is set (and no connection is given), the
+    query runs on the asyncio engine, in the event loop shared by the request
+    threads of the process, whose pool holds a connection only while a query
+    runs. The calling thread still blocks until the query completes or times
+    out. A query still running when the timeout is reached is cancelled, both
+    by postgres and by cancelling its task.
+
+    :param query: The query
+    :param values: Values of the query's named parameters (Default value = None)
+    :param connection: Database connection. If None, one will be
+        created for this operation, and the timeout applied to it.
+        (Default value = None)
+    :param timeout: Statement timeout in milliseconds, 0 for none. If None,
+        dataspatial.db.statement_timeout is used. (Default value = None)
+    :param resource_id: The resource being read, used to route the query
+        (Default value = None)
+    :returns: the rows, as mappings of column name to value
+    """
+    if timeout is None:
+        timeout = toolkit.asint(config["db.statement_timeout"])
+    values = values or {}
+
+    try:
+        if connection is None and async_reads_enabled():
+            target = choose_read_target(resource_id)
+            with target.acquire():
+                future = asyncio.run_coroutine_threadsafe(
+                    _execute_read_async(query, values, timeout, target.url),
+                    _get_event_loop(),
+                )
+                try:
+                    # leave postgres a moment to cancel the statement itself
+                    return future.result(timeout / 1000 + 1 if timeout > 0 else None)
+                except concurrent.futures.TimeoutError:
+                    future.cancel()
+                    raise _timeout_error(timeout)
+
+        with get_connection(connection, resource_id=resource_id) as c:
+            if connection is None and timeout > 0:
+                c.execute(_SET_STATEMENT_TIMEOUT, {"timeout": f"{timeout}ms"})
+            return c.execute(query, values).mappings().all()
+    except DBAPIError as e:
+        if getattr(e.orig, "pgcode", None) == QUERY_CANCELED:
+            raise _timeout_error(timeout)
+        raise
 
 
 def _index_name(table: str, field: str, index_type: str) -> str:
@@ -80,6 +472,7 @@ def create_index(
     table: str,
     field: str,
     index_type: str = "GIST",
+    operator_class: str = "",
 ):
     """Create an index on a field
 
@@ -87,17 +480,130 @@ def create_index(
     :param table: Table name
     :param field: Field name
     :param index_type: Index type (Default value = 'GIST')
+    :param operator_class: Operator class of the index, e.g. text_pattern_ops
+        for prefix searches on a btree index (Default value = '')
     """
     index_name: str = _index_name(table, field, index_type)
     s: TextClause = text(
         f"""
       CREATE INDEX IF NOT EXISTS "{index_name}"
           ON "{table}"
-       USING {index_type}("{field}")
+       USING {index_type}("{field}" {operator_class})
        WHERE "{field}" IS NOT NULL;
        """
     )
     connection.execute(s)
+    invalidate_table_info(table)
+
+
+def _get_table_info_cache() -> TTLCache:
+    """Return the process wide table introspection cache, creating it on first use."""
+    global _table_info_cache
+    if _table_info_cache is None:
+        _table_info_cache = TTLCache(
+            max_size=toolkit.asint(config["introspection.cache_size"]),
+            ttl=toolkit.asint(config["introspection.cache_ttl"]),
+        )
+    return _table_info_cache
+
+
+def invalidate_table_info(table: str) -> None:
+    """Remove a table from the introspection cache of this process
+
+    This must be called after altering a table, e.g. adding columns or indexes.
+
+    :param table: Table name
+    """
+    _get_table_info_cache().invalidate(lambda key: key == table)
+
+
+def get_table_info(connection: Connection, table: str) -> Optional[TableInfo]:
+    """Get the columns and indexes of a table
+
+    Everything is read from the system catalogs with a single query. Results
+    are cached per process, keyed on the oid, relfilenode and number of
+    columns and indexes of the table, which are looked up first: a table
+    recreated, rewritten, or given columns or indexes by another process is
+    read again, rather than being seen once the entry expires.
+
+    :param connection: Database connection
+    :param table: Table name
+    :returns: a dictionary defining:
+        {
+            columns: {name: {type: type as per format_type, srid: SRID of
+                geometry columns or None}},
+            indexes: {name: {method: access method, e.g. gist or btree,
+                columns: the indexed column names, partial: True if the
+                index has a predicate}},
+        }
+        or None if the table doesn't exist
+    """
+    version_query: TextClause = text(
+        """
+        SELECT c.oid, c.relfilenode, c.relnatts,
+               (SELECT count(*) FROM pg_index i WHERE i.indrelid = c.oid)
+        FROM   pg_class c
+        WHERE  c.oid = to_regclass(quote_ident(:table))
+        """
+    )
+    version = connection.execute(version_query, {"table": table}).fetchone()
+    if version is None:
+        # not cached, the table may be created at any time
+        return None
+    version = tuple(version)
+
+    cache = _get_table_info_cache()
+    info = cache.get(table, version)
+    if info is not None:
+        return info
+
+    query: TextClause = text(
+        """
+        SELECT (
+                 SELECT json_object_agg(
+                          a.attname,
+                          json_build_object(
+                            'type', format_type(a.atttypid, a.atttypmod),
+                            'srid', CASE WHEN t.typname IN ('geometry', 'geography')
+                                         THEN postgis_typmod_srid(a.atttypmod)
+                                    END
+                          )
+                        )
+                 FROM   pg_attribute a
+                 JOIN   pg_type t ON t.oid = a.atttypid
+                 WHERE  a.attrelid = c.oid
+                   AND  a.attnum > 0
+                   AND  NOT a.attisdropped
+               ) AS columns,
+               (
+                 SELECT json_object_agg(
+                          ic.relname,
+                          json_build_object(
+                            'method', am.amname,
+                            'columns', (
+                              SELECT array_agg(a.attname ORDER BY k.n)
+                              FROM   unnest(i.indkey::int2[]) WITH ORDINALITY AS k(attnum, n)
+                              JOIN   pg_attribute a
+                                ON   a.attrelid = i.indrelid AND a.attnum = k.attnum
+                            ),
+                            'partial', i.indpred IS NOT NULL
+                          )
+                        )
+                 FROM   pg_index i
+                 JOIN   pg_class ic ON ic.oid = i.indexrelid
+                 JOIN   pg_am am ON am.oid = ic.relam
+                 WHERE  i.indrelid = c.oid
+               ) AS indexes
+        FROM   pg_class c
+        WHERE  c.oid = to_regclass(quote_ident(:table))
+        """
+    )
+    result = connection.execute(query, {"table": table}).fetchone()
+    if result is None:
+        return None
+    info = {"columns": result["columns"] or {}, "indexes": result["indexes"] or {}}
+    cache.set(table, info, version)
+    return info
 
 
 def index_exists(
@@ -108,7 +614,8 @@ def index_exists(
 ) -> bool:
     """Test if an index exists
 
-    Note this will look for index named as per _index_name
+    This looks for any index of the given type on the field alone, whatever its
+    name.
 
     :param connection: Database connection
     :param table: Table name
@@ -116,16 +623,30 @@ def index_exists(
     :param index_type: Index type (Default value = u'GIST')
     :returns: True if the index exists, False otherwise.
     """
-    indexes_table = sql.table("pg_indexes")
-
-    query: Select = (
-        sql.select([sql.func.count()])
-        .select_from(indexes_table)
-        .where("indexname" == _index_name(table, field, index_type))
+    info = get_table_info(connection, table)
+    if info is None:
+        return False
+    return any(
+        index["method"] == index_type.lower() and index["columns"] == [field]
+        for index in info["indexes"].values()
     )
 
-    result = connection.execute(query).fetchone()
-    return result[0] > 0
+
+def is_indexed(connection: Connection, table: str, field: str) -> bool:
+    """Test if a field is the leading column of any index
+
+    :param connection: Database connection
+    :param table: Table name
+    :param field: Field name
+    :returns: True if an index can be used to look the field up
+    """
+    info = get_table_info(connection, table)
+    if info is None:
+        return False
+    return any(
+        (index["columns"] or [None])[0] == field
+        for index in info["indexes"].values()
+    )
 
 
 def fields_exist(
@@ -140,12 +661,24 @@ def fields_exist(
     :param fields: List of fields to look for
     :returns: True if all the fields exist, false if not
     """
-    query: Select = sql.select("*", from_obj=sql.table(table)).limit(0)
-    all_fields = connection.execute(query).keys()
-    for field in fields:
-        if field not in all_fields:
-            return False
-    return True
+    info = get_table_info(connection, table)
+    if info is None:
+        return False
+    return all(field in info["columns"] for field in fields)
+
+
+def get_column_type(connection: Connection, table: str, field: str) -> Optional[str]:
+    """Get the SQL type of a column
+
+    :param connection: Database connection
+    :param table: Table name
+    :param field: Field name
+    :returns: the type, as per format_type, or None if the column doesn't exist
+    """
+    info = get_table_info(connection, table)
+    if info is None or field not in info["columns"]:
+        return None
+    return info["columns"][field]["type"]
 
 
 def create_geom_column(
@@ -167,6 +700,160 @@ def create_geom_column(
         f"""ALTER TABLE "{table}" ADD COLUMN IF NOT EXISTS "{field}" geometry({geom_type}, {srid});"""
     )
     connection.execute(query)
+    invalidate_table_info(table)
+
+
+def _named_clause(clause_and_values: tuple, values: dict) -> str:
+    """Convert a where clause returned by an IDatastore plugin to use named
+    bind parameters, adding its values to the values dict.
+
+    Plugins for CKAN >= 2.10 return (clause, {name: value}) with named
+    parameters; older ones return (clause, value, ...) with %s placeholders.
+
+    :param clause_and_values: The clause and its values
+    :param values: Dictionary of named values to add to
+    :returns: the clause, using named parameters
+    """
+    clause = clause_and_values[0]
+    positional = []
+    for value in clause_and_values[1:]:
+        if isinstance(value, dict):
+            values.update(value)
+        else:
+            positional.append(value)
+    if not positional:
+        return clause
+
+    def _replace(match) -> str:
+        if match.group(0) == "%%":
+            return "%"
+        name = f"dataspatial_param_{len(values)}"
+        values[name] = positional.pop(0)
+        return f":{name}"
+
+    return re.sub(r"%%|%s", _replace, clause)
+
+
+def create_column(
+    connection: Connection,
+    table: str,
+    field: str,
+    field_type: str,
+) -> None:
+    """Create a column on the given table if it doesn't exist
+
+    :param connection: The database connection
+    :param table: The table to create column on
+    :param field: The name of the column to be created
+    :param field_type: The type of the column
+    """
+    query: TextClause = sql.text(
+        f"""ALTER TABLE "{table}" ADD COLUMN IF NOT EXISTS "{field}" {field_type};"""
+    )
+    connection.execute(query)
+    invalidate_table_info(table)
+
+
+def alter_geom_column(
+    connection: Connection,
+    table: str,
+    field: str,
+    geom_type: str,
+    srid: Union[str, int],
+) -> None:
+    """Change the geometry type of a geospatial column, emptying it
+
+    :param connection: The database connection
+    :param table: The table the column is on
+    :param field: The name of the geom column
+    :param geom_type: The new type of geometry of the column
+    :param srid: The projection of the geom column
+    """
+    query: TextClause = sql.text(
+        f"""ALTER TABLE "{table}" ALTER COLUMN "{field}" TYPE geometry({geom_type}, {srid}) USING NULL;"""
+    )
+    connection.execute(query)
+    invalidate_table_info(table)
+
+
+def reset_columns(connection: Connection, table: str, fields: list[str]) -> None:
+    """Set the given columns to NULL on every row
+
+    :param connection: The database connection
+    :param table: The table the columns are on
+    :param fields: The names of the columns to reset
+    """
+    assignments = ", ".join(f'"{field}" = NULL' for field in fields)
+    not_null = " OR ".join(f'"{field}" IS NOT NULL' for field in fields)
+    connection.execute(text(f'UPDATE "{table}" SET {assignments} WHERE {not_null}'))
+
+
+# resets the columns listed in its second argument whenever one of the columns
+#  listed in its first argument changes. Both arguments are JSON arrays.
+RESET_FUNCTION = "dataspatial_reset_columns"
+RESET_FUNCTION_SQL = f"""
+    CREATE OR REPLACE FUNCTION {RESET_FUNCTION}() RETURNS trigger
+    AS
+    $body$
+    DECLARE
+        old_row jsonb := to_jsonb(OLD);
+        new_row jsonb := to_jsonb(NEW);
+        source_field text;
+    BEGIN
+        FOR source_field IN SELECT jsonb_array_elements_text(TG_ARGV[0]::jsonb) LOOP
+            IF old_row -> source_field IS DISTINCT FROM new_row -> source_field THEN
+                RETURN jsonb_populate_record(
+                    NEW,
+                    (SELECT jsonb_object_agg(reset_field, NULL)
+                     FROM jsonb_array_elements_text(TG_ARGV[1]::jsonb) AS reset_field)
+                );
+            END IF;
+        END LOOP;
+        RETURN NEW;
+    END;
+    $body$ LANGUAGE plpgsql;
+"""
+
+
+def create_reset_trigger(
+    connection: Connection,
+    table: str,
+    source_fields: list[str],
+    reset_fields: list[str],
+) -> None:
+    """Create or replace the trigger that resets derived columns of the rows
+    whose source columns are updated
+
+    The trigger only fires for updates that set one of the source columns, so
+    updates of the derived columns themselves don't reset anything.
+
+    :param connection: The database connection
+    :param table: The table to create the trigger on
+    :param source_fields: The columns the derived columns are computed from
+    :param reset_fields: The derived columns, set to NULL when a source changes
+    """
+    exists = connection.execute(
+        text("SELECT to_regproc(:name) IS NOT NULL"), {"name": RESET_FUNCTION}
+    ).scalar()
+    if not exists:
+        connection.execute(text(RESET_FUNCTION_SQL))
+
+    def _literal(fields):
+        return "'" + json.dumps(fields).replace("'", "''") + "'"
+
+    trigger_name = f"{table}_dataspatial_reset"
+    columns = ", ".join(f'"{field}"' for field in source_fields)
+    connection.execute(
+        text(
+            f"""
+            DROP TRIGGER IF EXISTS "{trigger_name}" ON "{table}";
+            CREATE TRIGGER "{trigger_name}"
+                BEFORE UPDATE OF {columns} ON "{table}"
+                FOR EACH ROW
+                EXECUTE PROCEDURE {RESET_FUNCTION}({_literal(source_fields)}, {_literal(reset_fields)});
+            """
+        )
+    )
 
 
 def invoke_search_plugins(data_dict: dict, field_types: dict[str, str]):
@@ -179,18 +866,17 @@ def invoke_search_plugins(data_dict: dict, field_types: dict[str, str]):
     :param field_types: The field types, as a dict of field name to type name
     :returns: A tuple defining (
             SQL 'from' statement for full text queries,
-            where clause,
-            list of replacement values
+            where clause, using named bind parameters,
+            dict of replacement values
         )
     """
     query_dict = {"select": [], "sort": [], "where": []}
     for plugin in PluginImplementations(IDatastore):
         query_dict = plugin.datastore_search({}, data_dict, field_types, query_dict)
     clauses = []
-    values = []
+    values = {}
     for clause_and_values in query_dict["where"]:
-        clauses.append("(" + clause_and_values[0] + ")")
-        values += clause_and_values[1:]
+        clauses.append("(" + _named_clause(clause_and_values, values) + ")")
 
     where_clause = " AND ".join(clauses)
     if where_clause:
@@ -204,6 +890,118 @@ def invoke_search_plugins(data_dict: dict, field_types: dict[str, str]):
     return ts_query, where_clause, values
 
 
+def _table_writes_key(table: str) -> str:
+    return f"ckanext:dataspatial:writes:{table}"
+
+
+def _last_write_key(table: str) -> str:
+    return f"ckanext:dataspatial:last_write:{table}"
+
+
+def record_table_write(table: str, external: bool = True) -> None:
+    """Record that rows of a table were written to
+
+    This bumps a counter shared by all processes, which is part of the table
+    version, so it changes as soon as the write is made.
+
+    :param table: Table name
+    :param external: False for writes of the geometries themselves, which
+        don't make them out of date. The time of other writes is recorded.
+        (Default value = True)
+    """
+    redis = connect_to_redis()
+    key = _table_writes_key(table)
+    pipeline = redis.pipeline()
+    pipeline.incr(key)
+    pipeline.expire(key, TABLE_WRITES_TTL)
+    if external:
+        pipeline.set(_last_write_key(table), time.time(), ex=TABLE_WRITES_TTL)
+    pipeline.execute()
+
+
+def get_last_write(table: str) -> Optional[datetime.datetime]:
+    """Get the time of the last write to a table recorded as external by
+    record_table_write, in UTC
+
+    :param table: Table name
+    :returns: the time, or None if no write was recorded recently
+    """
+    last_write = connect_to_redis().get(_last_write_key(table))
+    if last_write is None:
+        return None
+    return datetime.datetime.utcfromtimestamp(float(last_write))
+
+
+def get_table_version(connection: Connection, table: str) -> Optional[tuple]:
+    """Get a value that changes whenever rows of the table are modified
+
+    This combines the count of writes recorded by record_table_write, which
+    is up to date for writes made through the datastore actions and by this
+    extension, with the cumulative row counters kept by the statistics
+    collector, which catch any other write but can lag behind by a moment.
+
+    :param connection: Database connection
+    :param table: Table name
+    :returns: a tuple of counters, or None if the table doesn't exist
+    """
+    query: TextClause = text(
+        """
+        SELECT n_tup_ins, n_tup_upd, n_tup_del
+        FROM pg_stat_user_tables
+        WHERE relid = to_regclass(quote_ident(:table))
+        """
+    )
+    result = connection.execute(query, {"table": table}).fetchone()
+    if result is None:
+        return None
+    writes = connect_to_redis().get(_table_writes_key(table))
+    return tuple(result) + (int(writes or 0),)
+
+
+def get_estimated_row_count(connection: Connection, table: str) -> int:
+    """Get the number of rows of a table as estimated by the planner statistics
+
+    :param connection: Database connection
+    :param table: Table name
+    :returns: the estimate, or 0 if the table doesn't exist or hasn't been
+        analyzed yet
+    """
+    query: TextClause = text(
+        """
+        SELECT reltuples::bigint
+        FROM   pg_class
+        WHERE  oid = to_regclass(quote_ident(:table))
+        """
+    )
+    result = connection.execute(query, {"table": table}).fetchone()
+    if result is None or result[0] < 0:
+        return 0
+    return result[0]
+
+
+def get_table_sizes(connection: Connection, tables: list[str]) -> dict[str, int]:
+    """Get the size on disk of tables, including their indexes and toast
+
+    :param connection: Database connection
+    :param tables: Table names
+    :returns: a dictionary of table name to size in bytes, for the tables that
+        exist
+    """
+    if not tables:
+        return {}
+    query: TextClause = text(
+        """
+        SELECT relname, pg_total_relation_size(oid) AS size
+        FROM   pg_class
+        WHERE  relname = ANY(:tables)
+          AND  relkind = 'r'
+          AND  relnamespace = 'public'::regnamespace
+        """
+    )
+    rows = connection.execute(query, {"tables": list(tables)}).fetchall()
+    return {row["relname"]: row["size"] for row in rows}
+
+
 def get_field_values(
     connection: Connection,
     resource_id: str,
@@ -0,0 +1,253 @@
+# encoding: utf-8
+import logging
+import os
+import subprocess
+import time
+import zlib
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+from ckan.plugins import toolkit
+from ckan.types import DataDict
+from ckanext.datastore import backend as datastore_db
+from ckanext.datastore.helpers import is_single_statement
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+
+from ckanext.dataspatial.config import config
+from ckanext.dataspatial.lib import metrics
+from ckanext.dataspatial.lib.constants import BATCH_SIZE
+from ckanext.dataspatial.lib.db import Connection, get_connection, invoke_search_plugins
+from ckanext.dataspatial.lib.util import DEFAULT_CONTEXT
+
+logger = logging.getLogger(__name__)
+
+# size of the chunks written to the response
+CHUNK_SIZE = 64 * 1024
+
+# file formats of cached exports, keyed by the name used in config and urls
+EXPORT_FORMATS = {
+    "flatgeobuf": {
+        "driver": "FlatGeobuf",
+        "extension": "fgb",
+        "mimetype": "application/flatgeobuf",
+        "options": ["-lco", "SPATIAL_INDEX=YES"],
+    },
+    "geoparquet": {
+        "driver": "Parquet",
+        "extension": "parquet",
+        "mimetype": "application/vnd.apache.parquet",
+        "options": ["-lco", "COMPRESSION=ZSTD"],
+    },
+}
+
+
+def prepare_geojson_query(data_dict: DataDict, precision: int) -> tuple[str, dict]:
+    """Build the query for a GeoJSON export of a datastore search
+
+    Each row of the query is a complete GeoJSON Feature, built in the database
+    with ST_AsGeoJSON, with every datastore field as a property.
+
+    :param data_dict: Dictionary defining the search, as per datastore_search
+    :param precision: Maximum number of decimal places of coordinates
+    :returns: the query and its values
+    """
+    r = toolkit.get_action("datastore_search")({}, dict(data_dict, limit=0))
+
+    field_types = dict([(f["id"], f["type"]) for f in r["fields"]])
+    field_types["_id"] = "int"
+
+    (ts_query, where_clause, values) = invoke_search_plugins(data_dict, field_types)
+    columns = ", ".join(f'"{f["id"]}"' for f in r["fields"])
+
+    query = """
+        SELECT ST_AsGeoJSON(_export_sub.*, :dataspatial_geom_field,
+                            :dataspatial_precision) AS feature
+        FROM   (
+          SELECT {columns}, "{geom_field}"
+          FROM   "{resource_id}" {ts_query}
+          {where_clause}
+          ORDER BY _id
+        ) _export_sub
+    """.format(
+        columns=columns,
+        geom_field=config["postgis.field"],
+        resource_id=data_dict["resource_id"],
+        where_clause=where_clause,
+        ts_query=ts_query,
+    )
+
+    if not is_single_statement(query):
+        raise datastore_db.DatastoreException(
+            {"query": ["Query is not a single statement."]}
+        )
+
+    values.update(
+        {
+            "dataspatial_geom_field": config["postgis.field"],
+            "dataspatial_precision": precision,
+        }
+    )
+    return query, values
+
+
+def iter_geojson(
+    query: str,
+    values: dict,
+    connection: Optional[Connection] = None,
+) -> Iterator[str]:
+    """Stream a FeatureCollection from a query built by prepare_geojson_query
+
+    Rows are read through a server side cursor in batches, so memory use
+    doesn't depend on the number of rows.
+
+    :param query: The query
+    :param values: The query values
+    :param connection: Database connection. If None, one will be
+        created for this operation. (Default value = None)
+    """
+    yield '{"type": "FeatureCollection", "features": ['
+    separator = ""
+    # features are encoded by the database, so the time spent waiting for
+    #  them, but not that spent sending them, is the encoding time
+    encode_seconds = 0.0
+    with get_connection(connection) as c:
+        started = time.perf_counter()
+        result = c.execution_options(stream_results=True).execute(
+            text(query), values
+        )
+        while True:
+            rows = result.fetchmany(BATCH_SIZE)
+            encode_seconds += time.perf_counter() - started
+            if not rows:
+                break
+            for row in rows:
+                yield separator + row["feature"]
+                separator = ","
+            started = time.perf_counter()
+    metrics.observe("dataspatial_geojson_seconds", encode_seconds, step="encode")
+    yield "]}"
+
+
+def chunked(parts: Iterable[str], size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Join small strings into encoded chunks of about size bytes"""
+    buffer = []
+    length = 0
+    for part in parts:
+        data = part.encode("utf-8")
+        buffer.append(data)
+        length += len(data)
+        if length >= size:
+            yield b"".join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+def gzipped(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Gzip a stream of chunks"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def get_export_formats() -> list[str]:
+    """Get the configured formats of cached exports"""
+    formats = toolkit.aslist(config["export.formats"])
+    return [f for f in formats if f in EXPORT_FORMATS]
+
+
+def get_export_file_path(resource_id: str, export_format: str) -> Path:
+    """Get the path of the cached export of a resource, as per
+    get_resource_file_path, under a dataspatial directory.
+
+    :param resource_id: The resource ID
+    :param export_format: One of EXPORT_FORMATS
+    """
+    extension = EXPORT_FORMATS[export_format]["extension"]
+    return (
+        Path(toolkit.config.get("ckan.storage_path"))
+        / "dataspatial"
+        / resource_id[:3]
+        / resource_id[3:6]
+        / f"{resource_id[6:]}.{extension}"
+    )
+
+
+def remove_exports(resource_id: str) -> None:
+    """Delete all cached exports of a resource
+
+    :param resource_id: The resource ID
+    """
+    for export_format in EXPORT_FORMATS:
+        path = get_export_file_path(resource_id, export_format)
+        if path.exists():
+            logger.info(f"Removing cached export {path}.")
+            path.unlink()
+
+
+def write_export(resource_id: str, export_format: str) -> Path:
+    """Write the cached export of a whole resource table
+
+    The table is read directly from the datastore database by ogr2ogr (GDAL),
+    which streams the rows, so memory use doesn't depend on the size of the
+    table. The file is written to a temporary path and moved in place once
+    complete.
+
+    :param resource_id: The resource to export
+    :param export_format: One of EXPORT_FORMATS
+    :returns: the path of the export
+    """
+    spec = EXPORT_FORMATS[export_format]
+    r = toolkit.get_action("datastore_search")(
+        DEFAULT_CONTEXT, {"resource_id": resource_id, "limit": 0}
+    )
+    columns = ", ".join(f'"{f["id"]}"' for f in r["fields"])
+    query = f'SELECT {columns}, "{config["postgis.field"]}" FROM "{resource_id}"'
+
+    url = make_url(toolkit.config["ckan.datastore.read_url"])
+    source = "PG:" + " ".join(
+        f"{key}={value}"
+        for key, value in [
+            ("dbname", url.database),
+            ("host", url.host),
+            ("port", url.port),
+            ("user", url.username),
+        ]
+        if value
+    )
+    env = dict(os.environ)
+    if url.password:
+        env["PGPASSWORD"] = url.password
+
+    path = get_export_file_path(resource_id, export_format)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(f".{path.name}.tmp")
+    if temp_path.exists():
+        temp_path.unlink()
+
+    command = [
+        config["export.ogr2ogr"],
+        "-f",
+        spec["driver"],
+        str(temp_path),
+        source,
+        "-sql",
+        query,
+        "-nln",
+        resource_id,
+        *spec["options"],
+    ]
+    logger.info(f"Exporting {resource_id} to {export_format}.")
+    try:
+        subprocess.run(command, env=env, check=True, capture_output=True, text=True)
+    except subprocess.CalledProcessError as e:
+        if temp_path.exists():
+            temp_path.unlink()
+        raise RuntimeError(f"Export of {resource_id} failed: {e.stderr}")
+    os.replace(temp_path, path)
+    return path
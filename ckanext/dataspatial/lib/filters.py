@@ -0,0 +1,257 @@
+# encoding: utf-8
+# Spatial filters for datastore_search and datastore_delete.
+import json
+import math
+from typing import Any
+
+from ckan.plugins import toolkit
+
+from ckanext.dataspatial.config import config
+from ckanext.dataspatial.lib.cells import geohash_field, get_available_precisions
+from ckanext.dataspatial.lib.constants import (
+    BBOX_FILTER,
+    DISTANCE_FILTER,
+    GEOHASH_FILTER,
+    SPATIAL_FILTERS,
+    WKT_FILTER,
+)
+from ckanext.dataspatial.lib.db import fields_exist, get_connection
+from ckanext.dataspatial.lib.util import load_wkt
+
+# shortest length of a degree of latitude and length of a degree of longitude
+#  at the equator, in meters
+METERS_PER_DEGREE_LAT = 110574
+METERS_PER_DEGREE_LNG = 111320
+
+GEOHASH_ALPHABET = set("0123456789bcdefghjkmnpqrstuvwxyz")
+
+
+def _invalid(message: str):
+    return toolkit.ValidationError({"filters": [message]})
+
+
+def _get_filters(data_dict: dict) -> dict:
+    filters = data_dict.get("filters") or {}
+    if isinstance(filters, str):
+        try:
+            filters = json.loads(filters)
+        except ValueError:
+            return {}
+    return filters if isinstance(filters, dict) else {}
+
+
+def _to_floats(value: Any, names: list[str], filter_name: str) -> list[float]:
+    """Read a list of numbers from a list, a comma separated string or a dict
+    keyed by the given names.
+    """
+    if isinstance(value, str):
+        value = value.split(",")
+    elif isinstance(value, dict):
+        value = [value.get(name) for name in names]
+    if not isinstance(value, (list, tuple)) or len(value) != len(names):
+        raise _invalid(f"{filter_name} must be given as {', '.join(names)}.")
+    try:
+        return [float(v) for v in value]
+    except (TypeError, ValueError):
+        raise _invalid(f"{filter_name} values must be numbers.")
+
+
+def parse_bbox(value: Any) -> list[float]:
+    """Parse and validate a bounding box filter value
+
+    :param value: xmin, ymin, xmax, ymax in WGS84
+    :returns: [xmin, ymin, xmax, ymax]
+    """
+    xmin, ymin, xmax, ymax = _to_floats(
+        value, ["xmin", "ymin", "xmax", "ymax"], BBOX_FILTER
+    )
+    if xmin > xmax or ymin > ymax:
+        raise _invalid(f"{BBOX_FILTER} minimums must not exceed maximums.")
+    return [xmin, ymin, xmax, ymax]
+
+
+def parse_distance(value: Any) -> list[float]:
+    """Parse and validate a distance filter value
+
+    :param value: lat, lng and distance in meters
+    :returns: [lat, lng, distance]
+    """
+    lat, lng, distance = _to_floats(value, ["lat", "lng", "distance"], DISTANCE_FILTER)
+    if not -90 <= lat <= 90 or not -180 <= lng <= 180:
+        raise _invalid(f"{DISTANCE_FILTER} lat/lng is out of range.")
+    if distance < 0:
+        raise _invalid(f"{DISTANCE_FILTER} distance must not be negative.")
+    return [lat, lng, distance]
+
+
+def parse_wkt(value: Any) -> str:
+    """Parse and validate a WKT filter value
+
+    :param value: Well-Known Text geometry in WGS84
+    :returns: the WKT string
+    """
+    if not isinstance(value, str):
+        raise _invalid(f"{WKT_FILTER} must be a Well-Known Text string.")
+    try:
+        load_wkt(value)
+    except Exception:
+        raise _invalid(f"{WKT_FILTER} is not valid Well-Known Text.")
+    return value
+
+
+def parse_geohash(value: Any) -> str:
+    """Parse and validate a geohash filter value
+
+    :param value: A geohash of up to 12 characters
+    :returns: the lower case geohash
+    """
+    if not isinstance(value, str):
+        raise _invalid(f"{GEOHASH_FILTER} must be a geohash string.")
+    value = value.lower()
+    if not 0 < len(value) <= 12 or not set(value) <= GEOHASH_ALPHABET:
+        raise _invalid(f"{GEOHASH_FILTER} is not a valid geohash.")
+    return value
+
+
+def distance_envelope(lat: float, lng: float, distance: float) -> list[float]:
+    """Get a WGS84 bounding box that contains every point within distance
+    meters of lat/lng, for use as an index-assisted pre-filter.
+
+    :returns: [xmin, ymin, xmax, ymax]
+    """
+    dlat = distance / METERS_PER_DEGREE_LAT
+    cos_lat = math.cos(math.radians(min(90.0, abs(lat) + dlat)))
+    if cos_lat * METERS_PER_DEGREE_LNG * 180 <= distance:
+        dlng = 180.0
+    else:
+        dlng = distance / (METERS_PER_DEGREE_LNG * cos_lat)
+    return [lng - dlng, lat - dlat, lng + dlng, lat + dlat]
+
+
+def validate_spatial_filters(data_dict: dict) -> dict:
+    """Validate the spatial filters of a datastore request.
+
+    As per IDatastore.datastore_validate, the filters that were handled are
+    removed from the given data_dict.
+
+    :param data_dict: A copy of the datastore request
+    :returns: the data_dict
+    """
+    filters = data_dict.get("filters")
+    if not isinstance(filters, dict):
+        return data_dict
+    if not any(name in filters for name in SPATIAL_FILTERS):
+        return data_dict
+    if BBOX_FILTER in filters:
+        parse_bbox(filters.pop(BBOX_FILTER))
+    if DISTANCE_FILTER in filters:
+        parse_distance(filters.pop(DISTANCE_FILTER))
+    if WKT_FILTER in filters:
+        parse_wkt(filters.pop(WKT_FILTER))
+    if GEOHASH_FILTER in filters:
+        parse_geohash(filters.pop(GEOHASH_FILTER))
+
+    resource_id = data_dict.get("resource_id")
+    with get_connection(resource_id=resource_id) as c:
+        georeferenced = fields_exist(c, resource_id, [config["postgis.field"]])
+    if not georeferenced:
+        raise _invalid(
+            "Spatial filters can only be used on resources that have been "
+            "georeferenced."
+        )
+    return data_dict
+
+
+def spatial_where_clauses(data_dict: dict) -> list[tuple[str, dict]]:
+    """Build where clauses for the spatial filters of a datastore request.
+
+    Every clause tests the geometry with an operator that can use the GiST
+    index on the geom column.
+
+    :param data_dict: The datastore request
+    :returns: a list of (clause, values) tuples, using named parameters
+    """
+    filters = _get_filters(data_dict)
+    if not any(name in filters for name in SPATIAL_FILTERS):
+        return []
+
+    geom_field = config["postgis.field"]
+    clauses = []
+
+    if BBOX_FILTER in filters:
+        xmin, ymin, xmax, ymax = parse_bbox(filters[BBOX_FILTER])
+        clauses.append(
+            (
+                f'"{geom_field}" && ST_MakeEnvelope('
+                ":dataspatial_bbox_xmin, :dataspatial_bbox_ymin, "
+                ":dataspatial_bbox_xmax, :dataspatial_bbox_ymax, 4326)",
+                {
+                    "dataspatial_bbox_xmin": xmin,
+                    "dataspatial_bbox_ymin": ymin,
+                    "dataspatial_bbox_xmax": xmax,
+                    "dataspatial_bbox_ymax": ymax,
+                },
+            )
+        )
+
+    if DISTANCE_FILTER in filters:
+        lat, lng, distance = parse_distance(filters[DISTANCE_FILTER])
+        xmin, ymin, xmax, ymax = distance_envelope(lat, lng, distance)
+        # the envelope lets the index discard most rows before the exact,
+        #  spheroidal distance test is done on geography
+        clauses.append(
+            (
+                f'"{geom_field}" && ST_MakeEnvelope('
+                ":dataspatial_dwithin_xmin, :dataspatial_dwithin_ymin, "
+                ":dataspatial_dwithin_xmax, :dataspatial_dwithin_ymax, 4326) "
+                f'AND ST_DWithin("{geom_field}"::geography, '
+                "ST_SetSRID(ST_MakePoint(:dataspatial_dwithin_lng, "
+                ":dataspatial_dwithin_lat), 4326)::geography, "
+                ":dataspatial_dwithin_distance)",
+                {
+                    "dataspatial_dwithin_xmin": xmin,
+                    "dataspatial_dwithin_ymin": ymin,
+                    "dataspatial_dwithin_xmax": xmax,
+                    "dataspatial_dwithin_ymax": ymax,
+                    "dataspatial_dwithin_lat": lat,
+                    "dataspatial_dwithin_lng": lng,
+                    "dataspatial_dwithin_distance": distance,
+                },
+            )
+        )
+
+    if WKT_FILTER in filters:
+        clauses.append(
+            (
+                f'ST_Intersects("{geom_field}", '
+                "ST_GeomFromText(:dataspatial_wkt, 4326))",
+                {"dataspatial_wkt": parse_wkt(filters[WKT_FILTER])},
+            )
+        )
+
+    if GEOHASH_FILTER in filters:
+        geohash = parse_geohash(filters[GEOHASH_FILTER])
+        precisions = [
+            p
+            for p in get_available_precisions(data_dict["resource_id"])
+            if p >= len(geohash)
+        ]
+        if precisions:
+            # a prefix scan on the btree index of the coarsest column that
+            #  is precise enough
+            clauses.append(
+                (
+                    f'"{geohash_field(precisions[0])}" LIKE :dataspatial_geohash',
+                    {"dataspatial_geohash": geohash + "%"},
+                )
+            )
+        else:
+            clauses.append(
+                (
+                    f'ST_Intersects("{geom_field}", '
+                    "ST_GeomFromGeoHash(:dataspatial_geohash))",
+                    {"dataspatial_geohash": geohash},
+                )
+            )
+
+    return clauses
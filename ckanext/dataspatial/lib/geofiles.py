@@ -8,10 +8,20 @@ from ckan.logic import NotFound
 from ckan.plugins import toolkit
 from geomet import wkb
 
+from ckanext.dataspatial.lib import metrics
 from ckanext.dataspatial.lib.constants import WKB_FIELD_NAME
+from ckanext.dataspatial.lib.db import invalidate_table_info
 from ckanext.dataspatial.lib.postgis import prepare_and_populate_geoms
-from ckanext.dataspatial.lib.types import StatusCallback, GeoreferenceStatus
-from ckanext.dataspatial.lib.util import get_resource_file_path, DEFAULT_CONTEXT
+from ckanext.dataspatial.lib.types import (
+    GeoreferencePhase,
+    GeoreferenceStatus,
+    StatusCallback,
+)
+from ckanext.dataspatial.lib.util import (
+    DEFAULT_CONTEXT,
+    INTERNAL_CONTEXT_KEY,
+    get_resource_file_path,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -97,23 +107,24 @@ def load_geojson_to_datastore(
     if resource["format"].lower() != "geojson":
         toolkit.ValidationError("Only GeoJSON is supported at the moment.")
 
-    # load geojson data and convert to list of dicts
-    geojson_filepath = get_resource_file_path(resource_id)
-    with open(geojson_filepath) as f:
-        logger.info(f"Loading geojson from {geojson_filepath}.")
-        geojson: dict = json.load(f)
-
-    # find the full set of keys
-    source_fields = set()
-    for feature in geojson["features"]:
-        source_fields |= set(feature["properties"].keys())
-
-    # records for datastore_create
-    records: list[dict[str, Any]] = [
-        to_row(feature, source_fields)
-        for feature in geojson["features"]
-        if feature["geometry"]
-    ]
+    with metrics.timed("dataspatial_geojson_seconds", step="parse"):
+        # load geojson data and convert to list of dicts
+        geojson_filepath = get_resource_file_path(resource_id)
+        with open(geojson_filepath) as f:
+            logger.info(f"Loading geojson from {geojson_filepath}.")
+            geojson: dict = json.load(f)
+
+        # find the full set of keys
+        source_fields = set()
+        for feature in geojson["features"]:
+            source_fields |= set(feature["properties"].keys())
+
+        # records for datastore_create
+        records: list[dict[str, Any]] = [
+            to_row(feature, source_fields)
+            for feature in geojson["features"]
+            if feature["geometry"]
+        ]
 
     fields = resource.get("dataspatial_fields_definition")
     if not fields:
@@ -129,7 +140,8 @@ def load_geojson_to_datastore(
         toolkit.get_action("datastore_info")(DEFAULT_CONTEXT, {"id": resource_id})
         logger.info(f"DELETING {resource_id}")
         toolkit.get_action("datastore_delete")(
-            DEFAULT_CONTEXT, {"resource_id": resource_id, "force": True}
+            {**DEFAULT_CONTEXT, INTERNAL_CONTEXT_KEY: True},
+            {"resource_id": resource_id, "force": True},
         )
     except NotFound:
         pass
@@ -147,9 +159,15 @@ def load_geojson_to_datastore(
     logger.debug(create_options["fields"])
     status_callback(
         GeoreferenceStatus.WORKING,
-        value={"notes": f"Creating datastore table for {resource_id}"},
+        value={
+            "notes": f"Creating datastore table for {resource_id}",
+            "phase": GeoreferencePhase.LOADING.value,
+        },
+    )
+    toolkit.get_action("datastore_create")(
+        {**DEFAULT_CONTEXT, INTERNAL_CONTEXT_KEY: True}, create_options
     )
-    toolkit.get_action("datastore_create")({"user": "default"}, create_options)
+    invalidate_table_info(resource_id)
 
     prepare_and_populate_geoms(
         resource,
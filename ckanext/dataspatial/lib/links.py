@@ -0,0 +1,283 @@
+# encoding: utf-8
+# Links between resources: geometries copied from the resource set in
+# dataspatial_geom_resource, joined on dataspatial_geom_link, and polygon keys
+# written by a spatial join with the resource set in dataspatial_link_resource.
+import logging
+import re
+import time
+from typing import Optional
+
+from sqlalchemy import text
+
+from ckanext.dataspatial.config import config
+from ckanext.dataspatial.lib import metrics
+from ckanext.dataspatial.lib.cells import geohash_field, get_available_precisions
+from ckanext.dataspatial.lib.constants import BATCH_SIZE
+from ckanext.dataspatial.lib.db import (
+    Connection,
+    create_column,
+    create_index,
+    get_column_type,
+    get_connection,
+    is_indexed,
+)
+from ckanext.dataspatial.lib.types import (
+    GeoreferencePhase,
+    GeoreferenceStatus,
+    StatusCallback,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def link_column(link_field: str) -> str:
+    """Get the name of the column holding the keys of the linked polygons"""
+    return f"_link_{link_field}"
+
+
+def link_hash_column(link_field: str) -> str:
+    """Get the name of the column holding a hash of the geometry each row was
+    last linked with"""
+    return f"_link_{link_field}_md5"
+
+
+def link_to_polygons(
+    resource_id: str,
+    polygon_resource_id: str,
+    link_field: str,
+    full: bool = False,
+    connection: Optional[Connection] = None,
+    status_callback: StatusCallback = lambda status, value=None, error=None: None,
+) -> int:
+    """Write the key of the polygon each row of a resource falls in
+
+    The rows of the resource are spatially joined to the polygons of another
+    georeferenced resource, and the value of link_field of the first polygon
+    each geometry intersects is written to the _link_<link_field> column of
+    the resource, which is created if needed.
+
+    A hash of the geometry each row was linked with is stored alongside, so
+    only rows whose geometry changed since the last run are processed. Rows
+    are processed in batches, each polygon lookup using the spatial index of
+    the polygon table.
+
+    :param resource_id: The resource to add the link column to
+    :param polygon_resource_id: The resource holding the polygons
+    :param link_field: The key field of the polygon resource
+    :param full: If True, every row is linked again, e.g. because the
+        polygons have changed (Default value = False)
+    :param connection: Database connection. If None, one will be
+        created for this operation. (Default value = None)
+    :param status_callback: Callable that logs status to CKAN task table
+    :returns: the number of rows processed
+    """
+    geom_field = config["postgis.field"]
+    column = link_column(link_field)
+    hash_column = link_hash_column(link_field)
+
+    with get_connection(connection, write=True) as c:
+        link_type = get_column_type(c, polygon_resource_id, link_field)
+        if link_type is None:
+            raise ValueError(
+                f"{link_field} is not a field of resource {polygon_resource_id}."
+            )
+        create_column(c, resource_id, column, link_type)
+        create_column(c, resource_id, hash_column, "text")
+        if full:
+            c.execute(text(f'UPDATE "{resource_id}" SET "{hash_column}" = NULL'))
+
+    source_sql = f"""
+        SELECT _id
+        FROM   "{resource_id}"
+        WHERE  "{hash_column}" IS DISTINCT FROM md5(ST_AsEWKB("{geom_field}"))
+        ORDER BY _id
+    """
+    update_sql = f"""
+        UPDATE "{resource_id}" AS _point
+        SET    "{column}" = (
+                 SELECT _polygon."{link_field}"
+                 FROM   "{polygon_resource_id}" AS _polygon
+                 WHERE  ST_Intersects(_polygon."{geom_field}", _point."{geom_field}")
+                 LIMIT  1
+               ),
+               "{hash_column}" = md5(ST_AsEWKB(_point."{geom_field}"))
+        WHERE  _point._id = ANY(%s)
+    """
+
+    count = 0
+    with get_connection(connection, write=True, raw=True) as c:
+        read_cursor = c.cursor()
+        write_cursor = c.cursor()
+        read_cursor.execute(source_sql)
+        rows_total = read_cursor.rowcount
+        while True:
+            rows = read_cursor.fetchmany(BATCH_SIZE)
+            if not rows:
+                break
+            with metrics.timed("dataspatial_batch_seconds", phase="link"):
+                write_cursor.execute(update_sql, ([row[0] for row in rows],))
+                c.commit()
+            count += len(rows)
+            logger.info(f"{count} rows linked.")
+            status_callback(
+                GeoreferenceStatus.WORKING,
+                value={
+                    "notes": f"Linking rows to {polygon_resource_id}.",
+                    "rows_completed": count,
+                    "rows_total": rows_total,
+                },
+            )
+        c.commit()
+    return count
+
+
+def get_linked_geom_type(
+    source_resource_id: str, connection: Optional[Connection] = None
+) -> str:
+    """Get the geometry type of the geom column of a georeferenced resource
+
+    :param source_resource_id: The georeferenced resource
+    :param connection: Database connection. If None, one will be
+        created for this operation. (Default value = None)
+    :returns: the geometry type name in all caps
+    """
+    geom_field = config["postgis.field"]
+    with get_connection(connection) as c:
+        column_type = get_column_type(c, source_resource_id, geom_field)
+    match = re.match(r"geometry\((\w+)", column_type or "")
+    if not match:
+        raise ValueError(
+            f"Resource {source_resource_id} has not been georeferenced."
+        )
+    return match.group(1).upper()
+
+
+def parse_geom_link(geom_link: str) -> tuple[str, str]:
+    """Parse the dataspatial_geom_link of a resource
+
+    :param geom_link: Either [field_in_this_resource]->[field_in_geom_resource],
+        or the name of a field present in both resources
+    :returns: the name of the field in the resource and in the geom resource
+    """
+    local_field, arrow, source_field = geom_link.partition("->")
+    local_field = local_field.strip()
+    source_field = source_field.strip() if arrow else local_field
+    if not local_field or not source_field:
+        raise ValueError(
+            f"Invalid geom link {geom_link!r}, expected "
+            f"[field_in_this_resource]->[field_in_geom_resource]."
+        )
+    return local_field, source_field
+
+
+def populate_from_linked_resource(
+    resource_id: str,
+    source_resource_id: str,
+    geom_link: str,
+    connection: Optional[Connection] = None,
+    status_callback: StatusCallback = lambda status, value=None, error=None: None,
+) -> int:
+    """Populate the geom columns of a resource from a linked resource
+
+    Rows get the geometries of the rows of the source resource whose link
+    field has the same value as theirs. The link field of the source resource
+    is indexed first, unless it already is. The update is set based, over
+    batches of _id ranges, and only writes rows whose geometry differs from
+    the source, so running it again after the source has been repopulated
+    only touches the rows that changed. The geohash columns of the rows
+    written are emptied in the same update, to be recomputed from their new
+    geometries.
+
+    :param resource_id: The resource to populate
+    :param source_resource_id: The georeferenced resource to take geometries from
+    :param geom_link: The key fields, as in dataspatial_geom_link
+    :param connection: Database connection. If None, one will be
+        created for this operation. (Default value = None)
+    :param status_callback: Callable that logs status to CKAN task table
+    :returns: the number of rows updated
+    """
+    geom_field = config["postgis.field"]
+    mercator_field = config["postgis.mercator_field"]
+
+    local_field, source_field = parse_geom_link(geom_link)
+
+    with get_connection(connection, write=True) as c:
+        if not is_indexed(c, source_resource_id, source_field):
+            logger.info(
+                f"Creating an index on {source_field} of {source_resource_id}, "
+                f"to join {resource_id} to it."
+            )
+            create_index(c, source_resource_id, source_field, "BTREE")
+    geohash_resets = "".join(
+        f', "{geohash_field(p)}" = NULL'
+        for p in get_available_precisions(resource_id, connection)
+    )
+
+    update_sql = f"""
+        UPDATE "{resource_id}" AS _target
+        SET    "{geom_field}" = _source."{geom_field}",
+               "{mercator_field}" = _source."{mercator_field}"
+               {geohash_resets}
+        FROM   "{source_resource_id}" AS _source
+        WHERE  _target._id >= %s AND _target._id < %s
+          AND  _target."{local_field}" = _source."{source_field}"
+          AND  (_target."{geom_field}" IS DISTINCT FROM _source."{geom_field}"
+                OR _target."{mercator_field}" IS NULL)
+    """
+    # rows whose key no longer matches any row of the source lose their geom
+    unlink_sql = f"""
+        UPDATE "{resource_id}" AS _target
+        SET    "{geom_field}" = NULL,
+               "{mercator_field}" = NULL
+               {geohash_resets}
+        WHERE  _target._id >= %s AND _target._id < %s
+          AND  _target."{geom_field}" IS NOT NULL
+          AND  NOT EXISTS (
+                 SELECT 1
+                 FROM   "{source_resource_id}" AS _source
+                 WHERE  _source."{source_field}" = _target."{local_field}"
+               )
+    """
+
+    count = 0
+    with get_connection(connection, write=True, raw=True) as c:
+        cursor = c.cursor()
+        cursor.execute(f'SELECT MIN(_id), MAX(_id) FROM "{resource_id}"')
+        min_id, max_id = cursor.fetchone()
+        if min_id is None:
+            return 0
+
+        status_callback(
+            GeoreferenceStatus.WORKING,
+            value={
+                "notes": f"Populating geom columns from {source_resource_id}.",
+                "phase": GeoreferencePhase.GEOMETRY.value,
+                "rows_completed": 0,
+                "rows_total": max_id + 1 - min_id,
+            },
+        )
+        for start in range(min_id, max_id + 1, BATCH_SIZE):
+            started = time.monotonic()
+            cursor.execute(update_sql, (start, start + BATCH_SIZE))
+            batch_count = cursor.rowcount
+            cursor.execute(unlink_sql, (start, start + BATCH_SIZE))
+            batch_count += cursor.rowcount
+            c.commit()
+            count += batch_count
+            metrics.observe(
+                "dataspatial_batch_seconds",
+                time.monotonic() - started,
+                phase=GeoreferencePhase.GEOMETRY.value,
+            )
+            metrics.inc("dataspatial_populate_rows_total", batch_count)
+            status_callback(
+                GeoreferenceStatus.WORKING,
+                value={
+                    "notes": f"Populating geom columns from {source_resource_id}.",
+                    "phase": GeoreferencePhase.GEOMETRY.value,
+                    "rows_completed": min(start + BATCH_SIZE, max_id + 1) - min_id,
+                    "rows_total": max_id + 1 - min_id,
+                },
+            )
+    logger.info(f"{count} rows of {resource_id} updated from {source_resource_id}.")
+    return count
@@ -0,0 +1,286 @@
+# encoding: utf-8
+# Counters and histograms of the hot paths of the extension.
+#
+# Every update is passed to the exporters listed in dataspatial.metrics.exporters.
+# The prometheus exporter aggregates updates in the memory of each process,
+# for the /dataspatial/metrics route to render; the others forward each update
+# as it happens, which also covers jobs, as rq runs each of them in a process
+# of its own.
+import bisect
+import logging
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from ckan.plugins import toolkit
+
+from ckanext.dataspatial.config import config
+
+logger = logging.getLogger(__name__)
+
+COUNTER = "counter"
+HISTOGRAM = "histogram"
+
+# name: (type, help)
+METRICS = {
+    "dataspatial_populate_rows_total": (
+        COUNTER,
+        "Number of rows whose geometries were populated",
+    ),
+    "dataspatial_populate_rows_per_second": (
+        HISTOGRAM,
+        "Number of rows populated per second, per run",
+    ),
+    "dataspatial_batch_seconds": (
+        HISTOGRAM,
+        "Time taken by a batch of updates, by phase",
+    ),
+    "dataspatial_geojson_seconds": (
+        HISTOGRAM,
+        "Time taken to parse or encode GeoJSON, by step",
+    ),
+    "dataspatial_extent_query_seconds": (
+        HISTOGRAM,
+        "Time taken to answer datastore_query_extent, by backend",
+    ),
+    "dataspatial_job_queue_wait_seconds": (
+        HISTOGRAM,
+        "Time georeferencing jobs waited in their queue",
+    ),
+    "dataspatial_connection_acquire_seconds": (
+        HISTOGRAM,
+        "Time taken to get a database connection, by kind",
+    ),
+}
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800,
+)
+BUCKETS = {
+    "dataspatial_populate_rows_per_second": (
+        10, 100, 500, 1000, 5000, 10000, 50000, 100000,
+    ),
+}
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(label_key: tuple, extra: tuple = ()) -> str:
+    pairs = label_key + extra
+    if not pairs:
+        return ""
+    escaped = (
+        (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pairs
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class Exporter:
+    """Receives every update of the metrics.
+
+    Exporters are registered by name with register_exporter, and enabled by
+    listing that name in dataspatial.metrics.exporters.
+    """
+
+    def inc(self, name: str, value: float, labels: dict) -> None:
+        """Increment a counter"""
+
+    def observe(self, name: str, value: float, labels: dict) -> None:
+        """Record a value of a histogram"""
+
+
+class PrometheusExporter(Exporter):
+    """Aggregates updates in memory, to be rendered in the Prometheus text
+    exposition format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: dict[tuple, float] = {}
+        # (name, labels): [count per bucket, sum, count]
+        self._histograms: dict[tuple, list] = {}
+
+    def inc(self, name: str, value: float, labels: dict) -> None:
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: dict) -> None:
+        key = (name, _label_key(labels))
+        buckets = BUCKETS.get(name, DEFAULT_BUCKETS)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(buckets), 0.0, 0]
+            index = bisect.bisect_left(buckets, value)
+            if index < len(buckets):
+                histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self) -> str:
+        """Render the metrics of this process"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {
+                key: [list(h[0]), h[1], h[2]] for key, h in self._histograms.items()
+            }
+
+        lines = []
+        for name, (metric_type, description) in METRICS.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+            buckets = BUCKETS.get(name, DEFAULT_BUCKETS)
+            for (metric, labels), (counts, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(buckets, counts):
+                    cumulative += bucket_count
+                    le = _format_labels(labels, (("le", str(bound)),))
+                    lines.append(f"{name}_bucket{le} {cumulative}")
+                le = _format_labels(labels, (("le", "+Inf"),))
+                lines.append(f"{name}_bucket{le} {count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+class StatsdExporter(Exporter):
+    """Sends each update to statsd over UDP.
+
+    Label values are appended to the metric name, e.g.
+    dataspatial_batch_seconds.geometry. Durations are sent as timers in
+    milliseconds, other histograms as histograms.
+    """
+
+    def __init__(self):
+        self.address = (
+            config["metrics.statsd_host"],
+            toolkit.asint(config["metrics.statsd_port"]),
+        )
+        self.prefix = config["metrics.statsd_prefix"]
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _name(self, name: str, labels: dict) -> str:
+        parts = [self.prefix] if self.prefix else []
+        parts.append(name)
+        parts.extend(v.replace(".", "_") for _, v in _label_key(labels))
+        return ".".join(parts)
+
+    def _send(self, data: str) -> None:
+        self._socket.sendto(data.encode("utf-8"), self.address)
+
+    def inc(self, name: str, value: float, labels: dict) -> None:
+        self._send(f"{self._name(name, labels)}:{value}|c")
+
+    def observe(self, name: str, value: float, labels: dict) -> None:
+        if name.endswith("_seconds"):
+            self._send(f"{self._name(name, labels)}:{value * 1000:.3f}|ms")
+        else:
+            self._send(f"{self._name(name, labels)}:{value}|h")
+
+
+class LogExporter(Exporter):
+    """Logs each update"""
+
+    def inc(self, name: str, value: float, labels: dict) -> None:
+        logger.info(f"{name}{_format_labels(_label_key(labels))} +{value}")
+
+    def observe(self, name: str, value: float, labels: dict) -> None:
+        logger.info(f"{name}{_format_labels(_label_key(labels))} {value}")
+
+
+EXPORTERS: dict[str, type] = {
+    "prometheus": PrometheusExporter,
+    "statsd": StatsdExporter,
+    "log": LogExporter,
+}
+
+_exporters: Optional[dict[str, Exporter]] = None
+_exporters_lock = threading.Lock()
+
+
+def register_exporter(name: str, exporter_class: type) -> None:
+    """Make an exporter available to dataspatial.metrics.exporters
+
+    :param name: The name to enable it by
+    :param exporter_class: An Exporter subclass, instantiated without arguments
+    """
+    EXPORTERS[name] = exporter_class
+
+
+def get_exporters() -> dict[str, Exporter]:
+    """Return the enabled exporters by name, creating them on first use."""
+    global _exporters
+    if _exporters is None:
+        with _exporters_lock:
+            if _exporters is None:
+                exporters = {}
+                for name in toolkit.aslist(config["metrics.exporters"]):
+                    if name not in EXPORTERS:
+                        raise ValueError(f"Unknown metrics exporter: {name}")
+                    exporters[name] = EXPORTERS[name]()
+                _exporters = exporters
+    return _exporters
+
+
+def _export(method: str, name: str, value: float, labels: dict) -> None:
+    for exporter in get_exporters().values():
+        try:
+            getattr(exporter, method)(name, value, labels)
+        except Exception:
+            # metrics must never break what they measure
+            logger.exception(f"Could not export {name}")
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    """Increment a counter
+
+    :param name: The metric, one of METRICS
+    :param value: The increment (Default value = 1)
+    :param labels: Labels of the metric
+    """
+    _export("inc", name, value, labels)
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """Record a value of a histogram
+
+    :param name: The metric, one of METRICS
+    :param value: The value
+    :param labels: Labels of the metric
+    """
+    _export("observe", name, value, labels)
+
+
+@contextmanager
+def timed(name: str, **labels):
+    """Context manager recording the time its body takes in a histogram
+
+    :param name: The metric, one of METRICS
+    :param labels: Labels of the metric
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+def render_prometheus() -> Optional[str]:
+    """Render the metrics of this process in the Prometheus text format
+
+    :returns: the metrics, or None if the prometheus exporter isn't enabled
+    """
+    exporter = get_exporters().get("prometheus")
+    if exporter is None:
+        return None
+    return exporter.render()
@@ -1,31 +1,64 @@
 # encoding: utf-8
 import datetime
+import json
 import logging
+import math
+import re
+import time
+from contextlib import nullcontext
 from typing import Optional
 
 from ckan.plugins import toolkit
 from ckan.types import DataDict
 from ckanext.datastore import backend as datastore_db
 from ckanext.datastore.helpers import is_single_statement
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
 
 from ckanext.dataspatial.config import config
+from ckanext.dataspatial.lib import metrics
+from ckanext.dataspatial.lib.cells import (
+    create_geohash_columns,
+    geohash_field,
+    get_available_precisions,
+    get_geohash_precisions,
+    populate_geohash_columns,
+    precision_for_cell_size,
+)
 from ckanext.dataspatial.lib.constants import WKB_FIELD_NAME
 from ckanext.dataspatial.lib.db import (
+    alter_geom_column,
     create_geom_column,
     create_index,
+    create_reset_trigger,
     fields_exist,
+    execute_read,
     get_connection,
+    get_engine,
     Connection,
     index_exists,
     invoke_search_plugins,
+    get_column_type,
     get_field_values,
+    pin_to_primary,
+    record_table_write,
+    reset_columns,
+)
+from ckanext.dataspatial.lib.links import (
+    get_linked_geom_type,
+    populate_from_linked_resource,
 )
 from ckanext.dataspatial.lib.types import (
     StatusCallback,
     SpecificStatusCallback,
+    GeoreferencePhase,
     GeoreferenceStatus,
 )
-from ckanext.dataspatial.lib.util import DEFAULT_CONTEXT, get_common_geom_type
+from ckanext.dataspatial.lib.util import (
+    DEFAULT_CONTEXT,
+    get_common_geom_type,
+    source_fingerprint,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -35,6 +68,19 @@ GEOM_MERCATOR_FIELD = toolkit.config.get("postgis.mercator_field", "_geom_webmer
 
 BATCH_SIZE = 5000
 
+# how many nearest candidates, per requested row, are fetched by index order
+#  before being ranked by their exact distance
+NEAREST_CANDIDATE_FACTOR = 2
+
+# circumference of the earth in web mercator meters, and size of a map tile
+#  in pixels
+MERCATOR_WORLD_SIZE = 40075016.68557849
+TILE_SIZE = 256
+MERCATOR_MAX_LAT = 85.0511
+
+GRID_TYPES = ("square", "hex", "geohash")
+NUMERIC_TYPES = ("int2", "int4", "int8", "int", "float4", "float8", "numeric")
+
 
 def has_postgis_columns(
     resource_id: str,
@@ -65,6 +111,7 @@ def has_postgis_index(resource_id: str, connection: Optional[Connection] = None)
               postgis columns
     """
     with get_connection(connection) as c:
+        # these share a single, cached, introspection query
         return (
             has_postgis_columns(resource_id, c)
             and index_exists(c, resource_id, GEOM_FIELD)
@@ -90,6 +137,39 @@ def create_postgis_columns(
         create_geom_column(c, resource_id, GEOM_MERCATOR_FIELD, geom_type, 3857)
 
 
+def get_postgis_geom_type(
+    resource_id: str, connection: Optional[Connection] = None
+) -> Optional[str]:
+    """Get the geometry type of the PostGIS columns of a resource
+
+    :param resource_id: The resource to check
+    :param connection: Database connection. If None, one will be
+        created for this operation. (Default value = None)
+    :returns: the geometry type name in all caps, or None if the resource
+        has no PostGIS columns
+    """
+    with get_connection(connection) as c:
+        column_type = get_column_type(c, resource_id, GEOM_FIELD)
+    match = re.match(r"geometry\((\w+)", column_type or "")
+    return match.group(1).upper() if match else None
+
+
+def alter_postgis_columns(
+    resource_id: str, geom_type: str, connection: Optional[Connection] = None
+):
+    """Change the geometry type of the PostGIS columns, emptying them
+
+    :param resource_id: The resource id the columns are on
+    :param geom_type: The new type of geometry of the columns
+    :param connection: Database connection. If None, one will be
+        created for this operation. (Default value = None)
+    """
+    c: Connection
+    with get_connection(connection, write=True) as c:
+        alter_geom_column(c, resource_id, GEOM_FIELD, geom_type, 4326)
+        alter_geom_column(c, resource_id, GEOM_MERCATOR_FIELD, geom_type, 3857)
+
+
 def create_postgis_index(resource_id: str, connection: Optional[Connection] = None):
     """Create geospatial index
 
@@ -166,6 +246,7 @@ def _populate_columns_with_lat_lng(
             GeoreferenceStatus.WORKING,
             value={
                 "notes": "Populating geom columns using Latitude and Longitude.",
+                "phase": GeoreferencePhase.GEOMETRY.value,
                 **value,
             },
         )
@@ -206,6 +287,7 @@ def _populate_columns_with_wkt(
             GeoreferenceStatus.WORKING,
             value={
                 "notes": "Populating geom columns using Well-Known Text.",
+                "phase": GeoreferencePhase.GEOMETRY.value,
                 **value,
             },
         )
@@ -248,6 +330,7 @@ def _populate_columns_with_wkb(
             GeoreferenceStatus.WORKING,
             value={
                 "notes": "Populating geom columns using Well-Known Binary.",
+                "phase": GeoreferencePhase.GEOMETRY.value,
                 **value,
             },
         )
@@ -279,9 +362,14 @@ def _populate_columns_with_wkb(
     )
 
 
-def connect_and_get_field_values(resource_id: str, field: str, is_bytes: bool = False) -> list:
+def connect_and_get_field_values(
+    resource_id: str,
+    field: str,
+    is_bytes: bool = False,
+    connection: Optional[Connection] = None,
+) -> list:
     c: Connection
-    with get_connection() as c:
+    with get_connection(connection) as c:
         values = get_field_values(c, resource_id, field, is_bytes=is_bytes)
         return values
 
@@ -289,19 +377,40 @@ def prep_table(
     resource,
     geom_type,
     status_callback: StatusCallback = lambda status: None,
+    connection: Optional[Connection] = None,
 ):
-    if not has_postgis_columns(resource["id"]):
-        logger.info(f"Creating PostGIS columns for {resource['id']}.")
-        status_callback(GeoreferenceStatus.WORKING, value={"notes": "Creating Columns"})
-        create_postgis_columns(resource["id"], geom_type)
-
-    if not has_postgis_index(resource["id"]):
-        logger.info(f"Creating PostGIS indexes for {resource['id']}.")
-        status_callback(
-            GeoreferenceStatus.WORKING,
-            value={"notes": "Indexing Geom Columns"},
-        )
-        create_postgis_index(resource["id"])
+    with get_connection(connection, write=True) as c:
+        if not has_postgis_columns(resource["id"], c):
+            logger.info(f"Creating PostGIS columns for {resource['id']}.")
+            status_callback(
+                GeoreferenceStatus.WORKING,
+                value={
+                    "notes": "Creating Columns",
+                    "phase": GeoreferencePhase.COLUMNS.value,
+                },
+            )
+            create_postgis_columns(resource["id"], geom_type, c)
+        elif get_postgis_geom_type(resource["id"], c) != geom_type:
+            logger.info(f"Changing PostGIS column types for {resource['id']}.")
+            status_callback(
+                GeoreferenceStatus.WORKING,
+                value={
+                    "notes": "Changing Column Types",
+                    "phase": GeoreferencePhase.COLUMNS.value,
+                },
+            )
+            alter_postgis_columns(resource["id"], geom_type, c)
+
+        if not has_postgis_index(resource["id"], c):
+            logger.info(f"Creating PostGIS indexes for {resource['id']}.")
+            status_callback(
+                GeoreferenceStatus.WORKING,
+                value={
+                    "notes": "Indexing Geom Columns",
+                    "phase": GeoreferencePhase.INDEX.value,
+                },
+            )
+            create_postgis_index(resource["id"], c)
 
 
 def prepare_and_populate_geoms(
@@ -312,57 +421,248 @@ def prepare_and_populate_geoms(
     """Adds geometric data fields, geometric indexes and then populates the geometric fields based
     on extant data and dataspatial metadata.
 
+    Resources without geometric data of their own take the geometries of the
+    resource set in dataspatial_geom_resource, joined on dataspatial_geom_link.
+
+    A single write connection is used for the whole run. It is in autocommit
+    mode, so DDL is committed as it goes, and batches of updates are committed
+    explicitly.
+
+    Only rows without geometries are populated. A trigger resets the
+    geometries of rows whose source values are updated, so reruns recompute
+    just the rows that changed since the previous run. All geometries are
+    recomputed when the metadata they are computed from changes, or their
+    type has to change.
+
     :param resource: CKAN Resource dict
     :param from_geojson_add: True if going from creation of new geojson file.
     """
+    fingerprint = source_fingerprint(resource)
+    full = (
+        from_geojson_add
+        or resource.get("dataspatial_source_fingerprint") != fingerprint
+    )
+    engine = get_engine(write=True).execution_options(isolation_level="AUTOCOMMIT")
+    with engine.connect() as c:
+        geom_type, stats = _prepare_and_populate_geoms(
+            resource, from_geojson_add, status_callback, c, full
+        )
+
+    pin_to_primary(resource["id"])
+    record_table_write(resource["id"], external=False)
+
+    # update metadata
+    status_callback(
+        GeoreferenceStatus.WORKING,
+        value={
+            "notes": "Updating metadata",
+            "phase": GeoreferencePhase.METADATA.value,
+        },
+    )
+    toolkit.get_action("resource_patch")(
+        DEFAULT_CONTEXT,
+        {
+            "id": resource["id"],
+            "dataspatial_last_geom_updated": datetime.datetime.utcnow().isoformat(),
+            "dataspatial_source_fingerprint": fingerprint,
+            "dataspatial_active": True,
+            "dataspatial_status": "active",
+            "dataspatial_geom_type": geom_type,
+            **stats,
+        },
+    )
+    logger.info(f"Geometry columns for {resource['id']} populated.")
+
+
+def _prepare_and_populate_geoms(
+    resource: dict,
+    from_geojson_add: bool,
+    status_callback: StatusCallback,
+    connection: Connection,
+    full: bool = True,
+) -> tuple[str, dict]:
     lat_field = resource.get("dataspatial_latitude_field")
     lng_field = resource.get("dataspatial_longitude_field")
     wkt_field = resource.get("dataspatial_wkt_field")
+    geom_resource = resource.get("dataspatial_geom_resource")
+    geom_link = resource.get("dataspatial_geom_link")
 
     # common args
-    populate_args = {"resource_id": resource['id'], "status_callback": status_callback}
+    populate_args = {
+        "resource_id": resource["id"],
+        "status_callback": status_callback,
+        "connection": connection,
+    }
+    linked = False
+    source_fields = []
+    current_geom_type = get_postgis_geom_type(resource["id"], connection)
 
     # get format-specific args
     if lat_field and lng_field:
         populate_args["lat_field"] = lat_field
         populate_args["lng_field"] = lng_field
+        source_fields = [lat_field, lng_field]
         geom_type = "POINT"
-    elif from_geojson_add or wkt_field:
-        if from_geojson_add:
-            populate_args["wkb_field"] = WKB_FIELD_NAME
-            values = connect_and_get_field_values(resource["id"], WKB_FIELD_NAME, is_bytes=True)
-            geom_format = "wkb"
-        else:
-            populate_args["wkt_field"] = wkt_field
-            values = connect_and_get_field_values(resource["id"], wkt_field)
-            geom_format = "wkt"
-        geom_type = get_common_geom_type(values, geom_format=geom_format)
+    elif from_geojson_add:
+        populate_args["wkb_field"] = WKB_FIELD_NAME
+        values = connect_and_get_field_values(
+            resource["id"], WKB_FIELD_NAME, is_bytes=True, connection=connection
+        )
+        geom_type = get_common_geom_type(values, geom_format="wkb")
+    elif wkt_field:
+        populate_args["wkt_field"] = wkt_field
+        source_fields = [wkt_field]
+        geom_type = None
+        if not full and current_geom_type:
+            geom_type = _get_pending_geom_type(
+                resource["id"], wkt_field, current_geom_type, connection
+            )
+        if geom_type is None:
+            values = connect_and_get_field_values(
+                resource["id"], wkt_field, connection=connection
+            )
+            geom_type = get_common_geom_type(values, geom_format="wkt")
+    elif geom_resource and geom_link:
+        linked = True
+        geom_type = get_linked_geom_type(geom_resource, connection)
     else:
         raise Exception(
-            "If not uploading a geojson file, lat/long or wkt fields are required."
+            "If not uploading a geojson file, lat/long or wkt fields or a linked "
+            "geometry resource are required."
         )
 
     populate_args["geom_type"] = geom_type
+    if current_geom_type and current_geom_type != geom_type:
+        # the columns are emptied when their type changes
+        full = True
 
     # add geom fields and indexes
-    prep_table(resource, geom_type, status_callback=status_callback)
+    prep_table(
+        resource, geom_type, status_callback=status_callback, connection=connection
+    )
+    precisions = get_geohash_precisions()
+    if precisions:
+        create_geohash_columns(resource["id"], precisions, connection)
+
+    if source_fields:
+        derived_fields = [GEOM_FIELD, GEOM_MERCATOR_FIELD] + [
+            geohash_field(p) for p in precisions
+        ]
+        # geometries of rows whose source values are updated later on are
+        #  reset, and recomputed by the next run
+        create_reset_trigger(
+            connection, resource["id"], source_fields, derived_fields
+        )
+        if full and current_geom_type:
+            logger.info(f"Resetting geometries of {resource['id']}.")
+            reset_columns(connection, resource["id"], derived_fields)
 
     # convert source data to postgis geometries
     logger.info(f"Populating PostGIS columns for {resource['id']}.")
     logger.debug(populate_args)
-    populate_postgis_columns(**populate_args)
+    if linked:
+        populate_from_linked_resource(
+            resource["id"],
+            geom_resource,
+            geom_link,
+            connection=connection,
+            status_callback=status_callback,
+        )
+    else:
+        populate_postgis_columns(**populate_args)
+
+    # precompute geohash cells, if configured
+    if precisions:
+        logger.info(f"Populating geohash columns for {resource['id']}.")
+        populate_geohash_columns(
+            resource["id"],
+            precisions,
+            GEOM_FIELD,
+            connection=connection,
+            status_callback=status_callback,
+        )
 
-    # update metadata
-    toolkit.get_action("resource_patch")(
-        DEFAULT_CONTEXT,
+    return geom_type, get_geom_stats(resource["id"], connection)
+
+
+def _get_pending_geom_type(
+    resource_id: str,
+    wkt_field: str,
+    current_geom_type: str,
+    connection: Connection,
+) -> Optional[str]:
+    """Check if the geometries of the rows still to be populated fit in the
+    existing geom columns
+
+    Only the WKT of those rows is read, instead of that of the whole table.
+
+    :param resource_id: The resource to check
+    :param wkt_field: The Well-Known Text field geometries are populated from
+    :param current_geom_type: The geometry type of the existing geom columns
+    :param connection: Database connection
+    :returns: current_geom_type if the pending geometries fit, None if not
+    """
+    query = text(
+        f"""
+        SELECT "{wkt_field}"
+        FROM   "{resource_id}"
+        WHERE  ("{GEOM_FIELD}" IS NULL OR "{GEOM_MERCATOR_FIELD}" IS NULL)
+          AND  "{wkt_field}" IS NOT NULL
+        """
+    )
+    values = [r[0] for r in connection.execute(query)]
+    if not values:
+        return current_geom_type
+    pending_geom_type = get_common_geom_type(values, geom_format="wkt")
+    if current_geom_type in (pending_geom_type, f"MULTI{pending_geom_type}"):
+        return current_geom_type
+    return None
+
+
+def get_geom_stats(resource_id: str, connection: Optional[Connection] = None) -> dict:
+    """Compute summary statistics of the geometries of a resource
+
+    All values are computed by a single aggregate query over the table, and are
+    named after the resource metadata fields they are stored in.
+
+    :param resource_id: The resource to compute statistics for
+    :param connection: Database connection. If None, one will be
+        created for this operation. (Default value = None)
+    :returns: a dictionary defining:
         {
-            "id": resource["id"],
-            "dataspatial_last_geom_updated": datetime.datetime.now().isoformat(),
-            "dataspatial_active": True,
-            "dataspatial_status": "active",
-        },
+            dataspatial_bbox: [xmin, ymin, xmax, ymax] or None if there are no geoms,
+            dataspatial_geom_count: Number of rows with a geom,
+            dataspatial_null_count: Number of rows without a geom,
+            dataspatial_avg_vertices: Average number of vertices per geom,
+        }
+    """
+    query = text(
+        f"""
+        SELECT COUNT(*) AS row_count,
+               COUNT("{GEOM_FIELD}") AS geom_count,
+               ST_XMIN(ST_EXTENT("{GEOM_FIELD}")) AS xmin,
+               ST_YMIN(ST_EXTENT("{GEOM_FIELD}")) AS ymin,
+               ST_XMAX(ST_EXTENT("{GEOM_FIELD}")) AS xmax,
+               ST_YMAX(ST_EXTENT("{GEOM_FIELD}")) AS ymax,
+               AVG(ST_NPOINTS("{GEOM_FIELD}")) AS avg_vertices
+        FROM   "{resource_id}"
+        """
     )
-    logger.info(f"Geometry columns for {resource['id']} populated.")
+    with get_connection(connection) as c:
+        r = c.execute(query).fetchone()
+
+    bbox = None
+    if r["geom_count"]:
+        bbox = [r["xmin"], r["ymin"], r["xmax"], r["ymax"]]
+    avg_vertices = r["avg_vertices"]
+    return {
+        "dataspatial_bbox": bbox,
+        "dataspatial_geom_count": r["geom_count"],
+        "dataspatial_null_count": r["row_count"] - r["geom_count"],
+        "dataspatial_avg_vertices": (
+            round(float(avg_vertices), 2) if avg_vertices is not None else None
+        ),
+    }
 
 
 def _get_rows_to_update_sql(
@@ -396,33 +696,69 @@ def _populate_columns_in_batches(
     connection=None,
     status_callback: SpecificStatusCallback = lambda d: None,
 ):
+    run_started = time.monotonic()
     with get_connection(connection, write=True, raw=True) as c:
         read_cursor = c.cursor()
         write_cursor = c.cursor()
 
         read_cursor.execute(source_sql)
+        rows_total = read_cursor.rowcount
+        status_callback({"rows_completed": 0, "rows_total": rows_total})
 
         count = 0
         incremental_commit_size = BATCH_SIZE
+        # the two steps alternate every batch, so they are timed separately
+        geometry_seconds = 0.0
+        mercator_seconds = 0.0
 
         while True:
             source_rows = read_cursor.fetchmany(incremental_commit_size)
             if not source_rows:
                 break
 
+            started = time.monotonic()
             for row in source_rows:
                 write_cursor.execute(geom_update_sql, (row[0],))
             c.commit()
-
+            batch_seconds = time.monotonic() - started
+            geometry_seconds += batch_seconds
+            metrics.observe(
+                "dataspatial_batch_seconds",
+                batch_seconds,
+                phase=GeoreferencePhase.GEOMETRY.value,
+            )
+
+            started = time.monotonic()
             for row in source_rows:
                 count += 1
                 write_cursor.execute(geom_webmercator_update_sql, (row[0],))
             c.commit()
+            batch_seconds = time.monotonic() - started
+            mercator_seconds += batch_seconds
+            metrics.observe(
+                "dataspatial_batch_seconds",
+                batch_seconds,
+                phase=GeoreferencePhase.MERCATOR.value,
+            )
+            metrics.inc("dataspatial_populate_rows_total", len(source_rows))
 
             logger.info(f"{count} rows geocoded.")
-            status_callback({"rows_completed": count})
+            status_callback(
+                {
+                    "rows_completed": count,
+                    "rows_total": rows_total,
+                    "phase_durations": {
+                        GeoreferencePhase.GEOMETRY.value: round(geometry_seconds, 3),
+                        GeoreferencePhase.MERCATOR.value: round(mercator_seconds, 3),
+                    },
+                }
+            )
         c.commit()
 
+    run_seconds = time.monotonic() - run_started
+    if count and run_seconds > 0:
+        metrics.observe("dataspatial_populate_rows_per_second", count / run_seconds)
+
 
 def query_extent(data_dict: DataDict, connection: Optional[Connection] = None):
     """Return the spatial query extent of a datastore search
@@ -474,12 +810,388 @@ def query_extent(data_dict: DataDict, connection: Optional[Connection] = None):
             {"query": ["Query is not a single statement."]}
         )
 
-    with get_connection(connection) as c:
-        query_result = c.execute(query, values)
-        r = query_result.fetchone()
+    r = execute_read(
+        text(query), values, connection, resource_id=data_dict["resource_id"]
+    )[0]
 
     result["geom_count"] = r["count"]
     if result["geom_count"] > 0:
         result["bounds"] = ((r["ymin"], r["xmin"]), (r["ymax"], r["xmax"]))
     return result
 
+
+def query_estimated_extent(
+    resource_id: str, connection: Optional[Connection] = None
+) -> Optional[dict]:
+    """Return an estimate of the spatial extent of a whole resource table
+
+    The extent and counts are read from the planner statistics gathered by
+    ANALYZE, so the table itself isn't scanned.
+
+    :param resource_id: The resource to get the extent of
+    :param connection: Database connection. If None, one will be
+        created for this operation. (Default value = None)
+    :returns: a dictionary as per query_extent with `approximate` set, or None
+        if the table has no statistics yet.
+    """
+    geom_field = config["postgis.field"]
+    query = text(
+        """
+        SELECT c.reltuples::bigint AS total_count,
+               COALESCE(s.null_frac, 0) AS null_frac,
+               ST_YMIN(e.extent) AS ymin,
+               ST_XMIN(e.extent) AS xmin,
+               ST_YMAX(e.extent) AS ymax,
+               ST_XMAX(e.extent) AS xmax
+        FROM   pg_class c
+        LEFT JOIN pg_stats s
+               ON s.schemaname = current_schema()
+              AND s.tablename = :table
+              AND s.attname = :field
+        CROSS JOIN LATERAL (
+          SELECT ST_EstimatedExtent(:table, :field) AS extent
+        ) e
+        WHERE  c.oid = to_regclass(quote_ident(:table))
+        """
+    )
+    # a failed statement aborts the transaction of the connection it ran on,
+    #  so on a given connection it runs in a savepoint
+    savepoint = connection.begin_nested() if connection is not None else nullcontext()
+    try:
+        with savepoint:
+            rows = execute_read(
+                query,
+                {"table": resource_id, "field": geom_field},
+                connection,
+                resource_id=resource_id,
+            )
+    except DBAPIError as e:
+        # older PostGIS versions raise rather than return NULL without stats
+        logger.debug(f"No extent estimate for {resource_id}: {e}")
+        return None
+
+    r = rows[0] if rows else None
+    if r is None or r["total_count"] < 0 or r["xmin"] is None:
+        return None
+
+    total_count = r["total_count"]
+    return {
+        "total_count": total_count,
+        "geom_count": round(total_count * (1 - r["null_frac"])),
+        "bounds": ((r["ymin"], r["xmin"]), (r["ymax"], r["xmax"])),
+        "approximate": True,
+    }
+
+
+def _and_where(where_clause: str, condition: str) -> str:
+    """Add a condition to a where clause as returned by invoke_search_plugins
+
+    :param where_clause: Where clause, including WHERE, or an empty string
+    :param condition: Condition to add
+    :returns: the combined where clause
+    """
+    if where_clause:
+        return f"{where_clause} AND ({condition})"
+    return f"WHERE {condition}"
+
+
+def query_nearest(
+    data_dict: DataDict,
+    lat: float,
+    lng: float,
+    k: int,
+    connection: Optional[Connection] = None,
+) -> dict:
+    """Return the k rows of a datastore search nearest to a point
+
+    Candidates are found in index order with the KNN operator on the mercator
+    column, so only about k rows are read whatever the size of the table, and
+    are then ranked by their distance on the spheroid.
+
+    :param data_dict: Dictionary defining the search, as per datastore_search
+    :param lat: Latitude of the point
+    :param lng: Longitude of the point
+    :param k: Number of rows to return
+    :param connection:  (Default value = None)
+    :returns: s a dictionary defining:
+        {
+            fields: The fields of the records, as per datastore_search, plus
+                    `_distance`,
+            records: The rows, nearest first, with their `_distance` from the
+                     point in meters
+        }
+    """
+    r = toolkit.get_action("datastore_search")({}, dict(data_dict, limit=0))
+
+    fields = r["fields"]
+    field_types = dict([(f["id"], f["type"]) for f in fields])
+    field_types["_id"] = "int"
+
+    (ts_query, where_clause, values) = invoke_search_plugins(data_dict, field_types)
+    where_clause = _and_where(
+        where_clause, f'"{config["postgis.mercator_field"]}" IS NOT NULL'
+    )
+    columns = ", ".join(f'"{f["id"]}"' for f in fields)
+
+    query = """
+        SELECT row_to_json(_nearest_sub) AS record
+        FROM   (
+          SELECT {columns},
+                 ST_Distance(
+                   "{geom_field}"::geography,
+                   ST_SetSRID(ST_MakePoint(:dataspatial_lng, :dataspatial_lat), 4326)::geography
+                 ) AS _distance
+          FROM   "{resource_id}" {ts_query}
+          {where_clause}
+          ORDER BY "{mercator_field}" <-> ST_Transform(
+            ST_SetSRID(ST_MakePoint(:dataspatial_lng, :dataspatial_lat), 4326), 3857
+          )
+          LIMIT  :dataspatial_candidates
+        ) _nearest_sub
+        ORDER BY _nearest_sub._distance
+        LIMIT  :dataspatial_k
+    """.format(
+        columns=columns,
+        geom_field=config["postgis.field"],
+        mercator_field=config["postgis.mercator_field"],
+        resource_id=data_dict["resource_id"],
+        where_clause=where_clause,
+        ts_query=ts_query,
+    )
+
+    if not is_single_statement(query):
+        raise datastore_db.DatastoreException(
+            {"query": ["Query is not a single statement."]}
+        )
+
+    values.update(
+        {
+            "dataspatial_lat": lat,
+            "dataspatial_lng": lng,
+            "dataspatial_k": k,
+            "dataspatial_candidates": k * NEAREST_CANDIDATE_FACTOR,
+        }
+    )
+    rows = execute_read(
+        text(query), values, connection, resource_id=data_dict["resource_id"]
+    )
+
+    return {
+        "fields": fields + [{"id": "_distance", "type": "float8"}],
+        "records": [row["record"] for row in rows],
+    }
+
+
+def to_mercator(lng: float, lat: float) -> tuple[float, float]:
+    """Project a WGS84 coordinate to web mercator"""
+    lat = max(min(lat, MERCATOR_MAX_LAT), -MERCATOR_MAX_LAT)
+    x = lng * MERCATOR_WORLD_SIZE / 360
+    y = math.log(math.tan(math.radians(90 + lat) / 2)) * MERCATOR_WORLD_SIZE / (2 * math.pi)
+    return x, y
+
+
+def grid_cell_size(zoom: int, cell_pixels: int) -> float:
+    """Get the size of a grid cell in web mercator meters
+
+    :param zoom: Map zoom level
+    :param cell_pixels: Size of a cell on screen, in pixels
+    """
+    return MERCATOR_WORLD_SIZE / (TILE_SIZE * 2**zoom) * cell_pixels
+
+
+def estimate_grid_cells(bbox: list[float], cell_size: float, grid: str) -> int:
+    """Estimate the largest number of cells a grid over a bbox can have
+
+    :param bbox: [xmin, ymin, xmax, ymax] in WGS84
+    :param cell_size: Cell size in web mercator meters
+    :param grid: One of GRID_TYPES
+    """
+    xmin, ymin = to_mercator(bbox[0], bbox[1])
+    xmax, ymax = to_mercator(bbox[2], bbox[3])
+    cell_area = cell_size**2
+    if grid == "hex":
+        # hexagons of ST_HexagonGrid have sides of cell_size
+        cell_area = 3 * math.sqrt(3) / 2 * cell_size**2
+    return math.ceil((xmax - xmin + cell_size) * (ymax - ymin + cell_size) / cell_area)
+
+
+def grid_geohash_precision(resource_id: str, cell_size: float) -> int:
+    """Pick the geohash precision of a geohash grid: the precomputed column
+    closest to the cell size.
+
+    :param resource_id: The resource to aggregate
+    :param cell_size: Cell size in web mercator meters
+    """
+    precisions = get_available_precisions(resource_id)
+    if not precisions:
+        raise toolkit.ValidationError(
+            {"grid": ["This resource has no geohash columns."]}
+        )
+    return precision_for_cell_size(precisions, cell_size)
+
+
+def query_grid(
+    data_dict: DataDict,
+    bbox: list[float],
+    cell_size: float,
+    grid: str = "square",
+    sum_fields: Optional[list[str]] = None,
+    connection: Optional[Connection] = None,
+    precision: Optional[int] = None,
+) -> dict:
+    """Aggregate the rows of a datastore search within a bbox into grid cells
+
+    Rows are assigned to cells by the centroid of their mercator geometry. For
+    square grids it is snapped to the grid with ST_SnapToGrid; for hexagonal
+    grids each cell of ST_HexagonGrid counts its rows with an index scan. For
+    geohash grids rows are grouped by their precomputed geohash column. The
+    number of cells returned depends on the bbox and cell size only.
+
+    :param data_dict: Dictionary defining the search, as per datastore_search
+    :param bbox: [xmin, ymin, xmax, ymax] in WGS84
+    :param cell_size: Cell size in web mercator meters
+    :param grid: One of GRID_TYPES (Default value = "square")
+    :param sum_fields: Numeric fields to sum in each cell (Default value = None)
+    :param connection:  (Default value = None)
+    :param precision: Geohash precision of geohash grids. If None, the one
+        picked by grid_geohash_precision. (Default value = None)
+    :returns: s a dictionary defining:
+        {
+            cells: list of {lat, lng, count, sums} for the cell centres, and
+                   the cell `geometry` as GeoJSON for hexagonal and geohash
+                   grids, and the `geohash` for geohash grids,
+            total_count: the number of rows in all the cells
+        }
+    """
+    r = toolkit.get_action("datastore_search")({}, dict(data_dict, limit=0))
+
+    field_types = dict([(f["id"], f["type"]) for f in r["fields"]])
+    field_types["_id"] = "int"
+
+    sum_fields = sum_fields or []
+    for field in sum_fields:
+        if field_types.get(field) not in NUMERIC_TYPES:
+            raise toolkit.ValidationError(
+                {"sum_fields": [f"{field} is not a numeric field."]}
+            )
+
+    (ts_query, where_clause, values) = invoke_search_plugins(data_dict, field_types)
+    mercator_field = config["postgis.mercator_field"]
+    where_clause = _and_where(
+        where_clause,
+        f'"{mercator_field}" && ST_Transform(ST_MakeEnvelope('
+        ":dataspatial_xmin, :dataspatial_ymin, :dataspatial_xmax, :dataspatial_ymax, "
+        "4326), 3857)",
+    )
+
+    resource_id = data_dict["resource_id"]
+    if grid == "geohash":
+        # group by the precomputed geohash column closest to the cell size
+        if precision is None:
+            precision = grid_geohash_precision(resource_id, cell_size)
+        field = geohash_field(precision)
+        sums = "".join(
+            f', SUM("{f}")::float8 AS _sum_{i}' for i, f in enumerate(sum_fields)
+        )
+        query = f"""
+            SELECT COUNT(*) AS count,
+                   "{field}" AS geohash,
+                   ST_X(ST_PointFromGeoHash("{field}")) AS lng,
+                   ST_Y(ST_PointFromGeoHash("{field}")) AS lat,
+                   ST_AsGeoJSON(ST_GeomFromGeoHash("{field}"), 6) AS geometry
+                   {sums}
+            FROM   "{resource_id}" {ts_query}
+            {_and_where(where_clause, f'"{field}" IS NOT NULL')}
+            GROUP BY "{field}"
+        """
+    elif grid == "hex":
+        # every hexagon counts its own rows with an index scan on its bounds
+        sums = "".join(
+            f', SUM("{field}")::float8 AS _sum_{i}' for i, field in enumerate(sum_fields)
+        )
+        cell_where_clause = _and_where(
+            where_clause,
+            f'"{mercator_field}" && _hex.geom '
+            f'AND ST_Intersects(_hex.geom, ST_Centroid("{mercator_field}"))',
+        )
+        query = f"""
+            SELECT _cells.*,
+                   ST_X(ST_Transform(ST_Centroid(_hex.geom), 4326)) AS lng,
+                   ST_Y(ST_Transform(ST_Centroid(_hex.geom), 4326)) AS lat,
+                   ST_AsGeoJSON(ST_Transform(_hex.geom, 4326), 6) AS geometry
+            FROM   ST_HexagonGrid(
+                     :dataspatial_cell_size,
+                     ST_Transform(ST_MakeEnvelope(:dataspatial_xmin, :dataspatial_ymin,
+                                                  :dataspatial_xmax, :dataspatial_ymax,
+                                                  4326), 3857)
+                   ) AS _hex
+            CROSS JOIN LATERAL (
+              SELECT COUNT(*) AS count {sums}
+              FROM   "{resource_id}" {ts_query}
+              {cell_where_clause}
+            ) _cells
+            WHERE  _cells.count > 0
+        """
+    else:
+        sum_columns = "".join(
+            f', "{field}" AS _sum_{i}' for i, field in enumerate(sum_fields)
+        )
+        sums = "".join(
+            f", SUM(_grid_sub._sum_{i})::float8 AS _sum_{i}"
+            for i in range(len(sum_fields))
+        )
+        query = f"""
+            SELECT COUNT(*) AS count,
+                   ST_X(ST_Transform(_grid_sub._cell, 4326)) AS lng,
+                   ST_Y(ST_Transform(_grid_sub._cell, 4326)) AS lat,
+                   NULL AS geometry
+                   {sums}
+            FROM   (
+              SELECT ST_SnapToGrid(ST_Centroid("{mercator_field}"),
+                                   :dataspatial_cell_size) AS _cell
+                     {sum_columns}
+              FROM   "{resource_id}" {ts_query}
+              {where_clause}
+            ) _grid_sub
+            GROUP BY _grid_sub._cell
+        """
+
+    if not is_single_statement(query):
+        raise datastore_db.DatastoreException(
+            {"query": ["Query is not a single statement."]}
+        )
+
+    xmin, ymin, xmax, ymax = bbox
+    values.update(
+        {
+            "dataspatial_xmin": xmin,
+            "dataspatial_ymin": ymin,
+            "dataspatial_xmax": xmax,
+            "dataspatial_ymax": ymax,
+            "dataspatial_cell_size": cell_size,
+        }
+    )
+    rows = execute_read(
+        text(query), values, connection, resource_id=data_dict["resource_id"]
+    )
+
+    cells = []
+    for row in rows:
+        cell = {
+            "lat": row["lat"],
+            "lng": row["lng"],
+            "count": row["count"],
+            "sums": {
+                field: row[f"_sum_{i}"] for i, field in enumerate(sum_fields)
+            },
+        }
+        if row["geometry"]:
+            cell["geometry"] = json.loads(row["geometry"])
+        if grid == "geohash":
+            cell["geohash"] = row["geohash"]
+        cells.append(cell)
+
+    return {
+        "cells": cells,
+        "total_count": sum(cell["count"] for cell in cells),
+    }
@@ -0,0 +1,147 @@
+# encoding: utf-8
+import json
+import logging
+import re
+
+import requests
+from ckan.plugins import toolkit
+from ckan.types import DataDict
+
+from ckanext.dataspatial.config import config
+from ckanext.dataspatial.lib.constants import BBOX_FILTER, SPATIAL_FILTERS
+from ckanext.dataspatial.lib.filters import parse_bbox
+
+logger = logging.getLogger(__name__)
+
+SOLR_SPECIAL_CHARS = re.compile(r'([+\-&|!(){}\[\]^"~*?:\\/\s])')
+
+
+def escape(value) -> str:
+    """Escape a value for use in a Solr query"""
+    return SOLR_SPECIAL_CHARS.sub(r"\\\1", str(value))
+
+
+def _load(value):
+    if isinstance(value, str):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+    return value
+
+
+def filter_queries(data_dict: DataDict) -> list[str]:
+    """Translate the filters of a datastore_search request to Solr filter queries
+
+    :param data_dict: Request arguments, as per datastore_search
+    :returns: a list of fq values
+    """
+    filters = _load(data_dict.get("filters")) or {}
+    fqs = []
+    for field, value in filters.items():
+        if field == BBOX_FILTER:
+            xmin, ymin, xmax, ymax = parse_bbox(value)
+            fqs.append(f"{escape(config['solr.latitude_field'])}:[{ymin} TO {ymax}]")
+            fqs.append(f"{escape(config['solr.longitude_field'])}:[{xmin} TO {xmax}]")
+        elif field in SPATIAL_FILTERS:
+            raise toolkit.ValidationError(
+                {"filters": [f"{field} is not supported with the Solr backend."]}
+            )
+        elif isinstance(value, list):
+            values = " OR ".join(f'"{escape(v)}"' for v in value)
+            fqs.append(f"{escape(field)}:({values})")
+        else:
+            fqs.append(f'{escape(field)}:"{escape(value)}"')
+    return fqs
+
+
+def _terms(value) -> str:
+    return " ".join(escape(term) for term in str(value).split())
+
+
+def text_query(data_dict: DataDict) -> str:
+    """Translate the q of a datastore_search request to a Solr query
+
+    :param data_dict: Request arguments, as per datastore_search
+    """
+    q = _load(data_dict.get("q"))
+    if not q:
+        return "*:*"
+    if isinstance(q, dict):
+        return " AND ".join(
+            f"{escape(field)}:({_terms(value)})" for field, value in q.items()
+        )
+    return _terms(q)
+
+
+def query_extent(data_dict: DataDict) -> dict:
+    """Return the spatial query extent of a datastore search, computed by Solr
+
+    The bounds are the stats of the indexed latitude and longitude fields of
+    the matching documents, so the datastore database isn't queried.
+
+    :param data_dict: Dictionary defining the search
+    :returns: s a dictionary defining:
+        {
+            total_count: The total number of rows in the query,
+            geom_count: The number of rows that have a geom,
+            bounds: ((lat min, long min), (lat max, long max)) for the
+                  queries rows
+        }
+    """
+    url = config["solr.url"].format(resource_id=data_dict["resource_id"])
+    if not url:
+        raise toolkit.ValidationError(
+            {"dataspatial.solr.url": ["Solr url must be configured."]}
+        )
+    lat_field = config["solr.latitude_field"]
+    lng_field = config["solr.longitude_field"]
+    index_field = config["solr.index_field"]
+
+    params = [
+        ("q", text_query(data_dict)),
+        ("rows", "0"),
+        ("wt", "json"),
+        ("stats", "true"),
+        ("stats.field", lat_field),
+        ("stats.field", lng_field),
+    ]
+    params += [("fq", fq) for fq in filter_queries(data_dict)]
+    if index_field:
+        params += [
+            ("facet", "true"),
+            ("facet.query", f"{{!key=geom_count}}{escape(index_field)}:[* TO *]"),
+        ]
+
+    try:
+        response = requests.get(
+            url.rstrip("/") + "/select",
+            params=params,
+            timeout=toolkit.asint(config["solr.timeout"]),
+        )
+        response.raise_for_status()
+        body = response.json()
+
+        total_count = body["response"]["numFound"]
+        stats = body.get("stats", {}).get("stats_fields", {})
+        lat_stats = stats.get(lat_field) or {}
+        lng_stats = stats.get(lng_field) or {}
+        if index_field:
+            geom_count = body["facet_counts"]["facet_queries"]["geom_count"]
+        else:
+            geom_count = min(lat_stats.get("count", 0), lng_stats.get("count", 0))
+    except (requests.RequestException, ValueError, KeyError) as e:
+        logger.warning(
+            f"Solr extent query of {data_dict['resource_id']} failed: {e!r}"
+        )
+        raise toolkit.ValidationError(
+            {"query_extent": ["The extent could not be computed by Solr."]}
+        )
+
+    result = {"total_count": total_count, "geom_count": geom_count, "bounds": None}
+    if geom_count > 0 and lat_stats.get("count") and lng_stats.get("count"):
+        result["bounds"] = (
+            (lat_stats["min"], lng_stats["min"]),
+            (lat_stats["max"], lng_stats["max"]),
+        )
+    return result
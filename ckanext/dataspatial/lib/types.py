@@ -22,6 +22,16 @@ class GeoreferenceStatus(Enum):
     ERROR = "ERROR"
 
 
+class GeoreferencePhase(Enum):
+    LOADING = "loading"
+    COLUMNS = "columns"
+    INDEX = "index"
+    GEOMETRY = "geometry"
+    MERCATOR = "mercator"
+    GEOHASH = "geohash"
+    METADATA = "metadata"
+
+
 StatusCallback = Callable[[str, Union[str, None], Union[str, None]], None]
 
 SpecificStatusCallback = Callable[[Union[str, None], Union[str, None]], None]
@@ -40,7 +50,28 @@ class StatusDict(TypedDict):
     status: str
     last_updated: str
     rows_completed: Union[int, None]
+    rows_total: Union[int, None]
+    rows_per_second: Union[float, None]
+    eta: Union[str, None]
+    phase: Union[str, None]
+    phase_durations: dict[str, float]
     notes: Union[str, None]
 
 
+class ColumnInfo(TypedDict):
+    type: str
+    srid: Union[int, None]
+
+
+class IndexInfo(TypedDict):
+    method: str
+    columns: list[str]
+    partial: bool
+
+
+class TableInfo(TypedDict):
+    columns: dict[str, ColumnInfo]
+    indexes: dict[str, IndexInfo]
+
+
 StatusResult = StatusDict | dict[Literal["status"] : str]
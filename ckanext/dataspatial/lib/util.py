@@ -1,4 +1,6 @@
 # encoding: utf-8
+import hashlib
+import json
 import logging
 import os
 from pathlib import Path
@@ -11,6 +13,19 @@ from ckanext.dataspatial.lib.db import get_connection
 
 DEFAULT_CONTEXT = {"user": "default"}
 
+# set in the context of datastore actions called by this extension, whose writes
+# mustn't be taken for changes to the data
+INTERNAL_CONTEXT_KEY = "dataspatial_internal"
+
+# resource metadata the geometries are computed from
+SOURCE_FIELDS = (
+    "dataspatial_latitude_field",
+    "dataspatial_longitude_field",
+    "dataspatial_wkt_field",
+    "dataspatial_geom_resource",
+    "dataspatial_geom_link",
+)
+
 from ckan.model import parse_db_config
 
 
@@ -91,25 +106,67 @@ def should_be_updated(resource: dict):
 
 
 def can_be_spatial(resource: dict):
-    return resource["datastore_active"] and _has_necessary_metadata(resource)
+    return resource.get("datastore_active") and _has_necessary_metadata(resource)
 
 
 def out_of_sync(resource: dict):
+    """True if the geometries of the resource need to be updated
+
+    That is if they were never populated, if the metadata they are computed
+    from changed, or if the data was modified since. Changes to any other
+    metadata don't affect them.
+    """
+    last_geom_updated = resource.get("dataspatial_last_geom_updated")
     return (
-        not resource.get("dataspatial_last_geom_updated")
-        or resource.get("dataspatial_last_geom_updated") < resource.get("last_modified")
-        or resource.get("dataspatial_last_geom_updated")
-        < resource.get("metadata_modified")
+        not last_geom_updated
+        or resource.get("dataspatial_source_fingerprint") != source_fingerprint(resource)
+        or last_geom_updated < (resource.get("last_modified") or "")
+    )
+
+
+def source_fingerprint(resource: dict) -> str:
+    """Hash of the resource metadata its geometries are computed from
+
+    :param resource: CKAN Resource dict
+    :returns: a hex digest
+    """
+    source = json.dumps([resource.get(field) or None for field in SOURCE_FIELDS])
+    return hashlib.md5(source.encode()).hexdigest()
+
+
+def links_to_polygons(resource: dict):
+    """True if the rows of the resource are to be linked to the polygons of
+    the resource set in its dataspatial_link_resource."""
+    return bool(
+        _has_necessary_metadata(resource)
+        and resource.get("dataspatial_link_resource")
+        and resource.get("dataspatial_link_field")
     )
 
 
+def takes_linked_geoms(resource: dict):
+    """True if the resource has no geometry data of its own and takes its
+    geometries from the resource set in its dataspatial_geom_resource."""
+    return bool(not _has_geom_source(resource) and _has_link(resource))
+
+
 def _has_necessary_metadata(resource: dict):
+    return _has_geom_source(resource) or _has_link(resource)
+
+
+def _has_geom_source(resource: dict):
     return (
         resource.get("dataspatial_latitude_field")
         and resource.get("dataspatial_longitude_field")
     ) or resource.get("dataspatial_wkt_field")
 
 
+def _has_link(resource: dict):
+    return resource.get("dataspatial_geom_resource") and resource.get(
+        "dataspatial_geom_link"
+    )
+
+
 def update_fulltext_trigger():
     parsed_db = parse_db_config("ckan.datastore.write_url")
 
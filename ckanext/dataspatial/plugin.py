@@ -4,6 +4,7 @@ from typing import cast
 from ckan.common import CKANConfig
 from ckan.plugins import SingletonPlugin, implements, interfaces, toolkit
 from ckan.types import Schema
+from ckanext.datastore.interfaces import IDatastore
 
 from ckanext.dataspatial import cli, views
 from ckanext.dataspatial.actions import (
@@ -11,14 +12,28 @@ from ckanext.dataspatial.actions import (
     dataspatial_hook,
     dataspatial_status,
     dataspatial_resource_list,
+    dataspatial_populate_all,
+    datastore_create,
+    datastore_delete,
+    datastore_upsert,
 )
 from ckanext.dataspatial.config import config
 from ckanext.dataspatial.helpers import dataspatial_status_description
+from ckanext.dataspatial.lib.db import READ_ROUTINGS
+from ckanext.dataspatial.lib.metrics import EXPORTERS
+from ckanext.dataspatial.lib.filters import (
+    spatial_where_clauses,
+    validate_spatial_filters,
+)
 from ckanext.dataspatial.schema import (
     dataspatial_modify_resource_schema,
     dataspatial_show_resource_schema,
 )
-from ckanext.dataspatial.search import datastore_query_extent
+from ckanext.dataspatial.search import (
+    datastore_query_extent,
+    datastore_query_grid,
+    datastore_search_nearest,
+)
 from ckanext.dataspatial.validators import json_object_list
 
 
@@ -33,6 +48,7 @@ class DataSpatialPlugin(toolkit.DefaultDatasetForm, SingletonPlugin):
     implements(interfaces.IConfigurer)
     implements(interfaces.IBlueprint)
     implements(interfaces.ITemplateHelpers)
+    implements(IDatastore, inherit=True)
 
     # IValidators
     def get_validators(self):
@@ -98,6 +114,21 @@ class DataSpatialPlugin(toolkit.DefaultDatasetForm, SingletonPlugin):
             raise toolkit.ValidationError(
                 {"dataspatial.query_extent": "Should be either of postgis or solr"}
             )
+        for exporter in toolkit.aslist(config["metrics.exporters"]):
+            if exporter not in EXPORTERS:
+                raise toolkit.ValidationError(
+                    {
+                        "dataspatial.metrics.exporters": "Should be a list of "
+                        + ", ".join(EXPORTERS)
+                    }
+                )
+        if config["db.read_routing"] not in READ_ROUTINGS:
+            raise toolkit.ValidationError(
+                {
+                    "dataspatial.db.read_routing": "Should be either of "
+                    + " or ".join(READ_ROUTINGS)
+                }
+            )
 
     # IActions
     def get_actions(self):
@@ -107,6 +138,13 @@ class DataSpatialPlugin(toolkit.DefaultDatasetForm, SingletonPlugin):
             "dataspatial_hook": dataspatial_hook,
             "dataspatial_status": dataspatial_status,
             "dataspatial_resource_list": dataspatial_resource_list,
+            "dataspatial_populate_all": dataspatial_populate_all,
+            "datastore_query_extent": datastore_query_extent,
+            "datastore_search_nearest": datastore_search_nearest,
+            "datastore_query_grid": datastore_query_grid,
+            "datastore_create": datastore_create,
+            "datastore_upsert": datastore_upsert,
+            "datastore_delete": datastore_delete,
         }
 
     # IClick
@@ -121,3 +159,15 @@ class DataSpatialPlugin(toolkit.DefaultDatasetForm, SingletonPlugin):
     # ITemplateHelpers
     def get_helpers(self):
         return {"dataspatial_status_description": dataspatial_status_description}
+
+    # IDatastore
+    def datastore_validate(self, context, data_dict, fields_types):
+        return validate_spatial_filters(data_dict)
+
+    def datastore_search(self, context, data_dict, fields_types, query_dict):
+        query_dict["where"] += spatial_where_clauses(data_dict)
+        return query_dict
+
+    def datastore_delete(self, context, data_dict, fields_types, query_dict):
+        query_dict["where"] += spatial_where_clauses(data_dict)
+        return query_dict
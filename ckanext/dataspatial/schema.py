@@ -6,6 +6,8 @@ from ckanext.dataspatial.validators import json_object_list
 boolean_validator = tk.get_validator("boolean_validator")
 isodate = tk.get_validator("isodate")
 ignore_empty = tk.get_validator("ignore_empty")
+ignore_missing = tk.get_validator("ignore_missing")
+int_validator = tk.get_validator("int_validator")
 ignore_not_sysadmin = tk.get_validator("ignore_not_sysadmin")
 resource_id_exists = tk.get_validator("resource_id_exists")
 default = tk.get_validator("default")
@@ -19,6 +21,13 @@ def dataspatial_modify_resource_schema() -> Schema:
         "dataspatial_active": [boolean_validator],
         "dataspatial_status": [ignore_empty],
         "dataspatial_last_geom_updated": [ignore_empty, isodate],
+        "dataspatial_source_fingerprint": [ignore_empty],
+        # geometry statistics, computed when populating
+        "dataspatial_geom_type": [ignore_empty],
+        "dataspatial_bbox": [ignore_empty, convert_to_json_if_string],
+        "dataspatial_geom_count": [ignore_missing, int_validator],
+        "dataspatial_null_count": [ignore_missing, int_validator],
+        "dataspatial_avg_vertices": [ignore_missing],
         # for preparing tabular files
         "dataspatial_longitude_field": [ignore_not_sysadmin, ignore_empty],
         "dataspatial_latitude_field": [ignore_not_sysadmin, ignore_empty],
@@ -37,6 +46,14 @@ def dataspatial_modify_resource_schema() -> Schema:
             resource_id_exists,
         ],
         "dataspatial_geom_link": [ignore_not_sysadmin, ignore_empty],
+        # for linking rows to the polygons of another resource
+        "dataspatial_link_resource": [
+            ignore_not_sysadmin,
+            ignore_empty,
+            resource_id_exists,
+        ],
+        "dataspatial_link_field": [ignore_not_sysadmin, ignore_empty],
+        "dataspatial_link_updated": [ignore_empty, isodate],
     }
 
 
@@ -49,6 +66,15 @@ def dataspatial_show_resource_schema() -> Schema:
         "dataspatial_fields_definition": [ignore_empty, default(None)],
         "dataspatial_geom_resource": [ignore_empty, default(None)],
         "dataspatial_geom_link": [ignore_empty, default(None)],
+        "dataspatial_link_resource": [ignore_empty, default(None)],
+        "dataspatial_link_field": [ignore_empty, default(None)],
+        "dataspatial_link_updated": [ignore_empty, default(None)],
         "dataspatial_last_geom_updated": [ignore_empty, default(None)],
+        "dataspatial_source_fingerprint": [ignore_empty, default(None)],
         "dataspatial_active": [boolean_validator, ignore_empty, default(False)],
+        "dataspatial_geom_type": [ignore_empty, default(None)],
+        "dataspatial_bbox": [ignore_empty, default(None)],
+        "dataspatial_geom_count": [default(None)],
+        "dataspatial_null_count": [default(None)],
+        "dataspatial_avg_vertices": [default(None)],
     }
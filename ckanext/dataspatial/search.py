@@ -1,9 +1,175 @@
 # encoding: utf-8
+import json
+import time
+from typing import Optional
+
+from ckan.logic import side_effect_free
+from ckan.plugins import toolkit
 from ckan.types import Context, DataDict
+from dateutil.parser import parse as parse_date
 
+from ckanext.dataspatial.config import config
+from ckanext.dataspatial.lib import metrics
+from ckanext.dataspatial.lib.cache import TTLCache
+from ckanext.dataspatial.lib.cells import estimate_geohash_cells
+from ckanext.dataspatial.lib.db import (
+    get_connection,
+    get_last_write,
+    get_table_version,
+)
 from ckanext.dataspatial.lib.postgis import query_extent as postgis_query_extent
+from ckanext.dataspatial.lib.solr import query_extent as solr_query_extent
+from ckanext.dataspatial.lib.filters import parse_bbox
+from ckanext.dataspatial.lib.postgis import (
+    GRID_TYPES,
+    MERCATOR_MAX_LAT,
+    estimate_grid_cells,
+    grid_cell_size,
+    grid_geohash_precision,
+    query_estimated_extent,
+    query_grid,
+    query_nearest,
+)
+
+# datastore_search arguments that have no effect on the extent of a query
+EXTENT_IGNORED_KEYS = {
+    "limit",
+    "offset",
+    "sort",
+    "fields",
+    "distinct",
+    "records_format",
+    "include_total",
+    "total_estimation_threshold",
+}
+
+# datastore_search arguments that narrow down the rows of a query
+EXTENT_FILTER_KEYS = {"filters", "q"}
+
+_extent_cache: Optional[TTLCache] = None
+
+
+def _get_extent_cache() -> TTLCache:
+    """Return the process wide query extent cache, creating it on first use."""
+    global _extent_cache
+    if _extent_cache is None:
+        _extent_cache = TTLCache(
+            max_size=toolkit.asint(config["query_extent.cache_size"]),
+            ttl=toolkit.asint(config["query_extent.cache_ttl"]),
+        )
+    return _extent_cache
+
+
+def _canonical_value(value):
+    """Parse JSON strings and sort lists so equivalent values compare equal."""
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return value
+    if isinstance(value, dict):
+        return {k: _canonical_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return sorted(
+            (_canonical_value(v) for v in value),
+            key=lambda v: json.dumps(v, sort_keys=True, default=str),
+        )
+    return value
+
+
+def extent_cache_key(data_dict: DataDict) -> str:
+    """Build a cache key from the arguments of an extent query.
+
+    Arguments that don't change the set of matched rows are dropped, and
+    filters are normalised so that the order in which they were given
+    doesn't matter.
+
+    :param data_dict: Request arguments, as per datastore_search
+    :returns: the cache key
+    """
+    canonical = {}
+    for key, value in data_dict.items():
+        if key in EXTENT_IGNORED_KEYS:
+            continue
+        if key == "filters":
+            value = _canonical_value(value)
+        canonical[key] = value
+    return json.dumps(canonical, sort_keys=True, default=str)
+
+
+def is_unfiltered(data_dict: DataDict) -> bool:
+    """Return True if the query matches every row of the resource table.
+
+    :param data_dict: Request arguments, as per datastore_search
+    """
+    return not any(_canonical_value(data_dict.get(key)) for key in EXTENT_FILTER_KEYS)
 
 
+def is_stored_extent_stale(resource: dict) -> bool:
+    """Return True if the table of a resource was written to since the extent
+    stored in its metadata was computed.
+
+    :param resource: CKAN Resource dict
+    """
+    last_write = get_last_write(resource["id"])
+    if last_write is None:
+        return False
+    last_geom_updated = resource.get("dataspatial_last_geom_updated")
+    return not last_geom_updated or last_write > parse_date(last_geom_updated)
+
+
+def _stored_extent(context: Context, resource_id: str) -> Optional[dict]:
+    """Return the extent of a resource as stored in its metadata when its
+    geometries were last populated, or None if it has not been stored or is
+    out of date.
+
+    :param context: Current context
+    :param resource_id: The resource to get the extent of
+    """
+    resource = toolkit.get_action("resource_show")(context, {"id": resource_id})
+    if is_stored_extent_stale(resource):
+        return None
+    bbox = resource.get("dataspatial_bbox")
+    geom_count = resource.get("dataspatial_geom_count")
+    null_count = resource.get("dataspatial_null_count")
+    if geom_count is None or null_count is None:
+        return None
+
+    bounds = None
+    if bbox:
+        xmin, ymin, xmax, ymax = bbox
+        bounds = ((ymin, xmin), (ymax, xmax))
+    return {
+        "total_count": geom_count + null_count,
+        "geom_count": geom_count,
+        "bounds": bounds,
+        "approximate": True,
+    }
+
+
+def _query_extent(
+    context: Context, data_dict: DataDict, approximate: bool = False
+) -> dict:
+    """Run the extent query, using stored or estimated extents where allowed.
+
+    :param context: Current context
+    :param data_dict: Request arguments, as per datastore_search
+    :param approximate: If True, unfiltered queries are answered from the
+        resource metadata or the table statistics rather than by scanning
+        the table.
+    """
+    if config["query_extent"] == "solr":
+        return dict(solr_query_extent(data_dict), approximate=False)
+    if approximate and is_unfiltered(data_dict):
+        result = _stored_extent(context, data_dict["resource_id"])
+        if result is None:
+            result = query_estimated_extent(data_dict["resource_id"])
+        if result is not None:
+            return result
+    return dict(postgis_query_extent(data_dict), approximate=False)
+
+
+@side_effect_free
 def datastore_query_extent(context: Context, data_dict: DataDict):
     """Return the geospatial extent of a given datastore queries.
 
@@ -14,11 +180,205 @@ def datastore_query_extent(context: Context, data_dict: DataDict):
                       information
         'bounds': ((lat min, long min), (lat max, long max)) for the
                   queries rows
+        'approximate': True if the result is an estimate
+        'cached': True if the result was served from the extent cache
+    }
+
+    If `approximate` is passed and true, queries without filters are answered
+    from the extent stored in the resource metadata when it was georeferenced,
+    or from the table statistics, rather than with a scan of the whole table.
+    The stored extent is skipped once the table has been written to since, and
+    the statistics can lag behind recent writes. Filtered queries always get
+    exact results.
+
+    The extent is computed by PostGIS, or by Solr stats over the indexed
+    latitude and longitude fields if `dataspatial.query_extent` is `solr`.
+
+    Results are cached per process, keyed on the query and on the version of
+    the resource table, so any write to the table invalidates them.
+
+    :param context: Current context
+    :param data_dict: Request arguments, as per datastore_search, plus
+        `approximate`
+
+    """
+    toolkit.get_or_bust(data_dict, "resource_id")
+    data_dict = dict(data_dict)
+    approximate = toolkit.asbool(data_dict.pop("approximate", False))
+    toolkit.check_access("datastore_search", context, data_dict)
+
+    started = time.perf_counter()
+    result = _cached_query_extent(context, data_dict, approximate)
+    metrics.observe(
+        "dataspatial_extent_query_seconds",
+        time.perf_counter() - started,
+        backend=config["query_extent"],
+        cached=result["cached"],
+    )
+    return result
+
+
+def _cached_query_extent(
+    context: Context, data_dict: DataDict, approximate: bool
+) -> dict:
+    """Run the extent query, unless its result is in the extent cache."""
+    resource_id = data_dict["resource_id"]
+    cache = _get_extent_cache()
+    if cache.max_size <= 0 or cache.ttl <= 0:
+        return dict(_query_extent(context, data_dict, approximate), cached=False)
+
+    if config["query_extent"] == "solr":
+        # the index isn't versioned, so entries only expire
+        version = "solr"
+    else:
+        # replicas may lag behind, and the version is what invalidates entries
+        with get_connection(primary=True) as c:
+            version = get_table_version(c, resource_id)
+    key = extent_cache_key(dict(data_dict, approximate=approximate))
+
+    if version is not None:
+        cached = cache.get(key, version)
+        if cached is not None:
+            return dict(cached, cached=True)
+
+    result = _query_extent(context, data_dict, approximate)
+    if version is not None:
+        cache.set(key, result, version)
+    return dict(result, cached=False)
+
+
+@side_effect_free
+def datastore_search_nearest(context: Context, data_dict: DataDict):
+    """Return the rows of a datastore query nearest to a point.
+
+    The arguments are as per `datastore_search` plus:
+      - lat: Latitude of the point; REQUIRED
+      - lng: Longitude of the point; REQUIRED
+      - k: Number of rows to return (Default value = 10)
+
+    The return value defines:
+    {
+        'resource_id': The resource searched,
+        'fields': Fields of the records, including `_distance`,
+        'records': Matching rows, nearest first, with their `_distance` from
+                   the point in meters
+        'point': {'lat': lat, 'lng': lng},
+        'k': Number of rows requested
     }
 
     :param context: Current context
     :param data_dict: Request arguments, as per datastore_search
 
     """
+    resource_id = toolkit.get_or_bust(data_dict, "resource_id")
+    data_dict = dict(data_dict)
+    lat, lng = toolkit.get_or_bust(data_dict, ["lat", "lng"])
+    k = data_dict.pop("k", 10)
+    for key in ("lat", "lng", "limit", "offset", "sort"):
+        data_dict.pop(key, None)
+
+    errors = {}
+    try:
+        lat, lng = float(lat), float(lng)
+        if not -90 <= lat <= 90 or not -180 <= lng <= 180:
+            errors["lat"] = ["lat/lng is out of range."]
+    except (TypeError, ValueError):
+        errors["lat"] = ["lat and lng must be numbers."]
+    max_k = toolkit.asint(config["nearest.max_k"])
+    try:
+        k = int(k)
+        if not 0 < k <= max_k:
+            errors["k"] = [f"k must be between 1 and {max_k}."]
+    except (TypeError, ValueError):
+        errors["k"] = ["k must be an integer."]
+    if errors:
+        raise toolkit.ValidationError(errors)
+
+    toolkit.check_access("datastore_search", context, data_dict)
+
+    result = query_nearest(data_dict, lat, lng, k)
+    return {
+        "resource_id": resource_id,
+        "fields": result["fields"],
+        "records": result["records"],
+        "point": {"lat": lat, "lng": lng},
+        "k": k,
+    }
+
+
+@side_effect_free
+def datastore_query_grid(context: Context, data_dict: DataDict):
+    """Aggregate the rows of a datastore query into grid cells over a bbox.
+
+    The arguments are as per `datastore_search` plus:
+      - bbox: [xmin, ymin, xmax, ymax] of the map view in WGS84; REQUIRED
+      - zoom: Map zoom level; REQUIRED
+      - grid: One of `square`, `hex` or `geohash` (Default value = square)
+      - cell_size: Size of the cells on screen, in pixels (Default value = 64)
+      - sum_fields: Numeric fields to sum in each cell
+
+    The return value defines:
+    {
+        'cells': [{'lat', 'lng', 'count', 'sums'}, ...] for each cell that has
+                 rows, with `geometry` as GeoJSON for hexagonal cells,
+        'total_count': Number of rows in all the cells,
+        'cell_size': Size of the cells in web mercator meters,
+        'grid': The grid type
+    }
+
+    :param context: Current context
+    :param data_dict: Request arguments, as per datastore_search
+
+    """
+    toolkit.get_or_bust(data_dict, "resource_id")
+    data_dict = dict(data_dict)
+    bbox, zoom = toolkit.get_or_bust(data_dict, ["bbox", "zoom"])
+    grid = data_dict.pop("grid", "square")
+    cell_pixels = data_dict.pop("cell_size", 64)
+    sum_fields = data_dict.pop("sum_fields", None) or []
+    for key in ("bbox", "zoom", "limit", "offset", "sort", "fields"):
+        data_dict.pop(key, None)
+
+    if isinstance(bbox, str) and bbox.startswith("["):
+        bbox = json.loads(bbox)
+    xmin, ymin, xmax, ymax = parse_bbox(bbox)
+    # web mercator is undefined at the poles
+    bbox = [xmin, max(ymin, -MERCATOR_MAX_LAT), xmax, min(ymax, MERCATOR_MAX_LAT)]
+    if isinstance(sum_fields, str):
+        sum_fields = [f.strip() for f in sum_fields.split(",") if f.strip()]
+
+    errors = {}
+    if grid not in GRID_TYPES:
+        errors["grid"] = [f"grid must be one of {', '.join(GRID_TYPES)}."]
+    try:
+        zoom = int(zoom)
+        cell_pixels = int(cell_pixels)
+        if not 0 <= zoom <= 24:
+            errors["zoom"] = ["zoom must be between 0 and 24."]
+        if cell_pixels < 1:
+            errors["cell_size"] = ["cell_size must be a positive number of pixels."]
+    except (TypeError, ValueError):
+        errors["zoom"] = ["zoom and cell_size must be integers."]
+    if errors:
+        raise toolkit.ValidationError(errors)
+
+    toolkit.check_access("datastore_search", context, data_dict)
+
+    cell_size = grid_cell_size(zoom, cell_pixels)
+    precision = None
+    if grid == "geohash":
+        # geohash cells don't have the requested size, count the ones used
+        precision = grid_geohash_precision(data_dict["resource_id"], cell_size)
+        cell_count = estimate_geohash_cells(bbox, precision)
+    else:
+        cell_count = estimate_grid_cells(bbox, cell_size, grid)
+    max_cells = toolkit.asint(config["grid.max_cells"])
+    if cell_count > max_cells:
+        raise toolkit.ValidationError(
+            {"bbox": [f"The bbox would have more than {max_cells} cells at this zoom."]}
+        )
 
-    return postgis_query_extent(data_dict)
+    result = query_grid(
+        data_dict, bbox, cell_size, grid, sum_fields, precision=precision
+    )
+    return dict(result, cell_size=cell_size, grid=grid)
@@ -0,0 +1,175 @@
+# encoding: utf-8
+import datetime
+from unittest import mock
+
+from ckan.plugins import toolkit
+
+from ckanext.dataspatial import actions
+from ckanext.dataspatial.lib.cache import TTLCache
+
+
+class TestPopulateAll:
+    resources = [
+        {"id": "new", "name": "new", "table_size": 1},
+        {"id": "raced", "name": "raced", "table_size": 2},
+        {"id": "broken", "name": "broken", "table_size": 3},
+    ]
+
+    def test_reports_resources_already_queued(self):
+        submit = mock.Mock(
+            side_effect=lambda context, data_dict: data_dict["resource_id"] == "new"
+        )
+        with mock.patch.object(
+            actions, "select_resources_to_populate", return_value=self.resources
+        ), mock.patch.object(
+            actions.jobs, "get_in_flight_job", return_value=None
+        ), mock.patch.object(
+            actions.toolkit, "get_action", return_value=submit
+        ), mock.patch.object(
+            actions,
+            "_find_extant_task",
+            side_effect=lambda context, resource_id: ("task", resource_id == "raced"),
+        ):
+            result = actions.dataspatial_populate_all({}, {"concurrency": 0})
+
+        assert result["submitted"] == ["new"]
+        assert result["already_queued"] == ["raced"]
+        assert result["failed"] == ["broken"]
+        assert result["remaining"] == []
+
+
+class TestSubmit:
+    def _submit(self, large, priority=True):
+        options = {"queue": "dataspatial", "timeout": 3600, "large": large}
+        actions_by_name = {
+            "resource_show": lambda context, data_dict: {
+                "id": "abc",
+                "datastore_active": True,
+            },
+            "task_status_update": lambda context, data_dict: data_dict,
+        }
+        with mock.patch.object(
+            actions.toolkit, "get_action", side_effect=actions_by_name.__getitem__
+        ), mock.patch.object(
+            actions, "_find_extant_task", return_value=(None, False)
+        ), mock.patch.object(
+            actions.jobs, "get_job_options", return_value=options
+        ), mock.patch.object(
+            actions.jobs, "register_job"
+        ), mock.patch.object(
+            actions, "enqueue_job", return_value=mock.Mock(id="job")
+        ) as enqueue_job:
+            assert actions.dataspatial_submit(
+                {"model": mock.Mock()}, {"resource_id": "abc", "priority": priority}
+            )
+        return enqueue_job.call_args.kwargs
+
+    def test_small_tables_skip_the_line(self):
+        kwargs = self._submit(large=False)
+        assert kwargs["queue"] == "dataspatial"
+        assert kwargs["rq_kwargs"] == {"timeout": 3600, "at_front": True}
+
+    def test_large_tables_wait_their_turn(self):
+        kwargs = self._submit(large=True)
+        assert kwargs["rq_kwargs"]["at_front"] is False
+
+    def test_not_at_front_without_priority(self):
+        kwargs = self._submit(large=False, priority=False)
+        assert kwargs["rq_kwargs"]["at_front"] is False
+
+
+class TestFindExtantTask:
+    def _find(self, task, job=None):
+        def task_status_show(context, data_dict):
+            if task is None:
+                raise toolkit.ObjectNotFound()
+            return task
+
+        with mock.patch.object(
+            actions.toolkit, "get_action", return_value=task_status_show
+        ), mock.patch.object(actions.jobs, "get_in_flight_job", return_value=job):
+            return actions._find_extant_task({}, "abc")
+
+    def test_no_task(self):
+        assert self._find(None) == (None, False)
+
+    def test_queued_job(self):
+        task = {
+            "id": "task",
+            "state": "pending",
+            "last_updated": datetime.datetime.utcnow().isoformat(),
+        }
+        job = mock.Mock(id="job")
+        job.get_status.return_value = "queued"
+        assert self._find(task, job) == ("task", True)
+
+    def test_finished_task(self):
+        task = {"id": "task", "state": "complete", "last_updated": "2026-01-01"}
+        assert self._find(task) == ("task", False)
+
+
+class TestAfterDatastoreWrite:
+    def _write(self, context, data_dict=None):
+        with mock.patch.object(
+            actions, "record_table_write"
+        ) as record_table_write, mock.patch.object(
+            actions.jobs, "schedule_auto_submit"
+        ) as schedule_auto_submit, mock.patch.dict(
+            actions.dataspatial_config, {"auto_submit": "true"}
+        ):
+            actions._after_datastore_write(
+                context, data_dict or {"resource_id": "abc"}, {}
+            )
+        return record_table_write, schedule_auto_submit
+
+    def test_external_write_schedules_auto_submit(self):
+        record_table_write, schedule_auto_submit = self._write({"user": "someone"})
+        record_table_write.assert_called_once_with("abc", external=True)
+        schedule_auto_submit.assert_called_once_with("abc")
+
+    def test_own_writes_only_bump_the_version(self):
+        record_table_write, schedule_auto_submit = self._write(
+            {"user": "default", actions.INTERNAL_CONTEXT_KEY: True}
+        )
+        record_table_write.assert_called_once_with("abc", external=False)
+        assert not schedule_auto_submit.called
+
+    def test_dry_run(self):
+        record_table_write, schedule_auto_submit = self._write(
+            {}, {"resource_id": "abc", "dry_run": True}
+        )
+        assert not record_table_write.called
+
+
+class TestResourceList:
+    pages = {
+        None: {"results": [{"id": "a"}, {"id": "b"}], "next_cursor": "b"},
+        "b": {"results": [{"id": "c"}], "next_cursor": None},
+    }
+
+    def _list(self, data_dict):
+        with mock.patch.object(
+            actions, "get_resource_list_version", return_value="v1"
+        ), mock.patch.object(
+            actions, "_get_resource_list_cache", return_value=TTLCache(0, 0)
+        ), mock.patch.object(
+            actions,
+            "_get_resource_list_page",
+            side_effect=lambda context, limit, cursor, since: self.pages[cursor],
+        ) as get_page:
+            result = actions.dataspatial_resource_list({"model": None}, data_dict)
+        return result, get_page
+
+    def test_unpaginated_calls_get_every_resource(self):
+        result, get_page = self._list({})
+        assert result == [{"id": "a"}, {"id": "b"}, {"id": "c"}]
+        assert get_page.call_args.args[1] == actions.RESOURCE_LIST_MAX_LIMIT
+
+    def test_paginated_calls_get_a_page(self):
+        result, get_page = self._list({"limit": "2"})
+        assert result == dict(self.pages[None], version="v1", modified=True)
+
+    def test_not_modified(self):
+        result, get_page = self._list({"version": "v1"})
+        assert result["modified"] is False
+        assert not get_page.called
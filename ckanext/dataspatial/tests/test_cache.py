@@ -0,0 +1,101 @@
+# encoding: utf-8
+from unittest import mock
+
+from ckanext.dataspatial.lib import db
+from ckanext.dataspatial.lib.cache import TTLCache
+
+
+class TestTTLCache:
+    def test_get_returns_value_stored_for_same_version(self):
+        cache = TTLCache(max_size=2, ttl=60)
+        cache.set("key", "value", version=(1, 2, 3))
+        assert cache.get("key", version=(1, 2, 3)) == "value"
+
+    def test_get_misses_and_evicts_for_other_version(self):
+        cache = TTLCache(max_size=2, ttl=60)
+        cache.set("key", "value", version=(1, 2, 3))
+        assert cache.get("key", version=(1, 2, 4)) is None
+        # the stale entry is gone, even for the version it was stored with
+        assert cache.get("key", version=(1, 2, 3)) is None
+
+    def test_entries_expire(self):
+        cache = TTLCache(max_size=2, ttl=60)
+        with mock.patch("time.monotonic", return_value=1000):
+            cache.set("key", "value")
+        with mock.patch("time.monotonic", return_value=1059):
+            assert cache.get("key") == "value"
+        with mock.patch("time.monotonic", return_value=1061):
+            assert cache.get("key") is None
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = TTLCache(max_size=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        assert cache.get("a") == 1
+        assert cache.get("b") is None
+        assert cache.get("c") == 3
+
+    def test_disabled_cache_stores_nothing(self):
+        for cache in (TTLCache(max_size=0, ttl=60), TTLCache(max_size=2, ttl=0)):
+            cache.set("key", "value")
+            assert cache.get("key") is None
+
+    def test_invalidate_by_predicate(self):
+        cache = TTLCache(max_size=4, ttl=60)
+        cache.set(("table_a", 1), 1)
+        cache.set(("table_b", 1), 2)
+        cache.invalidate(lambda key: key[0] == "table_a")
+        assert cache.get(("table_a", 1)) is None
+        assert cache.get(("table_b", 1)) == 2
+        cache.invalidate()
+        assert cache.get(("table_b", 1)) is None
+
+
+class TestTableVersion:
+    def _connection(self, counters):
+        connection = mock.MagicMock()
+        connection.execute.return_value.fetchone.return_value = counters
+        return connection
+
+    def test_version_includes_recorded_writes(self):
+        redis = mock.MagicMock()
+        redis.get.return_value = b"3"
+        with mock.patch.object(db, "connect_to_redis", return_value=redis):
+            version = db.get_table_version(self._connection((10, 2, 1)), "table")
+        assert version == (10, 2, 1, 3)
+        redis.get.assert_called_once_with("ckanext:dataspatial:writes:table")
+
+    def test_version_changes_with_a_write_before_statistics_do(self):
+        redis = mock.MagicMock()
+        redis.get.side_effect = [None, b"1"]
+        connection = self._connection((10, 2, 1))
+        with mock.patch.object(db, "connect_to_redis", return_value=redis):
+            before = db.get_table_version(connection, "table")
+            after = db.get_table_version(connection, "table")
+        assert before != after
+
+    def test_missing_table_has_no_version(self):
+        with mock.patch.object(db, "connect_to_redis") as connect_to_redis:
+            assert db.get_table_version(self._connection(None), "table") is None
+        connect_to_redis.assert_not_called()
+
+    def test_record_table_write_bumps_counter(self):
+        redis = mock.MagicMock()
+        pipeline = redis.pipeline.return_value
+        with mock.patch.object(db, "connect_to_redis", return_value=redis):
+            db.record_table_write("table")
+        pipeline.incr.assert_called_once_with("ckanext:dataspatial:writes:table")
+        pipeline.expire.assert_called_once_with(
+            "ckanext:dataspatial:writes:table", db.TABLE_WRITES_TTL
+        )
+        pipeline.execute.assert_called_once()
+
+    def test_record_internal_write_leaves_last_write(self):
+        redis = mock.MagicMock()
+        pipeline = redis.pipeline.return_value
+        with mock.patch.object(db, "connect_to_redis", return_value=redis):
+            db.record_table_write("table", external=False)
+        pipeline.incr.assert_called_once()
+        pipeline.set.assert_not_called()
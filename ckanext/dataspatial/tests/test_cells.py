@@ -0,0 +1,90 @@
+# encoding: utf-8
+from contextlib import contextmanager
+from unittest import mock
+
+import pytest
+from ckan.plugins import toolkit
+
+from ckanext.dataspatial import search
+from ckanext.dataspatial.lib import cells
+
+
+class TestGeohashCells:
+    @pytest.mark.parametrize(
+        "precision,width,height",
+        [(1, 45, 45), (2, 11.25, 5.625), (5, 360 / 2**13, 180 / 2**12)],
+    )
+    def test_cell_degrees(self, precision, width, height):
+        assert cells.geohash_cell_degrees(precision) == (width, height)
+
+    def test_estimate_counts_partial_cells(self):
+        # 0.25 x 0.25 degrees at precision 4 (0.35 x 0.18 degree cells)
+        assert cells.estimate_geohash_cells([-80.1, 40.3, -79.85, 40.55], 4) == 2 * 3
+
+    def test_estimate_is_bounded_by_the_world(self):
+        assert cells.estimate_geohash_cells([-180, -90, 180, 90], 1) == 32
+
+    def test_precision_for_cell_size(self):
+        assert cells.precision_for_cell_size([4, 6, 8], 2000) == 6
+
+
+class TestGeohashGrid:
+    data_dict = {
+        "resource_id": "abc",
+        "bbox": [-80.1, 40.3, -79.8, 40.6],
+        "zoom": 10,
+        "grid": "geohash",
+    }
+
+    def _query_grid(self, precision, max_cells):
+        with mock.patch.object(
+            search, "grid_geohash_precision", return_value=precision
+        ), mock.patch.object(
+            search, "query_grid", return_value={}
+        ) as query_grid, mock.patch.dict(
+            search.config, {"grid.max_cells": str(max_cells)}
+        ):
+            search.datastore_query_grid({}, dict(self.data_dict))
+        return query_grid
+
+    def test_within_max_cells(self):
+        # 0.3 x 0.3 degrees overlaps at most 2 x 3 cells at precision 4
+        query_grid = self._query_grid(4, 6)
+        assert query_grid.call_args.kwargs["precision"] == 4
+
+    def test_counts_cells_of_the_chosen_precision(self):
+        # and 29 x 56 cells at precision 6, whatever the cell size
+        with pytest.raises(toolkit.ValidationError):
+            self._query_grid(6, 1000)
+
+
+class TestPopulateGeohashColumns:
+    def test_progress_is_reported_per_batch(self):
+        cursor = mock.Mock(rowcount=10)
+        cursor.fetchone.return_value = (1, 2 * cells.BATCH_SIZE + 10)
+        status_callback = mock.Mock()
+
+        @contextmanager
+        def get_connection(connection=None, write=False, raw=False):
+            yield mock.Mock(cursor=mock.Mock(return_value=cursor))
+
+        with mock.patch.object(
+            cells, "get_connection", get_connection
+        ), mock.patch.object(cells.metrics, "observe") as observe:
+            cells.populate_geohash_columns("abc", [4, 6], "_geom", status_callback=status_callback)
+
+        progress = [
+            (c.kwargs["value"]["rows_completed"], c.kwargs["value"]["rows_total"])
+            for c in status_callback.call_args_list
+        ]
+        rows_total = 2 * cells.BATCH_SIZE + 10
+        assert progress == [
+            (0, rows_total),
+            (cells.BATCH_SIZE, rows_total),
+            (2 * cells.BATCH_SIZE, rows_total),
+            (rows_total, rows_total),
+        ]
+        assert all(
+            c.kwargs["value"]["phase"] == "geohash" for c in status_callback.call_args_list
+        )
+        assert [c.kwargs for c in observe.call_args_list] == [{"phase": "geohash"}] * 3
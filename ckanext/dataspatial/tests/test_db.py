@@ -0,0 +1,299 @@
+# encoding: utf-8
+import asyncio
+import threading
+from contextlib import contextmanager
+from unittest import mock
+
+import pytest
+from ckan.plugins import toolkit
+from sqlalchemy.engine import Connection
+
+from ckanext.dataspatial.lib import db
+
+
+def _connection(autocommit):
+    connection = mock.Mock(spec=Connection)
+    connection.connection.dbapi_connection = mock.Mock(autocommit=autocommit)
+    return connection
+
+
+class TestRawConnection:
+    def test_batches_are_committed_explicitly_on_autocommit_connections(self):
+        connection = _connection(autocommit=True)
+        dbapi_connection = connection.connection.dbapi_connection
+        with db.get_connection(connection, write=True, raw=True) as c:
+            assert c is connection.connection
+            assert dbapi_connection.autocommit is False
+        dbapi_connection.commit.assert_called_once()
+        assert dbapi_connection.autocommit is True
+
+    def test_rolls_back_on_error(self):
+        connection = _connection(autocommit=True)
+        dbapi_connection = connection.connection.dbapi_connection
+        with pytest.raises(ValueError):
+            with db.get_connection(connection, write=True, raw=True):
+                raise ValueError()
+        dbapi_connection.rollback.assert_called_once()
+        assert not dbapi_connection.commit.called
+        assert dbapi_connection.autocommit is True
+
+    def test_transactional_connection_is_left_alone(self):
+        connection = _connection(autocommit=False)
+        dbapi_connection = connection.connection.dbapi_connection
+        with db.get_connection(connection, write=True, raw=True):
+            pass
+        assert not dbapi_connection.commit.called
+
+
+class TestReadTargets:
+    urls = {
+        "ckan.datastore.read_url": "postgresql://primary/datastore",
+    }
+
+    @pytest.fixture(autouse=True)
+    def _config(self):
+        with mock.patch.dict(db.toolkit.config, self.urls), mock.patch.dict(
+            db.config,
+            {
+                "db.read_urls": "postgresql://replica/datastore",
+                "db.replica_connect_timeout": "5",
+                "db.health_check_interval": "30",
+                "db.replica_max_lag": "30",
+            },
+        ):
+            yield
+
+    def test_replicas_time_out(self):
+        assert db._replica_connect_args(
+            "postgresql://replica/datastore", "connect_timeout"
+        ) == {"connect_timeout": 5}
+        assert (
+            db._replica_connect_args("postgresql://primary/datastore", "timeout") == {}
+        )
+
+    def test_no_pin_lookup_without_replicas(self):
+        with mock.patch.dict(db.config, {"db.read_urls": ""}), mock.patch.object(
+            db, "connect_to_redis"
+        ) as connect_to_redis:
+            assert db.choose_read_target("abc").url == "postgresql://primary/datastore"
+            assert db.is_pinned_to_primary("abc") is False
+        assert not connect_to_redis.called
+
+    def test_health_is_checked_once_per_interval(self):
+        target = db.ReadTarget("postgresql://replica/datastore")
+        with mock.patch.object(db, "get_engine") as get_engine:
+            connection = get_engine.return_value.connect.return_value.__enter__
+            connection.return_value.execute.return_value.scalar.return_value = 60
+            assert target.is_healthy() is False
+            assert target.is_healthy() is False
+        assert get_engine.return_value.connect.call_count == 1
+
+    def test_concurrent_checks_get_the_previous_result(self):
+        target = db.ReadTarget("postgresql://replica/datastore")
+        checks = []
+
+        def connect():
+            # another thread asks while this one is checking
+            checks.append(target.is_healthy())
+            raise db.DBAPIError("SELECT 1", {}, Exception("unreachable"))
+
+        with mock.patch.object(db, "get_engine") as get_engine:
+            get_engine.return_value.connect.side_effect = connect
+            assert target.is_healthy() is False
+        assert checks == [True]
+        assert target.healthy is False
+
+
+class TestIsIndexed:
+    INFO = {
+        "columns": {},
+        "indexes": {
+            "gist_idx": {"method": "gist", "columns": ["_geom"], "partial": True},
+            "pair_idx": {"method": "btree", "columns": ["gid", "year"], "partial": False},
+            "expression_idx": {"method": "btree", "columns": None, "partial": False},
+        },
+    }
+
+    @pytest.mark.parametrize(
+        "field,expected", [("gid", True), ("_geom", True), ("year", False)]
+    )
+    def test_leading_column(self, field, expected):
+        with mock.patch.object(db, "get_table_info", return_value=self.INFO):
+            assert db.is_indexed(mock.Mock(), "source", field) is expected
+
+    def test_missing_table(self):
+        with mock.patch.object(db, "get_table_info", return_value=None):
+            assert db.is_indexed(mock.Mock(), "source", "gid") is False
+
+
+class TestGetTableInfo:
+    COLUMNS = {"_geom": {"type": "geometry(Point,4326)", "srid": 4326}}
+
+    @pytest.fixture
+    def connection(self):
+        connection = mock.Mock()
+        self.versions = [(16384, 16384, 5, 1)]
+
+        def execute(query, values):
+            if "relfilenode" in str(query):
+                return mock.Mock(fetchone=mock.Mock(return_value=self.versions[-1]))
+            return mock.Mock(
+                fetchone=mock.Mock(
+                    return_value={"columns": dict(self.COLUMNS), "indexes": None}
+                )
+            )
+
+        connection.execute.side_effect = execute
+        with mock.patch.object(db, "_table_info_cache", None):
+            yield connection
+
+    def _info_reads(self, connection):
+        return sum(
+            "relfilenode" not in str(c.args[0])
+            for c in connection.execute.call_args_list
+        )
+
+    def test_cached_while_the_table_is_unchanged(self, connection):
+        for _ in range(3):
+            info = db.get_table_info(connection, "abc")
+        assert info == {"columns": self.COLUMNS, "indexes": {}}
+        assert self._info_reads(connection) == 1
+
+    @pytest.mark.parametrize(
+        "version",
+        [
+            # recreated
+            (16500, 16500, 3, 0),
+            # rewritten
+            (16384, 16400, 5, 1),
+            # given a column, e.g. by a georeferencing job in another process
+            (16384, 16384, 6, 1),
+            # given an index
+            (16384, 16384, 5, 2),
+        ],
+    )
+    def test_read_again_once_the_table_changed(self, connection, version):
+        db.get_table_info(connection, "abc")
+        self.versions.append(version)
+        db.get_table_info(connection, "abc")
+        assert self._info_reads(connection) == 2
+
+    def test_missing_table(self, connection):
+        self.versions.append(None)
+        assert db.get_table_info(connection, "abc") is None
+        assert self._info_reads(connection) == 0
+
+
+class TestExecuteRead:
+    QUERY = db.text("SELECT 1")
+
+    def _canceled(self):
+        return db.DBAPIError(
+            "SELECT 1", {}, mock.Mock(pgcode=db.QUERY_CANCELED)
+        )
+
+    @pytest.fixture
+    def connection(self):
+        connection = mock.Mock()
+
+        @contextmanager
+        def get_connection(connection_=None, resource_id=None):
+            yield connection
+
+        with mock.patch.object(
+            db, "get_connection", get_connection
+        ), mock.patch.object(db, "async_reads_enabled", return_value=False):
+            yield connection
+
+    def test_statement_timeout(self, connection):
+        connection.execute.return_value.mappings.return_value.all.return_value = [
+            {"count": 1}
+        ]
+        assert db.execute_read(self.QUERY, timeout=500) == [{"count": 1}]
+        set_timeout, query = connection.execute.call_args_list
+        assert set_timeout.args == (db._SET_STATEMENT_TIMEOUT, {"timeout": "500ms"})
+        assert query.args == (self.QUERY, {})
+
+    def test_no_timeout_on_given_connection(self):
+        connection = mock.MagicMock()
+        db.execute_read(self.QUERY, connection=connection, timeout=500)
+        assert connection.execute.call_count == 1
+
+    def test_canceled_query_is_a_validation_error(self, connection):
+        connection.execute.side_effect = [None, self._canceled()]
+        with pytest.raises(toolkit.ValidationError) as e:
+            db.execute_read(self.QUERY, timeout=500)
+        assert "500ms" in str(e.value.error_dict["query"])
+
+    def test_other_errors_are_raised(self, connection):
+        error = db.DBAPIError("SELECT 1", {}, mock.Mock(pgcode="42P01"))
+        connection.execute.side_effect = [None, error]
+        with pytest.raises(db.DBAPIError):
+            db.execute_read(self.QUERY, timeout=500)
+
+
+class TestExecuteReadAsync:
+    QUERY = db.text("SELECT 1")
+
+    def _execute_read(self, execute, timeout=500):
+        target = mock.MagicMock(url="postgresql://replica/datastore")
+        with mock.patch.object(
+            db, "async_reads_enabled", return_value=True
+        ), mock.patch.object(
+            db, "choose_read_target", return_value=target
+        ) as choose_read_target, mock.patch.object(
+            db, "_execute_read_async", execute
+        ), mock.patch.object(
+            db, "get_connection"
+        ) as get_connection:
+            try:
+                return db.execute_read(
+                    self.QUERY, {"a": 1}, timeout=timeout, resource_id="abc"
+                )
+            finally:
+                choose_read_target.assert_called_once_with("abc")
+                target.acquire.assert_called_once_with()
+                assert not get_connection.called
+
+    def test_runs_on_the_event_loop(self):
+        calls = []
+
+        async def execute(query, values, timeout, url):
+            calls.append((query, values, timeout, url, threading.current_thread().name))
+            return [{"count": 1}]
+
+        assert self._execute_read(execute) == [{"count": 1}]
+        assert calls == [
+            (self.QUERY, {"a": 1}, 500, "postgresql://replica/datastore", "dataspatial-db")
+        ]
+
+    def test_canceled_query_is_a_validation_error(self):
+        async def execute(query, values, timeout, url):
+            raise db.DBAPIError("SELECT 1", {}, mock.Mock(pgcode=db.QUERY_CANCELED))
+
+        with pytest.raises(toolkit.ValidationError):
+            self._execute_read(execute)
+
+    def test_task_is_cancelled_after_the_timeout(self):
+        started = threading.Event()
+        cancelled = threading.Event()
+
+        async def execute(query, values, timeout, url):
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        def result(timeout):
+            started.wait(5)
+            raise db.concurrent.futures.TimeoutError
+
+        with mock.patch.object(
+            db.concurrent.futures.Future, "result", side_effect=result
+        ) as future_result, pytest.raises(toolkit.ValidationError):
+            self._execute_read(execute, timeout=10)
+        # the task gets a second more than the statement timeout
+        future_result.assert_called_once_with(1.01)
+        assert cancelled.wait(5)
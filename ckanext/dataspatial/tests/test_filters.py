@@ -0,0 +1,159 @@
+# encoding: utf-8
+import math
+from contextlib import contextmanager
+from unittest import mock
+
+import pytest
+from ckan.plugins import toolkit
+
+from ckanext.dataspatial.lib import filters
+from ckanext.dataspatial.lib.db import _named_clause
+
+
+@contextmanager
+def _georeferenced(exists=True):
+    with mock.patch.object(filters, "get_connection") as get_connection, mock.patch.object(
+        filters, "fields_exist", return_value=exists
+    ) as fields_exist:
+        yield fields_exist
+    get_connection.assert_called_once()
+
+
+class TestParseFilters:
+    @pytest.mark.parametrize(
+        "value",
+        [
+            [-80.1, 40.3, -79.8, 40.6],
+            "-80.1,40.3,-79.8,40.6",
+            {"xmin": -80.1, "ymin": 40.3, "xmax": -79.8, "ymax": 40.6},
+        ],
+    )
+    def test_bbox_forms(self, value):
+        assert filters.parse_bbox(value) == [-80.1, 40.3, -79.8, 40.6]
+
+    @pytest.mark.parametrize(
+        "value",
+        [[1, 2, 3], "a,b,c,d", [2, 0, 1, 1], None],
+    )
+    def test_invalid_bbox(self, value):
+        with pytest.raises(toolkit.ValidationError):
+            filters.parse_bbox(value)
+
+    def test_distance(self):
+        assert filters.parse_distance("40.4,-80,500") == [40.4, -80.0, 500.0]
+
+    @pytest.mark.parametrize("value", ["91,0,10", "0,181,10", "0,0,-1"])
+    def test_invalid_distance(self, value):
+        with pytest.raises(toolkit.ValidationError):
+            filters.parse_distance(value)
+
+    def test_wkt(self):
+        assert filters.parse_wkt("POINT (1 2)") == "POINT (1 2)"
+
+    @pytest.mark.parametrize("value", ["POINT (1", 5])
+    def test_invalid_wkt(self, value):
+        with pytest.raises(toolkit.ValidationError):
+            filters.parse_wkt(value)
+
+    def test_geohash_is_lower_cased(self):
+        assert filters.parse_geohash("DPPN") == "dppn"
+
+    @pytest.mark.parametrize("value", ["", "dppa", "d" * 13, 12])
+    def test_invalid_geohash(self, value):
+        with pytest.raises(toolkit.ValidationError):
+            filters.parse_geohash(value)
+
+
+class TestDistanceEnvelope:
+    def test_envelope_contains_the_circle(self):
+        lat, lng, distance = 40.4, -80.0, 10000
+        xmin, ymin, xmax, ymax = filters.distance_envelope(lat, lng, distance)
+        assert ymax - lat >= distance / 111320
+        # a degree of longitude is shorter than at the equator
+        assert xmax - lng > distance / 111320
+        assert math.isclose(lat - ymin, ymax - lat)
+        assert math.isclose(lng - xmin, xmax - lng)
+
+    def test_envelope_near_the_pole_spans_all_longitudes(self):
+        xmin, _, xmax, _ = filters.distance_envelope(89.99, 0, 10000)
+        assert (xmin, xmax) == (-180, 180)
+
+
+class TestValidateSpatialFilters:
+    def test_spatial_filters_are_removed(self):
+        data_dict = {
+            "resource_id": "abc",
+            "filters": {"_bbox": "-80.1,40.3,-79.8,40.6", "name": "x"},
+        }
+        with _georeferenced():
+            filters.validate_spatial_filters(data_dict)
+        assert data_dict["filters"] == {"name": "x"}
+
+    def test_invalid_filter_is_rejected(self):
+        data_dict = {"resource_id": "abc", "filters": {"_bbox": "1,2"}}
+        with pytest.raises(toolkit.ValidationError):
+            filters.validate_spatial_filters(data_dict)
+
+    def test_resource_without_geom_column_is_rejected(self):
+        data_dict = {"resource_id": "abc", "filters": {"_geohash": "dppn"}}
+        with _georeferenced(exists=False) as fields_exist:
+            with pytest.raises(toolkit.ValidationError):
+                filters.validate_spatial_filters(data_dict)
+        assert fields_exist.call_args[0][1:] == ("abc", ["_geom"])
+
+    def test_other_filters_skip_the_column_check(self):
+        data_dict = {"resource_id": "abc", "filters": {"name": "x"}}
+        with mock.patch.object(filters, "get_connection") as get_connection:
+            filters.validate_spatial_filters(data_dict)
+        get_connection.assert_not_called()
+
+
+class TestSpatialWhereClauses:
+    def test_no_spatial_filters(self):
+        assert filters.spatial_where_clauses({"filters": {"name": "x"}}) == []
+
+    def test_bbox_clause(self):
+        [(clause, values)] = filters.spatial_where_clauses(
+            {"filters": '{"_bbox": [-80.1, 40.3, -79.8, 40.6]}'}
+        )
+        assert clause.startswith('"_geom" && ST_MakeEnvelope(')
+        assert values == {
+            "dataspatial_bbox_xmin": -80.1,
+            "dataspatial_bbox_ymin": 40.3,
+            "dataspatial_bbox_xmax": -79.8,
+            "dataspatial_bbox_ymax": 40.6,
+        }
+
+    def test_geohash_uses_coarsest_precise_enough_column(self):
+        with mock.patch.object(
+            filters, "get_available_precisions", return_value=[3, 5, 7]
+        ):
+            [(clause, values)] = filters.spatial_where_clauses(
+                {"resource_id": "abc", "filters": {"_geohash": "dppn"}}
+            )
+        assert clause == '"_geohash_5" LIKE :dataspatial_geohash'
+        assert values == {"dataspatial_geohash": "dppn%"}
+
+    def test_geohash_without_columns_intersects_the_cell(self):
+        with mock.patch.object(filters, "get_available_precisions", return_value=[3]):
+            [(clause, values)] = filters.spatial_where_clauses(
+                {"resource_id": "abc", "filters": {"_geohash": "dppn"}}
+            )
+        assert "ST_GeomFromGeoHash(:dataspatial_geohash)" in clause
+        assert values == {"dataspatial_geohash": "dppn"}
+
+
+class TestNamedClause:
+    def test_named_values_are_kept(self):
+        values = {}
+        clause = _named_clause(("a = :a", {"a": 1}), values)
+        assert clause == "a = :a"
+        assert values == {"a": 1}
+
+    def test_positional_values_are_named(self):
+        values = {"x": 0}
+        clause = _named_clause(("a = %s AND b LIKE 'c%%' AND d = %s", 1, 2), values)
+        assert clause == (
+            "a = :dataspatial_param_1 AND b LIKE 'c%' AND d = :dataspatial_param_2"
+        )
+        assert values == {"x": 0, "dataspatial_param_1": 1, "dataspatial_param_2": 2}
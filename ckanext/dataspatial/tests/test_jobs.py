@@ -0,0 +1,361 @@
+# encoding: utf-8
+import datetime
+from unittest import mock
+
+import pytest
+from ckan.plugins import toolkit
+
+from ckanext.dataspatial import jobs
+from ckanext.dataspatial.lib.types import GeoreferenceStatus
+
+WORKING = GeoreferenceStatus.WORKING
+
+
+class TestGetJobOptions:
+    CONFIG = {
+        "jobs.queue": "dataspatial",
+        "jobs.large_queue": "dataspatial-large",
+        "jobs.large_table_rows": "1000000",
+        "jobs.seconds_per_million_rows": "1800",
+        "jobs.max_timeout": "7200",
+    }
+
+    def _options(self, rows):
+        with mock.patch.object(jobs, "get_connection"), mock.patch.object(
+            jobs, "get_estimated_row_count", return_value=rows
+        ), mock.patch.dict(jobs.config, self.CONFIG), mock.patch.dict(
+            jobs.toolkit.config, {"ckanext.dataspatial.job_timeout": "3600"}
+        ):
+            return jobs.get_job_options("abc")
+
+    @pytest.mark.parametrize(
+        "rows,large,queue",
+        [
+            (0, False, "dataspatial"),
+            (1_000_000, False, "dataspatial"),
+            (1_000_001, True, "dataspatial-large"),
+        ],
+    )
+    def test_queue(self, rows, large, queue):
+        options = self._options(rows)
+        assert options["large"] is large
+        assert options["queue"] == queue
+
+    @pytest.mark.parametrize(
+        "rows,timeout",
+        [
+            (0, 3600),
+            (500_000, 4500),
+            (1_000_000, 5400),
+            (1_500_000, 6300),
+            # capped by jobs.max_timeout
+            (10_000_000, 7200),
+        ],
+    )
+    def test_timeout_grows_with_the_table(self, rows, timeout):
+        assert self._options(rows)["timeout"] == timeout
+
+    def test_max_timeout_below_the_base_timeout(self):
+        with mock.patch.dict(self.CONFIG, {"jobs.max_timeout": "60"}):
+            assert self._options(10_000_000)["timeout"] == 3600
+
+
+class TestGetInFlightJob:
+    def _get(self, job_id, job=None):
+        redis = mock.Mock()
+        redis.get.return_value = job_id
+        with mock.patch.object(
+            jobs, "connect_to_redis", return_value=redis
+        ), mock.patch.object(jobs, "Job") as job_class:
+            job_class.fetch.return_value = job
+            if job is None:
+                job_class.fetch.side_effect = jobs.NoSuchJobError()
+            result = jobs.get_in_flight_job("abc")
+        redis.get.assert_called_once_with(jobs._job_key("abc"))
+        return result, job_class.fetch
+
+    def test_no_job_registered(self):
+        result, fetch = self._get(None)
+        assert result is None
+        assert not fetch.called
+
+    @pytest.mark.parametrize("status", jobs.IN_FLIGHT_JOB_STATUSES)
+    def test_in_flight(self, status):
+        job = mock.Mock()
+        job.get_status.return_value = status
+        result, fetch = self._get(b"job", job)
+        assert result is job
+        assert fetch.call_args.args == ("job",)
+
+    @pytest.mark.parametrize("status", ["finished", "failed", "stopped", "canceled"])
+    def test_done(self, status):
+        job = mock.Mock()
+        job.get_status.return_value = status
+        assert self._get(b"job", job)[0] is None
+
+    def test_expired_job(self):
+        assert self._get(b"job")[0] is None
+
+
+class TestSubmitDependentResources:
+    polygons = "polygons"
+    copy = {
+        "id": "copy",
+        "datastore_active": True,
+        "dataspatial_geom_resource": "polygons",
+        "dataspatial_geom_link": "tract",
+    }
+    linked = {
+        "id": "linked",
+        "datastore_active": True,
+        "dataspatial_active": True,
+        "dataspatial_wkt_field": "wkt",
+        "dataspatial_link_resource": "polygons",
+        "dataspatial_link_field": "tract",
+    }
+
+    def _submit_dependents(self):
+        def resource_search(context, data_dict):
+            return {"results": [self.copy, self.linked]}
+
+        actions = {
+            "resource_search": resource_search,
+            "dataspatial_submit": mock.Mock(),
+        }
+        with mock.patch.object(
+            jobs.toolkit, "get_action", side_effect=actions.__getitem__
+        ), mock.patch.object(jobs, "enqueue_link_job") as enqueue_link_job:
+            jobs.submit_dependent_resources(self.polygons)
+        return actions["dataspatial_submit"], enqueue_link_job
+
+    def test_dispatches_by_kind_of_link(self):
+        submit, enqueue_link_job = self._submit_dependents()
+        submit.assert_called_once_with(jobs.DEFAULT_CONTEXT, {"resource_id": "copy"})
+        enqueue_link_job.assert_called_once_with("linked")
+
+    def test_skips_resources_not_georeferenced_yet(self):
+        self.linked = dict(self.linked, dataspatial_active=False)
+        submit, enqueue_link_job = self._submit_dependents()
+        assert not enqueue_link_job.called
+
+
+class TestLinkDatastoreTable:
+    resource = {
+        "id": "abc",
+        "dataspatial_wkt_field": "wkt",
+        "dataspatial_link_resource": "polygons",
+        "dataspatial_link_field": "tract",
+    }
+
+    def test_deleted_resource(self):
+        def resource_show(context, data_dict):
+            if data_dict["id"] == "abc":
+                return self.resource
+            raise toolkit.ObjectNotFound()
+
+        with mock.patch.object(
+            jobs.toolkit, "get_action", return_value=resource_show
+        ), mock.patch.object(jobs.links, "link_to_polygons") as link_to_polygons:
+            jobs.link_datastore_table("abc")
+        assert not link_to_polygons.called
+
+    def test_links_to_the_link_field(self):
+        polygons = {"id": "polygons", "dataspatial_active": True}
+        actions = {
+            "resource_show": lambda context, data_dict: (
+                self.resource if data_dict["id"] == "abc" else polygons
+            ),
+            "resource_patch": mock.Mock(),
+        }
+        with mock.patch.object(
+            jobs.toolkit, "get_action", side_effect=actions.__getitem__
+        ), mock.patch.object(
+            jobs.links, "link_to_polygons"
+        ) as link_to_polygons, mock.patch.object(jobs, "record_table_write"):
+            jobs.link_datastore_table("abc")
+        link_to_polygons.assert_called_once_with("abc", "polygons", "tract", full=True)
+        assert actions["resource_patch"].called
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestStatusCallback:
+    @pytest.fixture
+    def callback(self):
+        self.clock = Clock()
+        self.hook = mock.Mock()
+        with mock.patch.object(
+            jobs.time, "monotonic", self.clock
+        ), mock.patch.object(
+            jobs.toolkit, "get_action", return_value=self.hook
+        ), mock.patch.dict(
+            jobs.config, {"status.update_interval": "5"}
+        ):
+            yield jobs.make_status_callback("abc", "2026-01-01T00:00:00", {})
+
+    def _sent(self):
+        return [c.args[1]["value"] for c in self.hook.call_args_list]
+
+    def test_progress_is_coalesced(self, callback):
+        callback(WORKING, {"notes": "Populating", "phase": "geometry"})
+        for rows in (10, 20, 30):
+            self.clock.now += 1
+            callback(WORKING, {"notes": "Populating", "rows_completed": rows})
+        assert len(self._sent()) == 1
+
+        self.clock.now += 5
+        callback(WORKING, {"notes": "Populating", "rows_completed": 40})
+        assert len(self._sent()) == 2
+        # the coalesced updates are merged into the one sent
+        assert self._sent()[-1]["rows_completed"] == 40
+
+    def test_phase_changes_and_errors_are_sent(self, callback):
+        callback(WORKING, {"notes": "Populating", "phase": "geometry"})
+        callback(WORKING, {"notes": "Populating", "phase": "geohash"})
+        callback(WORKING, {"notes": "Updating metadata"})
+        callback(WORKING, {"notes": "Updating metadata"}, error="boom")
+        callback(GeoreferenceStatus.COMPLETE, {"notes": ""})
+        assert len(self._sent()) == 5
+        assert self.hook.call_args_list[3].args[1]["error"] == "boom"
+
+
+class TestJobProgress:
+    @pytest.fixture
+    def progress(self):
+        self.clock = Clock()
+        with mock.patch.object(jobs.time, "monotonic", self.clock):
+            yield jobs.JobProgress()
+
+    def test_rows_per_second_and_eta(self, progress):
+        progress.update(WORKING, {"phase": "geometry", "rows_total": 1000})
+        self.clock.now += 10
+        value = progress.update(WORKING, {"rows_completed": 250})
+        assert value["phase"] == "geometry"
+        assert value["rows_total"] == 1000
+        assert value["rows_per_second"] == 25
+        assert "eta" in value
+
+    def test_phases_are_timed(self, progress):
+        progress.update(WORKING, {"phase": "geometry", "rows_completed": 5})
+        self.clock.now += 3
+        value = progress.update(WORKING, {"phase": "geohash"})
+        # counters of the previous phase are reset
+        assert "rows_completed" not in value
+        self.clock.now += 2
+        value = progress.update(GeoreferenceStatus.COMPLETE, {"notes": ""})
+        assert value["phase"] is None
+        assert "eta" not in value
+        assert value["phase_durations"] == {"geometry": 3, "geohash": 2}
+
+    def test_reported_durations_are_kept(self, progress):
+        progress.update(WORKING, {"phase": "geometry"})
+        self.clock.now += 10
+        progress.update(
+            WORKING, {"phase_durations": {"geometry": 4.0, "mercator": 6.0}}
+        )
+        value = progress.update(GeoreferenceStatus.COMPLETE)
+        assert value["phase_durations"] == {"geometry": 4.0, "mercator": 6.0}
+
+
+class TestAutoSubmit:
+    START = 1_000_000.0
+
+    def _run(self, writes, debounce=60, max_wait=600):
+        """Schedule the submission of a table written to at the given times,
+        then run its jobs when they are due
+
+        :returns: the delays the jobs were scheduled with
+        """
+        clock = {"now": self.START}
+        writes = sorted(writes)
+        scheduled = []
+        queue = mock.Mock()
+        queue.enqueue_in.side_effect = lambda delay, func, *args, **kwargs: (
+            scheduled.append((delay.total_seconds(), func, args))
+        )
+        redis = mock.Mock()
+        redis.set.return_value = True
+
+        def last_write(resource_id):
+            done = [w for w in writes if w <= clock["now"]]
+            if not done:
+                return None
+            return datetime.datetime.utcfromtimestamp(done[-1])
+
+        submit = mock.Mock()
+        actions = {
+            "resource_show": lambda context, data_dict: {
+                "id": "abc",
+                "datastore_active": True,
+                "dataspatial_wkt_field": "wkt",
+            },
+            "dataspatial_submit": submit,
+        }
+        delays = []
+        with mock.patch.object(
+            jobs.time, "time", lambda: clock["now"]
+        ), mock.patch.object(
+            jobs, "get_queue", return_value=queue
+        ) as get_queue, mock.patch.object(
+            jobs, "get_last_write", last_write
+        ), mock.patch.object(
+            jobs, "connect_to_redis", return_value=redis
+        ), mock.patch.object(
+            jobs.toolkit, "get_action", side_effect=actions.__getitem__
+        ), mock.patch.dict(
+            jobs.config,
+            {
+                "auto_submit.debounce": str(debounce),
+                "auto_submit.max_wait": str(max_wait),
+                "jobs.queue": "dataspatial",
+            },
+        ):
+            jobs.schedule_auto_submit("abc")
+            while scheduled:
+                delay, func, args = scheduled.pop(0)
+                delays.append(delay)
+                clock["now"] += delay
+                func(*args)
+        get_queue.assert_called_with("dataspatial")
+        submit.assert_called_once_with(jobs.DEFAULT_CONTEXT, {"resource_id": "abc"})
+        redis.delete.assert_called_once_with(jobs._auto_submit_key("abc"))
+        return delays
+
+    def test_submits_after_debounce(self):
+        assert self._run([self.START]) == [60]
+
+    def test_reschedules_while_writes_continue(self):
+        assert self._run([self.START, self.START + 30]) == [60, 30]
+
+    def test_waits_no_more_than_max_wait(self):
+        writes = [self.START + i * 50 for i in range(20)]
+        delays = self._run(writes, max_wait=300)
+        assert sum(delays) == 300
+        assert max(delays) <= 60
+
+    def test_scheduled_once_per_burst(self):
+        redis = mock.Mock()
+        redis.set.return_value = False
+        with mock.patch.object(
+            jobs, "connect_to_redis", return_value=redis
+        ), mock.patch.object(jobs, "get_queue") as get_queue:
+            jobs.schedule_auto_submit("abc")
+        assert not get_queue.called
+
+    def test_key_released_if_scheduling_fails(self):
+        redis = mock.Mock()
+        redis.set.return_value = True
+        with mock.patch.object(
+            jobs, "connect_to_redis", return_value=redis
+        ), mock.patch.object(jobs, "get_queue") as get_queue, pytest.raises(
+            RuntimeError
+        ):
+            get_queue.return_value.enqueue_in.side_effect = RuntimeError
+            jobs.schedule_auto_submit("abc")
+        redis.delete.assert_called_once_with(jobs._auto_submit_key("abc"))
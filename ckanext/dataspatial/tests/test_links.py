@@ -0,0 +1,74 @@
+# encoding: utf-8
+from contextlib import contextmanager
+from unittest import mock
+
+import pytest
+
+from ckanext.dataspatial.lib import links
+
+
+class TestParseGeomLink:
+    @pytest.mark.parametrize(
+        "geom_link,expected",
+        [
+            ("id->gid", ("id", "gid")),
+            (" id -> gid ", ("id", "gid")),
+            ("tract", ("tract", "tract")),
+        ],
+    )
+    def test_parse(self, geom_link, expected):
+        assert links.parse_geom_link(geom_link) == expected
+
+    @pytest.mark.parametrize("geom_link", ["", "id->", "->gid", " -> "])
+    def test_invalid(self, geom_link):
+        with pytest.raises(ValueError):
+            links.parse_geom_link(geom_link)
+
+
+class TestPopulateFromLinkedResource:
+    def _populate(self, geom_link, indexed=False, precisions=()):
+        cursor = mock.Mock(rowcount=0)
+        cursor.fetchone.return_value = (1, 10)
+
+        @contextmanager
+        def get_connection(connection=None, write=False, raw=False):
+            yield mock.Mock(cursor=mock.Mock(return_value=cursor))
+
+        with mock.patch.object(
+            links, "get_connection", get_connection
+        ), mock.patch.object(
+            links, "is_indexed", return_value=indexed
+        ), mock.patch.object(
+            links, "create_index"
+        ) as create_index, mock.patch.object(
+            links, "get_available_precisions", return_value=list(precisions)
+        ):
+            links.populate_from_linked_resource("abc", "source", geom_link)
+
+        update_sql, unlink_sql = [c.args[0] for c in cursor.execute.call_args_list[1:3]]
+        return create_index, update_sql, unlink_sql
+
+    def test_geohashes_are_reset_with_the_geometries(self):
+        _, update_sql, unlink_sql = self._populate("tract", precisions=[4, 6])
+        for sql in (update_sql, unlink_sql):
+            assert '"_geohash_4" = NULL' in sql
+            assert '"_geohash_6" = NULL' in sql
+
+    def test_joins_on_the_fields_of_each_resource(self):
+        _, update_sql, unlink_sql = self._populate("id->gid")
+        assert '_target."id" = _source."gid"' in update_sql
+        assert '_source."gid" = _target."id"' in unlink_sql
+
+    def test_source_field_is_indexed_if_needed(self):
+        create_index, _, _ = self._populate("id->gid")
+        create_index.assert_called_once_with(mock.ANY, "source", "gid", "BTREE")
+
+    def test_existing_index_is_used(self):
+        create_index, _, _ = self._populate("id->gid", indexed=True)
+        assert not create_index.called
+
+
+class TestLinkColumns:
+    def test_link_columns_are_namespaced(self):
+        assert links.link_column("tract") == "_link_tract"
+        assert links.link_hash_column("tract") == "_link_tract_md5"
@@ -0,0 +1,134 @@
+# encoding: utf-8
+import logging
+from unittest import mock
+
+import pytest
+
+from ckanext.dataspatial.lib import metrics
+
+
+class TestPrometheusExporter:
+    def test_counter(self):
+        exporter = metrics.PrometheusExporter()
+        exporter.inc("dataspatial_populate_rows_total", 100, {})
+        exporter.inc("dataspatial_populate_rows_total", 50, {})
+        lines = exporter.render().splitlines()
+        assert "# TYPE dataspatial_populate_rows_total counter" in lines
+        assert "dataspatial_populate_rows_total 150" in lines
+
+    def test_histogram_buckets_are_cumulative(self):
+        exporter = metrics.PrometheusExporter()
+        for value in (0.003, 0.02, 0.02, 400):
+            exporter.observe("dataspatial_batch_seconds", value, {"phase": "geometry"})
+        lines = exporter.render().splitlines()
+        name = "dataspatial_batch_seconds"
+        assert f'{name}_bucket{{phase="geometry",le="0.005"}} 1' in lines
+        assert f'{name}_bucket{{phase="geometry",le="0.01"}} 1' in lines
+        assert f'{name}_bucket{{phase="geometry",le="0.025"}} 3' in lines
+        assert f'{name}_bucket{{phase="geometry",le="1800"}} 4' in lines
+        assert f'{name}_bucket{{phase="geometry",le="+Inf"}} 4' in lines
+        assert f'{name}_count{{phase="geometry"}} 4' in lines
+        (total,) = [line for line in lines if line.startswith(f"{name}_sum")]
+        assert total.startswith(f'{name}_sum{{phase="geometry"}} 400.04')
+
+    def test_values_above_every_bucket_are_only_in_inf(self):
+        exporter = metrics.PrometheusExporter()
+        exporter.observe("dataspatial_batch_seconds", 5000, {})
+        lines = exporter.render().splitlines()
+        assert 'dataspatial_batch_seconds_bucket{le="1800"} 0' in lines
+        assert 'dataspatial_batch_seconds_bucket{le="+Inf"} 1' in lines
+
+    def test_label_values_are_escaped(self):
+        exporter = metrics.PrometheusExporter()
+        exporter.inc("dataspatial_populate_rows_total", 1, {"queue": 'a"b\\c\nd'})
+        assert (
+            'dataspatial_populate_rows_total{queue="a\\"b\\\\c\\nd"} 1'
+            in exporter.render().splitlines()
+        )
+
+    def test_every_metric_is_described(self):
+        text = metrics.PrometheusExporter().render()
+        for name in metrics.METRICS:
+            assert f"# HELP {name} " in text
+
+
+class TestStatsdExporter:
+    @pytest.fixture
+    def exporter(self):
+        with mock.patch.dict(
+            metrics.config,
+            {
+                "metrics.statsd_host": "localhost",
+                "metrics.statsd_port": "8125",
+                "metrics.statsd_prefix": "ckan",
+            },
+        ), mock.patch.object(metrics.socket, "socket"):
+            yield metrics.StatsdExporter()
+
+    def _sent(self, exporter):
+        return [c.args[0].decode() for c in exporter._socket.sendto.call_args_list]
+
+    def test_counter(self, exporter):
+        exporter.inc("dataspatial_populate_rows_total", 10, {})
+        assert self._sent(exporter) == ["ckan.dataspatial_populate_rows_total:10|c"]
+        assert exporter._socket.sendto.call_args.args[1] == ("localhost", 8125)
+
+    def test_durations_are_timers_in_milliseconds(self, exporter):
+        exporter.observe("dataspatial_batch_seconds", 0.25, {"phase": "geometry"})
+        assert self._sent(exporter) == [
+            "ckan.dataspatial_batch_seconds.geometry:250.000|ms"
+        ]
+
+    def test_other_histograms(self, exporter):
+        exporter.observe("dataspatial_populate_rows_per_second", 1500, {})
+        assert self._sent(exporter) == [
+            "ckan.dataspatial_populate_rows_per_second:1500|h"
+        ]
+
+    def test_dots_in_labels_are_replaced(self, exporter):
+        exporter.inc("dataspatial_populate_rows_total", 1, {"queue": "a.b"})
+        assert self._sent(exporter) == [
+            "ckan.dataspatial_populate_rows_total.a_b:1|c"
+        ]
+
+
+class TestLogExporter:
+    def test_updates_are_logged(self, caplog):
+        exporter = metrics.LogExporter()
+        with caplog.at_level(logging.INFO, logger=metrics.logger.name):
+            exporter.inc("dataspatial_populate_rows_total", 5, {})
+            exporter.observe("dataspatial_batch_seconds", 0.5, {"phase": "link"})
+        assert caplog.messages == [
+            "dataspatial_populate_rows_total +5",
+            'dataspatial_batch_seconds{phase="link"} 0.5',
+        ]
+
+
+class TestExport:
+    @pytest.fixture(autouse=True)
+    def _reset(self):
+        with mock.patch.object(metrics, "_exporters", None):
+            yield
+
+    def test_unknown_exporter(self):
+        with mock.patch.dict(metrics.config, {"metrics.exporters": "graphite"}):
+            with pytest.raises(ValueError):
+                metrics.get_exporters()
+
+    def test_failing_exporter_doesnt_break_the_caller(self):
+        class Failing(metrics.Exporter):
+            def inc(self, name, value, labels):
+                raise OSError()
+
+        with mock.patch.dict(
+            metrics.EXPORTERS, {"failing": Failing}
+        ), mock.patch.dict(
+            metrics.config, {"metrics.exporters": "failing prometheus"}
+        ):
+            metrics.inc("dataspatial_populate_rows_total", 3)
+            rendered = metrics.render_prometheus()
+        assert "dataspatial_populate_rows_total 3" in rendered.splitlines()
+
+    def test_prometheus_disabled(self):
+        with mock.patch.dict(metrics.config, {"metrics.exporters": ""}):
+            assert metrics.render_prometheus() is None
@@ -0,0 +1,152 @@
+# encoding: utf-8
+import math
+from unittest import mock
+
+import pytest
+from sqlalchemy.exc import DBAPIError
+
+from ckanext.dataspatial.lib import postgis
+
+
+class TestQueryEstimatedExtent:
+    def test_failed_probe_is_rolled_back_to_a_savepoint(self):
+        connection = mock.MagicMock()
+        savepoint = connection.begin_nested.return_value
+        error = DBAPIError("SELECT", {}, Exception("no statistics"))
+        with mock.patch.object(postgis, "execute_read", side_effect=error):
+            assert postgis.query_estimated_extent("table", connection) is None
+        connection.begin_nested.assert_called_once()
+        # the savepoint saw the error, so it rolled back rather than released
+        exc_type = savepoint.__exit__.call_args[0][0]
+        assert exc_type is DBAPIError
+
+    def test_estimate(self):
+        row = {
+            "total_count": 1000,
+            "null_frac": 0.25,
+            "xmin": -80.1,
+            "ymin": 40.3,
+            "xmax": -79.8,
+            "ymax": 40.6,
+        }
+        with mock.patch.object(postgis, "execute_read", return_value=[row]):
+            result = postgis.query_estimated_extent("table")
+        assert result == {
+            "total_count": 1000,
+            "geom_count": 750,
+            "bounds": ((40.3, -80.1), (40.6, -79.8)),
+            "approximate": True,
+        }
+
+    def test_no_statistics(self):
+        row = {"total_count": -1, "null_frac": 0, "xmin": None}
+        with mock.patch.object(postgis, "execute_read", return_value=[row]):
+            assert postgis.query_estimated_extent("table") is None
+
+
+class TestQueryNearest:
+    FIELDS = [{"id": "_id", "type": "int"}, {"id": "name", "type": "text"}]
+
+    def _query_nearest(self, k=3):
+        records = [{"_id": 2, "_distance": 10.5}, {"_id": 1, "_distance": 12.0}]
+        with mock.patch.object(
+            postgis.toolkit,
+            "get_action",
+            return_value=lambda context, data_dict: {"fields": self.FIELDS},
+        ), mock.patch.object(
+            postgis,
+            "invoke_search_plugins",
+            return_value=("", 'WHERE "name" = :name', {"name": "oak"}),
+        ), mock.patch.object(
+            postgis, "execute_read", return_value=[{"record": r} for r in records]
+        ) as execute_read:
+            result = postgis.query_nearest(
+                {"resource_id": "abc", "filters": {"name": "oak"}}, 40.4, -79.9, k
+            )
+        (query, values, _), _ = execute_read.call_args
+        return result, " ".join(str(query).split()), values
+
+    def test_candidates_are_reranked_by_geography_distance(self):
+        result, query, values = self._query_nearest(k=3)
+        inner, outer = query.rsplit(") _nearest_sub", 1)
+        # candidates come from the KNN operator on the mercator column...
+        assert 'ORDER BY "_geom_webmercator" <-> ST_Transform(' in inner
+        assert "LIMIT :dataspatial_candidates" in inner
+        assert values["dataspatial_candidates"] == 3 * postgis.NEAREST_CANDIDATE_FACTOR
+        # ...and are ranked by their distance on the spheroid
+        assert '"_geom"::geography' in inner
+        assert "ORDER BY _nearest_sub._distance LIMIT :dataspatial_k" in outer
+        assert values["dataspatial_k"] == 3
+
+    def test_filters_and_point(self):
+        result, query, values = self._query_nearest()
+        assert 'WHERE "name" = :name AND ("_geom_webmercator" IS NOT NULL)' in query
+        assert values["name"] == "oak"
+        assert (values["dataspatial_lat"], values["dataspatial_lng"]) == (40.4, -79.9)
+
+    def test_records_keep_the_query_order(self):
+        result, _, _ = self._query_nearest()
+        assert [r["_id"] for r in result["records"]] == [2, 1]
+        assert result["fields"] == self.FIELDS + [{"id": "_distance", "type": "float8"}]
+
+
+class TestGridEstimates:
+    WORLD = [-180, -postgis.MERCATOR_MAX_LAT, 180, postgis.MERCATOR_MAX_LAT]
+
+    def test_cell_size(self):
+        # a 256 pixel tile covers the world at zoom 0, and halves at each zoom
+        assert postgis.grid_cell_size(0, 256) == postgis.MERCATOR_WORLD_SIZE
+        assert postgis.grid_cell_size(3, 64) == postgis.MERCATOR_WORLD_SIZE / 32
+
+    def test_square_cells(self):
+        cell_size = postgis.grid_cell_size(2, 256)
+        # 4 by 4 cells, plus a partial row and column at the edges
+        assert postgis.estimate_grid_cells(self.WORLD, cell_size, "square") == 25
+
+    def test_hex_cells_are_larger(self):
+        cell_size = postgis.grid_cell_size(2, 256)
+        square = postgis.estimate_grid_cells(self.WORLD, cell_size, "square")
+        hexes = postgis.estimate_grid_cells(self.WORLD, cell_size, "hex")
+        assert hexes == math.ceil(25 / (3 * math.sqrt(3) / 2))
+        assert hexes < square
+
+    def test_poles_are_clamped(self):
+        cell_size = postgis.grid_cell_size(2, 256)
+        estimate = postgis.estimate_grid_cells([-180, -90, 180, 90], cell_size, "square")
+        assert estimate == 25
+
+    def test_to_mercator(self):
+        assert postgis.to_mercator(0, 0) == pytest.approx((0, 0), abs=1e-6)
+        x, y = postgis.to_mercator(180, postgis.MERCATOR_MAX_LAT)
+        assert x == pytest.approx(postgis.MERCATOR_WORLD_SIZE / 2)
+        assert y == pytest.approx(postgis.MERCATOR_WORLD_SIZE / 2, rel=1e-4)
+        assert postgis.to_mercator(180, 90) == postgis.to_mercator(180, 89.9)
+
+
+class TestQueryGrid:
+    FIELDS = [{"id": "trees", "type": "int4"}, {"id": "name", "type": "text"}]
+
+    def _query_grid(self, sum_fields):
+        with mock.patch.object(
+            postgis.toolkit,
+            "get_action",
+            return_value=lambda context, data_dict: {"fields": self.FIELDS},
+        ), mock.patch.object(
+            postgis, "invoke_search_plugins", return_value=("", "", {})
+        ), mock.patch.object(postgis, "execute_read", return_value=[]) as execute_read:
+            postgis.query_grid(
+                {"resource_id": "abc"}, [-80.1, 40.3, -79.8, 40.6], 100, "square", sum_fields
+            )
+        return execute_read
+
+    def test_sum_fields(self):
+        execute_read = self._query_grid(["trees"])
+        (query, values, _), _ = execute_read.call_args
+        assert "SUM(_grid_sub._sum_0)::float8 AS _sum_0" in str(query)
+        assert values["dataspatial_cell_size"] == 100
+
+    @pytest.mark.parametrize("field", ["name", "missing"])
+    def test_sum_fields_must_be_numeric(self, field):
+        with pytest.raises(postgis.toolkit.ValidationError) as e:
+            self._query_grid(["trees", field])
+        assert "sum_fields" in e.value.error_dict
@@ -0,0 +1,153 @@
+# encoding: utf-8
+import datetime
+from unittest import mock
+
+import pytest
+from ckan.plugins import toolkit
+
+from ckanext.dataspatial import search
+
+
+class TestStoredExtent:
+    resource = {
+        "id": "abc",
+        "dataspatial_last_geom_updated": "2026-01-02T00:00:00",
+        "dataspatial_bbox": [-80.1, 40.3, -79.8, 40.6],
+        "dataspatial_geom_count": 90,
+        "dataspatial_null_count": 10,
+    }
+
+    def _stored_extent(self, last_write):
+        with mock.patch.object(
+            search, "get_last_write", return_value=last_write
+        ), mock.patch.object(
+            search.toolkit,
+            "get_action",
+            return_value=lambda context, data_dict: self.resource,
+        ):
+            return search._stored_extent({}, "abc")
+
+    def test_stored_extent(self):
+        assert self._stored_extent(None) == {
+            "total_count": 100,
+            "geom_count": 90,
+            "bounds": ((40.3, -80.1), (40.6, -79.8)),
+            "approximate": True,
+        }
+
+    def test_write_before_georeferencing_keeps_stored_extent(self):
+        assert self._stored_extent(datetime.datetime(2026, 1, 1)) is not None
+
+    def test_write_since_georeferencing_makes_stored_extent_stale(self):
+        assert self._stored_extent(datetime.datetime(2026, 1, 3)) is None
+
+
+class TestDatastoreSearchNearest:
+    def _search(self, **kwargs):
+        data_dict = dict({"resource_id": "abc", "lat": 40.4, "lng": -79.9}, **kwargs)
+        with mock.patch.object(
+            search, "query_nearest", return_value={"fields": [], "records": []}
+        ) as query_nearest, mock.patch.dict(search.config, {"nearest.max_k": "100"}):
+            result = search.datastore_search_nearest({}, data_dict)
+        return result, query_nearest
+
+    def test_nearest(self):
+        result, query_nearest = self._search(lat="40.4", k="5", limit=1000, sort="name")
+        query_nearest.assert_called_once_with({"resource_id": "abc"}, 40.4, -79.9, 5)
+        assert result["point"] == {"lat": 40.4, "lng": -79.9}
+        assert result["k"] == 5
+
+    def test_default_k(self):
+        result, _ = self._search()
+        assert result["k"] == 10
+
+    @pytest.mark.parametrize(
+        "point",
+        [
+            {"lat": 90.5},
+            {"lat": -91},
+            {"lng": 180.1},
+            {"lng": -200},
+            {"lat": "north"},
+            {"lng": None},
+        ],
+    )
+    def test_invalid_point(self, point):
+        with pytest.raises(toolkit.ValidationError) as e:
+            self._search(**point)
+        assert "lat" in e.value.error_dict
+
+    @pytest.mark.parametrize("k", [0, -1, 101, "many"])
+    def test_invalid_k(self, k):
+        with pytest.raises(toolkit.ValidationError) as e:
+            self._search(k=k)
+        assert "k" in e.value.error_dict
+
+    def test_max_k(self):
+        result, _ = self._search(k=100)
+        assert result["k"] == 100
+
+
+class TestDatastoreQueryGrid:
+    def _query_grid(self, max_cells=1000, **kwargs):
+        data_dict = dict(
+            {"resource_id": "abc", "bbox": [-80.1, 40.3, -79.8, 40.6], "zoom": 12},
+            **kwargs,
+        )
+        with mock.patch.object(
+            search, "query_grid", return_value={"cells": [], "total_count": 0}
+        ) as query_grid, mock.patch.dict(
+            search.config, {"grid.max_cells": str(max_cells)}
+        ):
+            result = search.datastore_query_grid({}, data_dict)
+        return result, query_grid
+
+    def test_grid(self):
+        result, query_grid = self._query_grid(
+            grid="hex", cell_size="32", sum_fields="trees, benches", limit=10
+        )
+        cell_size = search.grid_cell_size(12, 32)
+        query_grid.assert_called_once_with(
+            {"resource_id": "abc"},
+            [-80.1, 40.3, -79.8, 40.6],
+            cell_size,
+            "hex",
+            ["trees", "benches"],
+            precision=None,
+        )
+        assert result["cell_size"] == cell_size
+        assert result["grid"] == "hex"
+
+    def test_bbox_is_clamped_to_web_mercator(self):
+        _, query_grid = self._query_grid(bbox="[-180, -90, 180, 90]", zoom=2)
+        bbox = query_grid.call_args.args[1]
+        assert bbox == [-180, -search.MERCATOR_MAX_LAT, 180, search.MERCATOR_MAX_LAT]
+
+    @pytest.mark.parametrize("grid", ["square", "hex"])
+    def test_max_cells(self, grid):
+        bbox = [-180, -90, 180, 90]
+        cell_count = search.estimate_grid_cells(
+            [-180, -search.MERCATOR_MAX_LAT, 180, search.MERCATOR_MAX_LAT],
+            search.grid_cell_size(4, 64),
+            grid,
+        )
+        self._query_grid(max_cells=cell_count, bbox=bbox, zoom=4, grid=grid)
+        with pytest.raises(toolkit.ValidationError) as e:
+            self._query_grid(max_cells=cell_count - 1, bbox=bbox, zoom=4, grid=grid)
+        assert "bbox" in e.value.error_dict
+
+    @pytest.mark.parametrize(
+        "arguments,field",
+        [
+            ({"grid": "triangle"}, "grid"),
+            ({"zoom": 25}, "zoom"),
+            ({"zoom": -1}, "zoom"),
+            ({"zoom": "far"}, "zoom"),
+            ({"cell_size": 0}, "cell_size"),
+            ({"cell_size": "big"}, "zoom"),
+        ],
+    )
+    def test_invalid(self, arguments, field):
+        with pytest.raises(toolkit.ValidationError) as e:
+            self._query_grid(**arguments)
+        assert field in e.value.error_dict
@@ -0,0 +1,170 @@
+# encoding: utf-8
+from unittest import mock
+
+import pytest
+import requests
+from ckan.plugins import toolkit
+
+from ckanext.dataspatial import search
+from ckanext.dataspatial.lib import solr
+
+SOLR_CONFIG = {
+    "query_extent": "solr",
+    "solr.url": "http://solr:8983/solr/{resource_id}",
+    "solr.index_field": "_geom",
+    "solr.latitude_field": "latitude",
+    "solr.longitude_field": "longitude",
+    "query_extent.cache_size": "0",
+}
+
+
+def _response(body, status=200):
+    response = mock.Mock(status_code=status)
+    response.json.return_value = body
+    if status >= 400:
+        response.raise_for_status.side_effect = requests.HTTPError(
+            f"{status} Error", response=response
+        )
+    return response
+
+
+def _stats(count, lat=(None, None), lng=(None, None)):
+    return {
+        "latitude": {"count": count, "min": lat[0], "max": lat[1]},
+        "longitude": {"count": count, "min": lng[0], "max": lng[1]},
+    }
+
+
+@pytest.fixture
+def solr_get():
+    with mock.patch.dict(solr.config, SOLR_CONFIG), mock.patch.object(
+        solr.requests, "get"
+    ) as get:
+        yield get
+
+
+class TestQueryExtent:
+    def test_extent(self, solr_get):
+        solr_get.return_value = _response(
+            {
+                "response": {"numFound": 100},
+                "stats": {
+                    "stats_fields": _stats(90, (40.3, 40.6), (-80.1, -79.8))
+                },
+                "facet_counts": {"facet_queries": {"geom_count": 90}},
+            }
+        )
+        assert solr.query_extent({"resource_id": "abc"}) == {
+            "total_count": 100,
+            "geom_count": 90,
+            "bounds": ((40.3, -80.1), (40.6, -79.8)),
+        }
+
+        (url,), kwargs = solr_get.call_args
+        assert url == "http://solr:8983/solr/abc/select"
+        assert ("q", "*:*") in kwargs["params"]
+        assert ("facet.query", "{!key=geom_count}_geom:[* TO *]") in kwargs["params"]
+        assert kwargs["timeout"] == 10
+
+    def test_filters(self, solr_get):
+        solr_get.return_value = _response(
+            {
+                "response": {"numFound": 0},
+                "stats": {"stats_fields": _stats(0)},
+                "facet_counts": {"facet_queries": {"geom_count": 0}},
+            }
+        )
+        solr.query_extent(
+            {
+                "resource_id": "abc",
+                "q": "main st",
+                "filters": {"_bbox": [-80.1, 40.3, -79.8, 40.6], "ward": [1, 2]},
+            }
+        )
+        params = solr_get.call_args.kwargs["params"]
+        assert ("q", "main st") in params
+        assert ("fq", "latitude:[40.3 TO 40.6]") in params
+        assert ("fq", "longitude:[-80.1 TO -79.8]") in params
+        assert ("fq", 'ward:("1" OR "2")') in params
+
+    def test_no_matching_documents(self, solr_get):
+        solr_get.return_value = _response(
+            {
+                "response": {"numFound": 0},
+                "stats": {"stats_fields": {"latitude": None, "longitude": None}},
+                "facet_counts": {"facet_queries": {"geom_count": 0}},
+            }
+        )
+        assert solr.query_extent({"resource_id": "abc"}) == {
+            "total_count": 0,
+            "geom_count": 0,
+            "bounds": None,
+        }
+
+    def test_no_stats_without_index_field(self, solr_get):
+        solr_get.return_value = _response({"response": {"numFound": 5}})
+        with mock.patch.dict(solr.config, {"solr.index_field": ""}):
+            result = solr.query_extent({"resource_id": "abc"})
+        assert result == {"total_count": 5, "geom_count": 0, "bounds": None}
+        assert "facet" not in dict(solr_get.call_args.kwargs["params"])
+
+    def test_solr_error(self, solr_get):
+        solr_get.return_value = _response({"error": {"msg": "undefined field"}}, 400)
+        with pytest.raises(toolkit.ValidationError):
+            solr.query_extent({"resource_id": "abc"})
+
+    def test_solr_unreachable(self, solr_get):
+        solr_get.side_effect = requests.ConnectionError()
+        with pytest.raises(toolkit.ValidationError):
+            solr.query_extent({"resource_id": "abc"})
+
+    def test_missing_facet_counts(self, solr_get):
+        solr_get.return_value = _response(
+            {"response": {"numFound": 3}, "stats": {"stats_fields": _stats(3)}}
+        )
+        with pytest.raises(toolkit.ValidationError):
+            solr.query_extent({"resource_id": "abc"})
+
+    def test_unsupported_spatial_filter(self, solr_get):
+        with pytest.raises(toolkit.ValidationError):
+            solr.query_extent(
+                {"resource_id": "abc", "filters": {"_geohash": "dppn"}}
+            )
+        assert not solr_get.called
+
+    def test_url_required(self, solr_get):
+        with mock.patch.dict(solr.config, {"solr.url": ""}), pytest.raises(
+            toolkit.ValidationError
+        ):
+            solr.query_extent({"resource_id": "abc"})
+
+
+class TestDispatch:
+    def test_solr_backend_answers_datastore_query_extent(self, solr_get):
+        solr_get.return_value = _response(
+            {
+                "response": {"numFound": 3},
+                "stats": {"stats_fields": _stats(3, (40.3, 40.6), (-80.1, -79.8))},
+                "facet_counts": {"facet_queries": {"geom_count": 3}},
+            }
+        )
+        with mock.patch.object(search, "postgis_query_extent") as postgis:
+            result = search.datastore_query_extent({}, {"resource_id": "abc"})
+        assert not postgis.called
+        assert result["total_count"] == 3
+        assert result["approximate"] is False
+        assert result["cached"] is False
+
+    def test_solr_backend_ignores_approximate(self, solr_get):
+        solr_get.return_value = _response(
+            {
+                "response": {"numFound": 0},
+                "facet_counts": {"facet_queries": {"geom_count": 0}},
+            }
+        )
+        with mock.patch.object(search, "_stored_extent") as stored:
+            result = search.datastore_query_extent(
+                {}, {"resource_id": "abc", "approximate": True}
+            )
+        assert not stored.called
+        assert result["bounds"] is None
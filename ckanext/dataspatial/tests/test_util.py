@@ -0,0 +1,48 @@
+# encoding: utf-8
+from ckanext.dataspatial.lib import util
+
+
+class TestOutOfSync:
+    resource = {
+        "id": "abc",
+        "datastore_active": True,
+        "dataspatial_latitude_field": "lat",
+        "dataspatial_longitude_field": "lng",
+        "last_modified": "2026-01-01T00:00:00",
+        "dataspatial_last_geom_updated": "2026-01-02T00:00:00",
+    }
+
+    def _georeferenced(self, **changes):
+        resource = dict(
+            self.resource,
+            dataspatial_source_fingerprint=util.source_fingerprint(self.resource),
+        )
+        resource.update(changes)
+        return resource
+
+    def test_fingerprint_only_depends_on_source_fields(self):
+        fingerprint = util.source_fingerprint(self.resource)
+        assert util.source_fingerprint(dict(self.resource, name="other")) == fingerprint
+        # empty values are the same as missing ones
+        assert (
+            util.source_fingerprint(dict(self.resource, dataspatial_wkt_field=""))
+            == fingerprint
+        )
+        assert (
+            util.source_fingerprint(dict(self.resource, dataspatial_latitude_field="y"))
+            != fingerprint
+        )
+
+    def test_up_to_date(self):
+        assert not util.out_of_sync(self._georeferenced())
+        assert not util.out_of_sync(self._georeferenced(description="changed"))
+
+    def test_never_georeferenced(self):
+        assert util.out_of_sync(self.resource)
+
+    def test_source_fields_changed(self):
+        assert util.out_of_sync(self._georeferenced(dataspatial_longitude_field="x"))
+
+    def test_data_modified_since(self):
+        resource = self._georeferenced(last_modified="2026-01-03T00:00:00")
+        assert util.out_of_sync(resource)
@@ -0,0 +1,111 @@
+# encoding: utf-8
+import gzip
+import json
+from unittest import mock
+
+import flask
+import pytest
+from werkzeug.exceptions import HTTPException
+
+from ckanext.dataspatial import views
+
+
+@pytest.fixture
+def request_context():
+    app = flask.Flask(__name__)
+
+    def abort(status_code, detail=""):
+        flask.abort(status_code, detail)
+
+    with mock.patch.object(views.base, "abort", abort):
+        yield app.test_request_context
+
+
+def _status(call):
+    with pytest.raises(HTTPException) as e:
+        call()
+    return e.value.code
+
+
+class TestGeojsonExport:
+    FEATURES = ['{"type": "Feature", "properties": {"_id": %d}}' % i for i in range(3)]
+
+    @pytest.fixture
+    def export(self):
+        def iter_geojson(query, values):
+            yield '{"type": "FeatureCollection", "features": ['
+            yield ",".join(self.FEATURES)
+            yield "]}"
+
+        with mock.patch.object(
+            views.toolkit, "check_access"
+        ), mock.patch.object(
+            views, "prepare_geojson_query", return_value=("SELECT", {})
+        ) as prepare, mock.patch.object(views, "iter_geojson", iter_geojson):
+            yield prepare
+
+    def test_feature_collection(self, request_context, export):
+        with request_context(
+            "/", query_string={"filters": '{"ward": 3}', "q": "oak", "precision": "4"}
+        ):
+            response = views.geojson_export("abc")
+            body = json.loads(response.get_data())
+        assert response.mimetype == "application/geo+json"
+        assert "Content-Encoding" not in response.headers
+        assert len(body["features"]) == 3
+        export.assert_called_once_with(
+            {"resource_id": "abc", "filters": {"ward": 3}, "q": "oak"}, 4
+        )
+
+    def test_gzip(self, request_context, export):
+        with request_context("/", headers={"Accept-Encoding": "gzip, deflate"}):
+            response = views.geojson_export("abc")
+            body = json.loads(gzip.decompress(response.get_data()))
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert response.headers["Vary"] == "Accept-Encoding"
+        assert len(body["features"]) == 3
+
+    @pytest.mark.parametrize("precision", ["-1", "16", "six"])
+    def test_invalid_precision(self, request_context, export, precision):
+        with request_context("/", query_string={"precision": precision}):
+            assert _status(lambda: views.geojson_export("abc")) == 400
+        assert not export.called
+
+    def test_invalid_filters(self, request_context, export):
+        with request_context("/", query_string={"filters": "{ward: 3"}):
+            assert _status(lambda: views.geojson_export("abc")) == 400
+        assert not export.called
+
+    def test_rejected_filters(self, request_context, export):
+        export.side_effect = views.logic.ValidationError({"filters": ["invalid"]})
+        with request_context("/", query_string={"filters": '{"_bbox": "x"}'}):
+            assert _status(lambda: views.geojson_export("abc")) == 400
+
+
+class TestCachedExport:
+    @pytest.fixture
+    def storage(self, tmp_path):
+        with mock.patch.object(views.toolkit, "check_access"), mock.patch.dict(
+            views.toolkit.config, {"ckan.storage_path": str(tmp_path)}
+        ):
+            yield tmp_path
+
+    def test_unknown_format(self, request_context, storage):
+        with request_context("/"):
+            assert _status(lambda: views.cached_export("abcdefgh", "shapefile")) == 404
+
+    def test_missing_file(self, request_context, storage):
+        with request_context("/"):
+            assert _status(lambda: views.cached_export("abcdefgh", "flatgeobuf")) == 404
+
+    def test_export(self, request_context, storage):
+        path = views.get_export_file_path("abcdefgh", "flatgeobuf")
+        path.parent.mkdir(parents=True)
+        path.write_bytes(b"fgb")
+        with request_context("/"):
+            response = views.cached_export("abcdefgh", "flatgeobuf")
+            response.direct_passthrough = False
+            assert response.get_data() == b"fgb"
+        assert response.mimetype == "application/flatgeobuf"
+        assert response.headers["Accept-Ranges"] == "bytes"
+        assert "abcdefgh.fgb" in response.headers["Content-Disposition"]
@@ -1,12 +1,25 @@
 # encoding: utf-8
+import hashlib
+import json
 
 import ckan.lib.base as base
 import ckan.logic as logic
 import ckan.plugins.toolkit as toolkit
-from ckan.common import _
-from flask import Blueprint
+from ckan.common import _, request
+from flask import Blueprint, Response, send_file, stream_with_context
 from flask.views import MethodView
 
+from ckanext.dataspatial.actions import RESOURCE_LIST_DEFAULT_LIMIT
+from ckanext.dataspatial.config import config
+from ckanext.dataspatial.lib import metrics
+from ckanext.dataspatial.lib.export import (
+    EXPORT_FORMATS,
+    chunked,
+    get_export_file_path,
+    gzipped,
+    iter_geojson,
+    prepare_geojson_query,
+)
 from ckanext.dataspatial.lib.types import StatusResult
 
 dataspatial = Blueprint("dataspatial", __name__)
@@ -48,7 +61,7 @@ class ResourceDataView(MethodView):
     def post(self, id: str, resource_id: str):
         """Submit job and return its status"""
         toolkit.get_action("dataspatial_submit")(
-            {"user": "default"}, {"resource_id": resource_id}
+            {"user": "default"}, {"resource_id": resource_id, "priority": True}
         )
 
         return toolkit.redirect_to(
@@ -64,3 +77,144 @@ dataspatial.add_url_rule(
     "/dataset/<id>/resource_dataspatial/<resource_id>",
     view_func=ResourceDataView.as_view(str("resource_dataspatial")),
 )
+
+
+def geojson_export(resource_id: str):
+    """Stream the rows of a datastore search as a GeoJSON FeatureCollection
+
+    Accepts `filters` (as JSON) and `q` as per datastore_search, and
+    `precision`, the number of decimal places of the coordinates.
+    """
+    data_dict = {"resource_id": resource_id}
+    try:
+        if request.args.get("filters"):
+            data_dict["filters"] = json.loads(request.args["filters"])
+        if request.args.get("q"):
+            data_dict["q"] = request.args["q"]
+        precision = int(request.args.get("precision", config["geojson.precision"]))
+    except ValueError:
+        base.abort(400, _("Invalid filters or precision"))
+    if not 0 <= precision <= 15:
+        base.abort(400, _("Precision must be between 0 and 15"))
+
+    try:
+        toolkit.check_access("datastore_search", {}, data_dict)
+        query, values = prepare_geojson_query(data_dict, precision)
+    except logic.NotAuthorized:
+        base.abort(403, _("Not authorized to read resource %s") % resource_id)
+    except logic.NotFound:
+        base.abort(404, _("Resource not found"))
+    except logic.ValidationError as e:
+        base.abort(400, str(e.error_dict))
+
+    body = chunked(iter_geojson(query, values))
+    headers = {
+        "Content-Disposition": f'attachment; filename="{resource_id}.geojson"',
+    }
+    if "gzip" in request.accept_encodings:
+        body = gzipped(body)
+        headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+
+    return Response(
+        stream_with_context(body),
+        mimetype="application/geo+json",
+        headers=headers,
+    )
+
+
+dataspatial.add_url_rule(
+    "/dataspatial/geojson/<resource_id>",
+    view_func=geojson_export,
+)
+
+
+def cached_export(resource_id: str, export_format: str):
+    """Serve the cached export of a resource, with support for range requests"""
+    if export_format not in EXPORT_FORMATS:
+        base.abort(404, _("Unknown export format"))
+    try:
+        toolkit.check_access("resource_show", {}, {"id": resource_id})
+    except logic.NotAuthorized:
+        base.abort(403, _("Not authorized to read resource %s") % resource_id)
+    except logic.NotFound:
+        base.abort(404, _("Resource not found"))
+
+    path = get_export_file_path(resource_id, export_format)
+    if not path.exists():
+        base.abort(404, _("Export not available"))
+
+    spec = EXPORT_FORMATS[export_format]
+    return send_file(
+        path,
+        mimetype=spec["mimetype"],
+        as_attachment=True,
+        download_name=f"{resource_id}.{spec['extension']}",
+        conditional=True,
+    )
+
+
+dataspatial.add_url_rule(
+    "/dataspatial/export/<resource_id>/<export_format>",
+    view_func=cached_export,
+)
+
+
+def resource_list():
+    """List the georeferenced resources as per dataspatial_resource_list
+
+    Accepts `limit`, `cursor` and `since`. Responses carry an ETag, and
+    requests whose If-None-Match matches it get a 304 Not Modified reply.
+    """
+    data_dict = {
+        key: request.args[key]
+        for key in ("limit", "cursor", "since")
+        if request.args.get(key)
+    }
+    # always get a page, rather than the whole list
+    data_dict.setdefault("limit", str(RESOURCE_LIST_DEFAULT_LIMIT))
+    try:
+        result = toolkit.get_action("dataspatial_resource_list")({}, data_dict)
+    except logic.ValidationError as e:
+        base.abort(400, str(e.error_dict))
+
+    tag = hashlib.md5(
+        json.dumps([result["version"], data_dict], sort_keys=True).encode()
+    ).hexdigest()
+    if request.if_none_match.contains(tag):
+        response = Response(status=304)
+    else:
+        response = Response(
+            json.dumps(
+                {
+                    "results": result["results"],
+                    "next_cursor": result["next_cursor"],
+                    "version": result["version"],
+                }
+            ),
+            mimetype="application/json",
+        )
+    response.set_etag(tag)
+    # pollers revalidate every time, which is cheap when nothing changed
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+dataspatial.add_url_rule(
+    "/dataspatial/resources",
+    view_func=resource_list,
+)
+
+
+def metrics_view():
+    """Serve the metrics of this process in the Prometheus text format"""
+    body = metrics.render_prometheus()
+    if body is None:
+        base.abort(404, _("Prometheus metrics are not enabled"))
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
+
+dataspatial.add_url_rule(
+    "/dataspatial/metrics",
+    view_func=metrics_view,
+)